@@ -0,0 +1,176 @@
+'''
+Stand-ins for the Deluge components the plugin core talks to, and a Core
+set up the way enable() and start_plugin() would, without the plugin
+manager, RPC server or proxy.
+'''
+
+import os
+import random
+import hashlib
+import tempfile
+from functools import partial
+from twisted.internet import defer, task, reactor
+import deluge.component as component
+
+from lobbercore.core import Core, DEFAULT_PREFS, time_budget
+from lobbercore.store import TorrentStore
+from lobbercore.addqueue import AddQueue, AddBatcher
+from lobbercore.placement import Placement, load_volumes
+from lobbercore.scrape import ScrapeCache
+from lobbercore.metrics import Registry
+from lobbercore.persist import WriteBehind
+from lobbercore.source import load_sources
+
+STATES = ['Seeding', 'Seeding', 'Paused', 'Downloading', 'Queued']
+
+
+class FakeHandle(object):
+
+    def __init__(self, torrent):
+        self.torrent = torrent
+
+    def is_paused(self):
+        return self.torrent.status['state'] == 'Paused'
+
+
+class FakeTorrent(object):
+
+    def __init__(self, torrent_id, status):
+        self.torrent_id = torrent_id
+        self.status = status
+        self.handle = FakeHandle(self)
+
+    def get_status(self, keys):
+        return dict((k, self.status[k]) for k in keys)
+
+    def pause(self):
+        self.status['state'] = 'Paused'
+
+    def resume(self):
+        self.status['state'] = 'Seeding'
+
+
+def make_library(size, seed=0, now=1300000000.0):
+    """
+    Returns size torrents with seeders, peers, ratios, ages, sizes and states
+    drawn from a seeded random generator.
+    """
+    rnd = random.Random(seed)
+    torrents = {}
+    for i in range(size):
+        torrent_id = hashlib.sha1('library-%d-%d' % (seed, i)).hexdigest()
+        state = rnd.choice(STATES)
+        torrents[torrent_id] = FakeTorrent(torrent_id, {
+            'total_seeds': rnd.randint(0, 6),
+            'total_peers': rnd.randint(0, 20),
+            'ratio': rnd.random() * 4,
+            'time_added': now - rnd.randint(0, 365 * 24 * 3600),
+            'total_size': rnd.randint(1, 1024) * 1024 * 1024,
+            'state': state,
+            'is_finished': state != 'Downloading',
+        })
+    return torrents
+
+
+class FakeTorrentManager(component.Component):
+
+    def __init__(self):
+        component.Component.__init__(self, 'TorrentManager')
+        self.torrents = {}
+        self.removed = 0
+        self.saves = 0
+
+    def __getitem__(self, torrent_id):
+        return self.torrents[torrent_id]
+
+    def get_torrent_list(self):
+        return self.torrents.keys()
+
+    def add(self, filedump=None, filename=None, options=None, save_state=True):
+        torrent_id = hashlib.sha1(filedump).hexdigest()
+        if save_state:
+            self.save_state()
+        return torrent_id
+
+    def save_state(self):
+        self.saves += 1
+
+    def remove(self, torrent_id, remove_data=False):
+        del self.torrents[torrent_id]
+        self.removed += 1
+        return True
+
+
+class FakeCore(component.Component):
+    """
+    The parts of Deluge's Core the plugin calls. Torrent adds succeed at
+    once without fetching anything.
+    """
+
+    def __init__(self, manager):
+        component.Component.__init__(self, 'Core')
+        self.manager = manager
+        self.added = 0
+
+    def get_torrents_status(self, filter_dict, keys):
+        return dict((torrent_id, torrent.get_status(keys))
+                    for torrent_id, torrent in self.manager.torrents.iteritems())
+
+    def add_torrent_url(self, url, options, headers=None):
+        self.added += 1
+        return defer.succeed(hashlib.sha1(url).hexdigest())
+
+
+_components = None
+
+
+def components():
+    """
+    Returns the fake TorrentManager and Core, registered once per process.
+    """
+    global _components
+    if _components is None:
+        manager = FakeTorrentManager()
+        _components = (manager, FakeCore(manager))
+    return _components
+
+
+def make_core(directory=None, **config):
+    """
+    Returns a Core with the default config updated with config, a torrent
+    store in directory and the queues and caches start_plugin creates.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    core = Core.__new__(Core)
+    # Adds are not held for space unless asked for.
+    core.config = dict(DEFAULT_PREFS, admission_enabled=False)
+    core.config.update(config)
+    core.metrics = Registry()
+    core.config_writer = WriteBehind(lambda: None)
+    core.store = TorrentStore(os.path.join(directory, 'lobbercore.db'))
+    core.sources = load_sources(core.config)
+    core.add_batcher = AddBatcher(core.add_torrent_file, core.save_torrent_state,
+                                  batch_size=core.config['add_batch_size'],
+                                  delay=core.config['add_batch_delay'])
+    core.placement = Placement(load_volumes(core.config, directory), core.store,
+                               core.config['placement_policy'])
+    for source in core.sources:
+        source.add_queue = AddQueue(partial(core.add_feed_torrent, source),
+                                    concurrency=core.config['add_concurrency'])
+        source.scrape_cache = ScrapeCache(core.proxy_url(source, core.config['scrape_path']),
+                                          ttl=core.config['scrape_ttl'])
+    core.monitor_cooperator = task.Cooperator(
+        terminationPredicateFactory=time_budget(core.config['monitor_slice_budget']),
+        scheduler=lambda x: reactor.callLater(core.config['monitor_slice_delay'], x))
+    return core
+
+
+def close_core(core):
+    for source in core.sources:
+        source.add_queue.stop()
+        source.scrape_cache.stop()
+    core.placement.stop()
+    core.add_batcher.stop()
+    core.monitor_cooperator.stop()
+    core.store.close()
@@ -0,0 +1,317 @@
+'''
+A local stand-in for the Lobber API for benchmarks and manual testing.
+
+Serves a JSON torrent feed, .torrent downloads, announce/uannounce and
+scrape with a configurable latency, over plain HTTP or TLS with a
+generated self-signed certificate, gzip encoded for clients accepting it
+if asked to. New torrents can be published to the
+feed at an interval, and are pushed to subscribers of the feed's
+server-sent event stream at /torrent/events:
+
+    python benchmarks/lobber.py --port 8000 --torrents 10000 --latency 0.02 --tls
+    python benchmarks/lobber.py --publish-interval 5 --compress
+'''
+
+import os
+import re
+import zlib
+import json
+import hashlib
+import tempfile
+import optparse
+from urllib import unquote
+from binascii import hexlify
+from twisted.internet import reactor, ssl, task
+from twisted.web import server
+from twisted.web.resource import Resource
+
+
+def bencode(value):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, long)):
+        return 'i%de' % value
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return '%d:%s' % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return 'l%se' % ''.join(bencode(v) for v in value)
+    if isinstance(value, dict):
+        return 'd%se' % ''.join(bencode(k) + bencode(value[k]) for k in sorted(value))
+    raise TypeError('Cannot bencode %r' % (value,))
+
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def make_info(i, seed=0):
+    """
+    Returns the info dictionary of torrent number i, the same one for the
+    same seed.
+    """
+    digest = hashlib.sha1('%d-%d' % (seed, i)).digest()
+    length = (int(hexlify(digest[:2]), 16) % 1024 + 1) * 1024 * 1024
+    piece_length = 4 * 1024 * 1024
+    return {
+        'name': 'dataset-%d' % i,
+        'length': length,
+        'piece length': piece_length,
+        'pieces': digest * ((length + piece_length - 1) // piece_length),
+    }
+
+
+def make_entry(i, seed=0):
+    """
+    Returns feed entry number i, the same one for the same seed.
+    """
+    info = make_info(i, seed)
+    return {
+        'id': i,
+        'info_hash': hashlib.sha1(bencode(info)).hexdigest(),
+        'label': info['name'],
+        'description': 'Benchmark torrent %d' % i,
+        'creator': 'benchmark',
+        'published': True,
+        'size': info['length'],
+    }
+
+
+def make_feed(count, seed=0):
+    """
+    Returns count feed entries, the same ones for the same seed.
+    """
+    return [make_entry(i, seed) for i in range(1, count + 1)]
+
+
+def make_metainfo(entry, announce, seed=0):
+    """
+    Returns a bencoded metainfo file for a feed entry made with seed.
+    """
+    return bencode({'announce': announce, 'info': make_info(entry['id'], seed)})
+
+
+def make_certificate(directory):
+    """
+    Writes a self-signed certificate for localhost to directory and returns
+    the paths of the key and certificate.
+    """
+    from OpenSSL import crypto
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    key_path = os.path.join(directory, 'key.pem')
+    cert_path = os.path.join(directory, 'cert.pem')
+    open(key_path, 'w').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    open(cert_path, 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return key_path, cert_path
+
+
+class LobberStandIn(Resource):
+    """
+    The Lobber API paths the plugin uses. Every response is delayed by
+    latency seconds, and requests are counted per path in counts.
+
+    Subscribers of the event stream are sent a comment every ping_interval
+    seconds, and an event for every torrent published, with the entry id as
+    event id so reconnecting subscribers get what they missed.
+
+    If compress is set, responses are gzip encoded for requests accepting
+    it, like a tracker behind a compressing web server.
+    """
+
+    isLeaf = True
+
+    def __init__(self, torrents=1000, latency=0.0, seed=0, ping_interval=30,
+                 compress=False, reactor=reactor):
+        Resource.__init__(self)
+        self.latency = latency
+        self.compress = compress
+        self.gzipped_feed = None
+        self.seed = seed
+        self.reactor = reactor
+        self.counts = {}
+        self.subscribers = []
+        self.pinger = task.LoopingCall(self.ping)
+        self.pinger.clock = reactor
+        self.ping_interval = ping_interval
+        self.set_feed(make_feed(torrents, seed))
+
+    def set_feed(self, entries):
+        self.entries = entries
+        self.by_id = dict((str(e['id']), e) for e in entries)
+        self.by_hash = dict((e['info_hash'], e) for e in entries)
+        self.feed = json.dumps(entries)
+        self.feed_etag = '"%s"' % hashlib.sha1(self.feed).hexdigest()
+        self.gzipped_feed = None
+
+    def publish(self, count=1):
+        """
+        Adds count new torrents to the feed and pushes them to subscribers.
+        """
+        last = self.entries and self.entries[-1]['id'] or 0
+        new = [make_entry(i, self.seed) for i in range(last + 1, last + count + 1)]
+        self.set_feed(self.entries + new)
+        for request in self.subscribers:
+            for entry in new:
+                self.push(request, entry)
+        return new
+
+    def push(self, request, entry):
+        request.write('id: %d\nevent: torrent\ndata: %s\n\n' % (entry['id'], json.dumps(entry)))
+
+    def ping(self):
+        for request in self.subscribers:
+            request.write(': ping\n\n')
+
+    def events(self, request):
+        """
+        Holds the request open as an event stream subscription.
+        """
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        request.write(': subscribed\n\n')
+        last = request.getHeader('last-event-id')
+        if last is not None:
+            for entry in self.entries:
+                if entry['id'] > int(last):
+                    self.push(request, entry)
+        self.subscribers.append(request)
+        request.notifyFinish().addBoth(lambda _: self.subscribers.remove(request))
+        if not self.pinger.running:
+            self.pinger.start(self.ping_interval, now=False)
+        return server.NOT_DONE_YET
+
+    def render(self, request):
+        path = request.path
+        if path == '/torrent/events':
+            self.counts['events'] = self.counts.get('events', 0) + 1
+            return self.events(request)
+        handler = self.route(path)
+        self.counts[handler.__name__] = self.counts.get(handler.__name__, 0) + 1
+        status, headers, body = handler(request)
+        if self.compress and body and 'gzip' in (request.getHeader('accept-encoding') or ''):
+            headers['content-encoding'] = 'gzip'
+            body = self.gzip(body)
+        if self.latency:
+            self.reactor.callLater(self.latency, self.respond, request, status, headers, body)
+            return server.NOT_DONE_YET
+        self.set_headers(request, status, headers)
+        return body
+
+    def gzip(self, body):
+        if body is not self.feed:
+            return gzip(body)
+        if self.gzipped_feed is None:
+            self.gzipped_feed = gzip(body)
+        return self.gzipped_feed
+
+    def set_headers(self, request, status, headers):
+        request.setResponseCode(status)
+        for name, value in headers.items():
+            request.setHeader(name, value)
+
+    def respond(self, request, status, headers, body):
+        if request._disconnected:
+            return
+        self.set_headers(request, status, headers)
+        request.write(body)
+        request.finish()
+
+    def route(self, path):
+        if path.endswith('.json'):
+            return self.feed_json
+        if re.match('^/torrent/[^/]+\\.torrent$', path):
+            return self.torrent_file
+        if path in ('/tracker/announce', '/tracker/uannounce'):
+            return self.announce
+        if path == '/tracker/scrape':
+            return self.scrape
+        return self.not_found
+
+    def feed_json(self, request):
+        since = request.args.get('since')
+        if since:
+            entries = [e for e in self.entries if e['id'] > int(since[0])]
+            return 200, {'content-type': 'application/json'}, json.dumps(entries)
+        if request.getHeader('if-none-match') == self.feed_etag:
+            return 304, {'etag': self.feed_etag}, ''
+        return 200, {'content-type': 'application/json', 'etag': self.feed_etag}, self.feed
+
+    def torrent_file(self, request):
+        entry = self.by_id.get(request.path.split('/')[-1][:-len('.torrent')])
+        if entry is None:
+            return self.not_found(request)
+        announce = 'http://127.0.0.1:%d/tracker/announce' % request.getHost().port
+        return 200, {'content-type': 'application/x-bittorrent'}, make_metainfo(entry, announce, self.seed)
+
+    def announce(self, request):
+        return 200, {'content-type': 'text/plain'}, bencode({'interval': 1800, 'peers': ''})
+
+    def scrape(self, request):
+        files = {}
+        for info_hash in self.info_hashes(request):
+            entry = self.by_hash.get(hexlify(info_hash))
+            if entry is not None:
+                files[info_hash] = {'complete': entry['id'] % 5, 'incomplete': entry['id'] % 3,
+                                    'downloaded': entry['id'] % 7}
+        return 200, {'content-type': 'text/plain'}, bencode({'files': files})
+
+    def info_hashes(self, request):
+        """
+        The raw info_hash parameters, which request.args may have decoded
+        as something other than bytes.
+        """
+        query = request.uri.split('?', 1)[-1]
+        return [unquote(p[len('info_hash='):]) for p in query.split('&') if p.startswith('info_hash=')]
+
+    def not_found(self, request):
+        return 404, {'content-type': 'text/plain'}, 'Not found'
+
+
+def listen(resource, port=0, tls=False, interface='127.0.0.1', reactor=reactor):
+    """
+    Starts serving resource and returns the listening port.
+    """
+    site = server.Site(resource)
+    site.noisy = False
+    if tls:
+        key_path, cert_path = make_certificate(tempfile.mkdtemp())
+        context = ssl.DefaultOpenSSLContextFactory(key_path, cert_path)
+        return reactor.listenSSL(port, site, context, interface=interface)
+    return reactor.listenTCP(port, site, interface=interface)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--torrents', type='int', default=1000, help='feed entries')
+    parser.add_option('--latency', type='float', default=0.0, help='seconds per response')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--tls', action='store_true', default=False)
+    parser.add_option('--compress', action='store_true', default=False,
+                      help='gzip responses for clients accepting it')
+    parser.add_option('--publish-interval', type='float', default=0,
+                      help='seconds between new torrents, 0 for none')
+    options, args = parser.parse_args()
+    standin = LobberStandIn(options.torrents, options.latency, options.seed,
+                            compress=options.compress)
+    port = listen(standin, options.port, options.tls)
+    if options.publish_interval:
+        task.LoopingCall(standin.publish).start(options.publish_interval, now=False)
+    print('Lobber stand-in at %s://127.0.0.1:%d/' % (options.tls and 'https' or 'http',
+                                                      port.getHost().port))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
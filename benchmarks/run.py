@@ -0,0 +1,301 @@
+'''
+Benchmarks of the proxy, feed processing and torrent monitoring, against a
+local Lobber stand-in and fake Deluge components. Needs Deluge and Twisted
+importable, like the plugin itself:
+
+    python benchmarks/run.py -o results.json
+    python benchmarks/run.py --scenario proxy --latency 0.02 --tls
+
+Results are written as JSON, with the parameters and the git revision of
+the run, so runs can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import traceback
+import optparse
+import subprocess
+from urllib import quote
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASEDIR)
+
+import twisted
+from twisted.internet import reactor, defer, task
+from twisted.web import client
+
+from lobber import LobberStandIn, listen, make_feed
+import fakes
+from lobbercore.proxy import ProxyResource, ProxyRoute
+from lobbercore.pool import HTTPConnectionPool
+from lobbercore.metrics import Registry
+
+SCENARIOS = ['proxy', 'feed', 'monitor']
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of a non-empty list.
+    """
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'min': min(values),
+        'median': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': max(values),
+        'mean': sum(values) / len(values),
+    }
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=BASEDIR,
+                                stdout=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return None
+
+
+class StallMonitor(object):
+    """
+    Measures the longest time the reactor did not get to run a timer due
+    every interval seconds.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.max_stall = 0.0
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            self.max_stall = max(self.max_stall, now - self.last - self.interval)
+        self.last = now
+
+    def start(self):
+        self.loop.start(self.interval)
+
+    def stop(self):
+        self.loop.stop()
+        return self.max_stall
+
+
+def request_paths(feed, count):
+    """
+    Returns count proxy request paths: announces, .torrent downloads and
+    scrapes in the proportions 3:1:1 of a storage node seeding feed.
+    """
+    paths = []
+    for i in range(count):
+        entry = feed[i % len(feed)]
+        info_hash = quote(entry['info_hash'].decode('hex'), safe='')
+        kind = i % 5
+        if kind < 3:
+            paths.append('/tracker/announce?info_hash=%s&peer_id=-DE1330-%012d&port=6881'
+                         '&uploaded=0&downloaded=0&left=0&compact=1' % (info_hash, i))
+        elif kind == 3:
+            paths.append('/torrent/%d.torrent' % entry['id'])
+        else:
+            paths.append('/tracker/scrape?info_hash=%s' % info_hash)
+    return paths
+
+
+@defer.inlineCallbacks
+def proxy_scenario(options):
+    """
+    Requests/sec and latency of requests through the proxy to the stand-in.
+    """
+    standin = LobberStandIn(torrents=1000, latency=options.latency, compress=options.compress)
+    upstream = listen(standin, tls=options.tls)
+    pool = HTTPConnectionPool(reactor, metrics=Registry())
+    route = ProxyRoute(
+        '127.0.0.1', upstream.getHost().port,
+        tls=options.tls,
+        path_rewrite=[['/tracker/announce$', '/tracker/uannounce']],
+        headers={'X_LOBBER_KEY': 'benchmark', 'User-Agent': 'Lobber Storage Node/2.0'},
+        pool=pool)
+    proxy = listen(ProxyResource(route))
+    base = 'http://127.0.0.1:%d' % proxy.getHost().port
+    paths = request_paths(standin.entries, options.requests)
+    latencies = []
+    errors = [0]
+
+    def one(path):
+        started = time.time()
+        d = client.getPage(base + path)
+        d.addCallback(lambda _: latencies.append(time.time() - started))
+        d.addErrback(lambda _: errors.__setitem__(0, errors[0] + 1))
+        return d
+
+    started = time.time()
+    cpu = cpu_time()
+    work = (one(path) for path in paths)
+    yield defer.DeferredList([task.cooperate(work).whenDone()
+                              for i in range(options.concurrency)])
+    elapsed = time.time() - started
+    cpu = cpu_time() - cpu
+    stats = pool.metrics.get_stats()
+    pool.closeCachedConnections()
+    yield proxy.stopListening()
+    yield upstream.stopListening()
+    defer.returnValue({
+        'params': {'requests': options.requests, 'concurrency': options.concurrency,
+                   'latency': options.latency, 'tls': options.tls,
+                   'compress': options.compress},
+        'results': {
+            'requests_per_second': len(latencies) / elapsed,
+            'seconds': elapsed,
+            'cpu_seconds': cpu,
+            'errors': errors[0],
+            'latency': summarize(latencies),
+            'upstream_requests': standin.counts,
+            'upstream_connects': stats['upstream_connect_seconds'],
+            'upstream_body_bytes': stats['upstream_body_bytes_total'],
+            'decoded_bytes': stats.get('decoded_bytes_total', {}),
+        },
+    })
+
+
+@defer.inlineCallbacks
+def feed_scenario(options):
+    """
+    Time for process_json to read feeds of each size, half of whose torrents
+    are already in the library.
+    """
+    manager, _ = fakes.components()
+    results = []
+    for size in options.feed_sizes:
+        feed = make_feed(size)
+        document = json.dumps(feed)
+        times = []
+        for i in range(options.repeat):
+            manager.torrents = dict((e['info_hash'], None) for e in feed[::2])
+            plugin = fakes.make_core()
+            started = time.time()
+            plugin.process_json(document)
+            times.append(time.time() - started)
+            fakes.close_core(plugin)
+            # Let the add queue's callbacks settle between runs.
+            yield task.deferLater(reactor, 0, lambda: None)
+        results.append({
+            'entries': size,
+            'bytes': len(document),
+            'seconds': summarize(times),
+            'entries_per_second': size / min(times),
+        })
+    manager.torrents = {}
+    defer.returnValue({'params': {'repeat': options.repeat}, 'results': results})
+
+
+@defer.inlineCallbacks
+def monitor_scenario(options):
+    """
+    Cost of a monitor_torrents pass over libraries of each size, with scrape
+    results cached for all paused torrents.
+    """
+    manager, _ = fakes.components()
+    results = []
+    for size in options.library_sizes:
+        passes = []
+        for i in range(options.repeat):
+            manager.torrents = fakes.make_library(size)
+            plugin = fakes.make_core(monitor_slice_delay=0)
+            for torrent_id, torrent in manager.torrents.iteritems():
+                if torrent.status['state'] == 'Paused':
+                    plugin.sources.default.scrape_cache.update(torrent_id, torrent.status['total_seeds'], 0)
+            stalls = StallMonitor()
+            stalls.start()
+            started = time.time()
+            cpu = cpu_time()
+            yield plugin.monitor_torrents()
+            passes.append({
+                'seconds': time.time() - started,
+                'cpu_seconds': cpu_time() - cpu,
+                'max_stall': stalls.stop(),
+                'evaluate_seconds': plugin.metrics.get_stats()['monitor_evaluate_seconds']['sum'],
+                'actions': plugin.metrics.get_stats().get('monitor_actions_total', {}),
+            })
+            fakes.close_core(plugin)
+        seconds = [p['seconds'] for p in passes]
+        results.append({
+            'torrents': size,
+            'seconds': summarize(seconds),
+            'cpu_seconds': summarize([p['cpu_seconds'] for p in passes]),
+            'evaluate_seconds': summarize([p['evaluate_seconds'] for p in passes]),
+            'max_stall': max(p['max_stall'] for p in passes),
+            'microseconds_per_torrent': min(seconds) / size * 1e6,
+            'actions': passes[-1]['actions'],
+        })
+    manager.torrents = {}
+    defer.returnValue({'params': {'repeat': options.repeat}, 'results': results})
+
+
+@defer.inlineCallbacks
+def run(options):
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'twisted': twisted.__version__,
+        'platform': platform.platform(),
+        'scenarios': {},
+    }
+    try:
+        for name in options.scenarios:
+            scenario = globals()['%s_scenario' % name]
+            print('Running %s...' % name)
+            report['scenarios'][name] = yield scenario(options)
+        output = open(options.output, 'w')
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.close()
+        print('Results written to %s' % options.output)
+    except Exception:
+        traceback.print_exc()
+    reactor.stop()
+
+
+def sizes(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(v) for v in value.split(',')])
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default='benchmark-results.json')
+    parser.add_option('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                      help='one of %s, all by default' % ', '.join(SCENARIOS))
+    parser.add_option('--requests', type='int', default=5000)
+    parser.add_option('--concurrency', type='int', default=20)
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds the stand-in takes per response')
+    parser.add_option('--tls', action='store_true', default=False)
+    parser.add_option('--compress', action='store_true', default=False,
+                      help='have the stand-in gzip its responses')
+    parser.add_option('--feed-sizes', type='string', action='callback', callback=sizes,
+                      default=[1000, 10000, 100000])
+    parser.add_option('--library-sizes', type='string', action='callback', callback=sizes,
+                      default=[1000, 10000, 50000])
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+    if not options.scenarios:
+        options.scenarios = SCENARIOS
+    reactor.callWhenRunning(run, options)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+'''
+Bounded concurrency queue for adding torrents from the feed, and batching
+of the adds themselves.
+'''
+
+import time
+import random
+import logging
+from collections import deque
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+
+log = logging.getLogger(__name__)
+
+
+class AddQueue(object):
+    """
+    Adds feed entries with at most concurrency adds in flight. A failed add
+    is retried after an exponential backoff with jitter, and an entry which
+    has failed max_retries times is moved to the dead letters, where it
+    stays until retry_dead_letters is called.
+
+    add is called with a feed entry and should return a Deferred firing
+    with something true when the torrent has been added. An add which has
+    handed the torrent on and only waits for it to be added, such as in a
+    batch, may hand its slot back with release.
+    """
+
+    def __init__(self, add, concurrency=4, max_retries=5, retry_delay=30,
+                 retry_max_delay=3600, reactor=reactor):
+        self.add = add
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.reactor = reactor
+        self.queue = deque()
+        self.pending = {}
+        self.retries = {}
+        self.dead_letters = {}
+        self.active = 0
+        # Adds in flight, and those of them which have handed their slot back
+        self.running = set()
+        self.released = set()
+        self.stats = {
+            'added': 0,
+            'failed': 0,
+            'retried': 0,
+            'dead_lettered': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    def put(self, torrent):
+        """
+        Queues a feed entry unless it is queued, being added or dead.
+        """
+        info_hash = torrent['info_hash']
+        if info_hash in self.pending or info_hash in self.dead_letters:
+            return False
+        self.pending[info_hash] = {'torrent': torrent, 'attempts': 0, 'queued': time.time()}
+        self.queue.append(info_hash)
+        self.run()
+        return True
+
+    def run(self):
+        while self.queue and self.active < self.concurrency:
+            info_hash = self.queue.popleft()
+            item = self.pending[info_hash]
+            item['attempts'] += 1
+            self.active += 1
+            self.running.add(info_hash)
+            d = defer.maybeDeferred(self.add, item['torrent'])
+            d.addCallbacks(self.add_done, self.add_failed,
+                           callbackArgs=(info_hash,), errbackArgs=(info_hash,))
+            d.addBoth(self.next, info_hash)
+
+    def next(self, _, info_hash):
+        self.running.discard(info_hash)
+        if info_hash in self.released:
+            self.released.discard(info_hash)
+        else:
+            self.active -= 1
+        self.run()
+
+    def release(self, info_hash):
+        """
+        Hands the slot of the add of info_hash in flight back, letting the
+        next entry start. The add still counts as done or failed when its
+        Deferred fires.
+        """
+        if info_hash in self.running and info_hash not in self.released:
+            self.released.add(info_hash)
+            self.active -= 1
+            self.run()
+
+    def add_done(self, result, info_hash):
+        if info_hash not in self.pending:
+            # Stopped while the add was in flight.
+            return
+        if not result:
+            return self.add_failed(None, info_hash)
+        item = self.pending.pop(info_hash)
+        latency = time.time() - item['queued']
+        self.stats['added'] += 1
+        self.stats['latency_total'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def add_failed(self, failure, info_hash):
+        item = self.pending.get(info_hash)
+        if item is None:
+            return
+        self.stats['failed'] += 1
+        error = failure and failure.getErrorMessage() or 'Torrent was not added'
+        if item['attempts'] > self.max_retries:
+            del self.pending[info_hash]
+            self.dead_letters[info_hash] = {
+                'torrent': item['torrent'],
+                'attempts': item['attempts'],
+                'error': error,
+                'time': time.time(),
+            }
+            self.stats['dead_lettered'] += 1
+            log.error('Giving up adding %s after %d attempts: %s' % (info_hash, item['attempts'], error))
+            return
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** (item['attempts'] - 1))
+        delay *= random.uniform(0.5, 1.5)
+        log.warning('Adding %s failed, retrying in %d seconds: %s' % (info_hash, delay, error))
+        self.retries[info_hash] = self.reactor.callLater(delay, self.retry, info_hash)
+
+    def retry(self, info_hash):
+        del self.retries[info_hash]
+        self.stats['retried'] += 1
+        self.queue.append(info_hash)
+        self.run()
+
+    def retry_dead_letters(self):
+        """
+        Queues all dead letters again.
+        """
+        dead, self.dead_letters = self.dead_letters, {}
+        for letter in dead.itervalues():
+            self.put(letter['torrent'])
+        return len(dead)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = len(self.queue)
+        stats['active'] = self.active
+        stats['released'] = len(self.released)
+        stats['retrying'] = len(self.retries)
+        stats['dead_letters'] = len(self.dead_letters)
+        if stats['added']:
+            stats['latency_avg'] = stats['latency_total'] / stats['added']
+        else:
+            stats['latency_avg'] = 0.0
+        return stats
+
+    def stop(self):
+        for call in self.retries.values():
+            call.cancel()
+        self.retries.clear()
+        self.queue.clear()
+        self.pending.clear()
+
+
+class AddBatcher(object):
+    """
+    Adds torrents in batches, calling save once per batch instead of once
+    per torrent. A batch is added delay seconds after its first torrent, or
+    at once when batch_size torrents are waiting.
+
+    add is called with the arguments given to put and returns the torrent
+    id, or raises. put returns a Deferred firing with the result.
+    """
+
+    def __init__(self, add, save, batch_size=50, delay=1, reactor=reactor):
+        self.add = add
+        self.save = save
+        self.batch_size = batch_size
+        self.delay = delay
+        self.reactor = reactor
+        self.batch = []
+        self.flush_call = None
+        self.stats = {
+            'batches': 0,
+            'added': 0,
+            'failed': 0,
+            'batch_time_total': 0.0,
+            'batch_time_max': 0.0,
+        }
+
+    def put(self, *args):
+        d = defer.Deferred()
+        self.batch.append((args, d))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = self.reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        started = time.time()
+        results = []
+        for args, d in batch:
+            try:
+                results.append((d, self.add(*args)))
+                self.stats['added'] += 1
+            except Exception:
+                results.append((d, Failure()))
+                self.stats['failed'] += 1
+        try:
+            self.save()
+        except Exception:
+            log.exception('Saving the torrents added failed.')
+        elapsed = time.time() - started
+        self.stats['batches'] += 1
+        self.stats['batch_time_total'] += elapsed
+        self.stats['batch_time_max'] = max(self.stats['batch_time_max'], elapsed)
+        log.debug('Added a batch of %d torrents in %.3f seconds.' % (len(batch), elapsed))
+        for d, result in results:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['waiting'] = len(self.batch)
+        if stats['batches']:
+            stats['batch_time_avg'] = stats['batch_time_total'] / stats['batches']
+        else:
+            stats['batch_time_avg'] = 0.0
+        return stats
+
+    def stop(self):
+        """
+        Adds the torrents waiting.
+        """
+        self.flush()
@@ -0,0 +1,179 @@
+'''
+Admission of new torrents by the free space of the volume they are
+downloaded to.
+'''
+
+import os
+import time
+import logging
+from collections import deque
+from twisted.internet import defer
+
+log = logging.getLogger(__name__)
+
+
+class Admission(object):
+    """
+    Admits torrents to a volume while the space used on it, plus the space
+    reserved for downloads in progress, stays under high_water, a fraction
+    of the volume's size. Torrents which do not fit wait in a queue and are
+    admitted first in first out by check, as space is freed.
+
+    An admitted torrent reserves its size until released. Once added, the
+    reservation should be updated with the bytes it has left to download,
+    as what it has downloaded is already used on the volume.
+    """
+
+    def __init__(self, path, high_water=0.9, statvfs=os.statvfs):
+        self.path = path
+        self.high_water = high_water
+        self.statvfs = statvfs
+        self.waiting = deque()
+        # info_hash -> [bytes reserved, whether the torrent has been added]
+        self.reservations = {}
+        self.reserved = 0
+        self.total = 0
+        self.free = 0
+        self.stats = {
+            'admitted': 0,
+            'rejected': 0,
+            'waited': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def usage(self):
+        """
+        Returns the size and the free space of the volume in bytes.
+        """
+        path = self.path
+        # Download directories may not have been made yet.
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        st = self.statvfs(path)
+        self.total = st.f_blocks * st.f_frsize
+        self.free = st.f_bavail * st.f_frsize
+        return self.total, self.free
+
+    def fits(self, size):
+        total, free = self.usage()
+        return total - free + self.reserved + size <= self.high_water * total
+
+    def admit(self, info_hash, size):
+        """
+        Returns a Deferred firing when the torrent info_hash of size bytes
+        has been admitted, failing at once if it could never fit.
+        """
+        size = size or 0
+        try:
+            if size > self.high_water * self.usage()[0]:
+                self.stats['rejected'] += 1
+                raise ValueError('%s needs %d bytes, more than the volume of %s holds'
+                                 % (info_hash, size, self.path))
+            if not self.waiting and self.fits(size):
+                self.reserve(info_hash, size)
+                return defer.succeed(None)
+        except (OSError, ValueError):
+            return defer.fail()
+        d = defer.Deferred()
+        self.waiting.append((info_hash, size, d, time.time()))
+        log.info('Holding %s until %d bytes fit on %s.' % (info_hash, size, self.path))
+        return d
+
+    def check(self):
+        """
+        Admits the waiting torrents which fit, in order.
+        """
+        while self.waiting:
+            info_hash, size, d, queued = self.waiting[0]
+            try:
+                if not self.fits(size):
+                    break
+            except OSError:
+                log.exception('Checking the free space of %s failed.' % self.path)
+                break
+            self.waiting.popleft()
+            waited = time.time() - queued
+            self.stats['waited'] += 1
+            self.stats['wait_time_total'] += waited
+            self.stats['wait_time_max'] = max(self.stats['wait_time_max'], waited)
+            self.reserve(info_hash, size)
+            d.callback(None)
+
+    def reserve(self, info_hash, size):
+        self.release(info_hash)
+        self.reservations[info_hash] = [size, False]
+        self.reserved += size
+        self.stats['admitted'] += 1
+
+    def added(self, info_hash):
+        """
+        Marks the reservation of info_hash as that of a torrent in Deluge.
+        """
+        if info_hash in self.reservations:
+            self.reservations[info_hash][1] = True
+
+    def update(self, info_hash, remaining):
+        """
+        Sets the bytes info_hash has left to download.
+        """
+        reservation = self.reservations.get(info_hash)
+        if reservation is not None:
+            self.reserved += remaining - reservation[0]
+            reservation[0] = remaining
+
+    def release(self, info_hash):
+        reservation = self.reservations.pop(info_hash, None)
+        if reservation is not None:
+            self.reserved -= reservation[0]
+
+    def refresh(self, statuses):
+        """
+        Updates the reservations of added torrents from their Deluge statuses
+        with total_wanted, total_done and is_finished, releasing those of
+        torrents finished or gone.
+        """
+        for info_hash, (size, added) in self.reservations.items():
+            if not added:
+                continue
+            status = statuses.get(info_hash)
+            if status is None or status['is_finished']:
+                self.release(info_hash)
+            else:
+                self.update(info_hash, max(0, status['total_wanted'] - status['total_done']))
+
+    def track(self, statuses):
+        """
+        Reserves the space left to download of the unfinished torrents in
+        statuses, like refresh, such as those in Deluge when the plugin
+        starts.
+        """
+        for info_hash, status in statuses.items():
+            if info_hash not in self.reservations and not status['is_finished']:
+                self.reservations[info_hash] = [0, True]
+        self.refresh(statuses)
+
+    def added_torrents(self):
+        return [info_hash for info_hash, (size, added) in self.reservations.items() if added]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['waiting'] = len(self.waiting)
+        stats['reservations'] = len(self.reservations)
+        stats['reserved_bytes'] = self.reserved
+        stats['total_bytes'] = self.total
+        stats['free_bytes'] = self.free
+        if stats['waited']:
+            stats['wait_time_avg'] = stats['wait_time_total'] / stats['waited']
+        else:
+            stats['wait_time_avg'] = 0.0
+        return stats
+
+    def stop(self):
+        """
+        Gives up the adds of the waiting torrents, failing them with
+        CancelledError.
+        """
+        waiting, self.waiting = self.waiting, deque()
+        for info_hash, size, d, queued in waiting:
+            d.errback(defer.CancelledError('Gave up waiting for space for %s' % info_hash))
@@ -0,0 +1,168 @@
+'''
+Rate limiting and spreading of the announces relayed by the Lobber proxy.
+'''
+
+import re
+import hashlib
+from collections import deque
+from twisted.internet import reactor
+from metrics import Registry
+
+# Paths of the announces the scheduler applies to.
+ANNOUNCE_PATH = re.compile('/tracker/u?announce$')
+
+
+class AnnounceScheduler(object):
+    """
+    Paces the announces sent to the tracker with a token bucket refilled
+    with C{rate} tokens a second up to C{burst}. Announces which find no
+    token wait in a queue of at most C{maxQueue} for at most C{maxWait}
+    seconds, and are answered with a 503 if the queue is full or the wait
+    runs out.
+
+    If C{spreadWindow} is set, the regular and started announces made in
+    the first C{spreadWindow} seconds, typically by every torrent at once
+    after a restart, are each given a slot in the window derived from the
+    info hash. Until its slot the torrent is answered without contacting
+    the tracker, with an interval telling it when to announce again.
+
+    @ivar rate: tokens added per second.
+    @ivar burst: the most tokens the bucket holds.
+    @ivar maxQueue: the most announces waiting for a token.
+    @ivar maxWait: seconds an announce may wait for a token.
+    @ivar spreadWindow: seconds startup announces are spread over, 0 for
+        none.
+    """
+
+    def __init__(self, rate=10, burst=20, maxQueue=1000, maxWait=20,
+                 spreadWindow=0, reactor=reactor, metrics=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.spreadWindow = spreadWindow
+        self.reactor = reactor
+        if metrics is None:
+            metrics = Registry()
+        self.started = reactor.seconds()
+        self._tokens = float(burst)
+        self._refilled = self.started
+        self._queue = deque()
+        self._timer = None
+        self._announces = metrics.counter(
+            'announces_total', 'Announces through the proxy, by outcome.', ('outcome',))
+        self._waitSeconds = metrics.histogram(
+            'announce_wait_seconds', 'Time announces waited for a token.')
+
+    def matches(self, path):
+        """
+        Return whether C{path} is an announce path.
+        """
+        return ANNOUNCE_PATH.search(path) is not None
+
+    def schedule(self, request, infoHash, event, send):
+        """
+        Call C{send} when the announce C{request} may go to the tracker, or
+        answer it without contacting the tracker.
+        """
+        now = self.reactor.seconds()
+        if (self.spreadWindow and now - self.started < self.spreadWindow and
+                infoHash is not None and event in (None, '', 'started')):
+            slot = self.started + self._slot(infoHash)
+            if slot > now:
+                self._announces.inc(('deferred',))
+                self._deferTo(request, slot - now)
+                return
+        self._refill(now)
+        if not self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            self._announces.inc(('sent',))
+            send()
+            return
+        if len(self._queue) >= self.maxQueue:
+            self._drop(request, 'dropped_overflow')
+            return
+        entry = [now + self.maxWait, now, request, send]
+        self._queue.append(entry)
+        self._announces.inc(('queued',))
+        request.notifyFinish().addErrback(self._cancelled, entry)
+        self._schedule()
+
+    def getStats(self):
+        self._refill(self.reactor.seconds())
+        return {
+            'queued': len(self._queue),
+            'tokens': self._tokens,
+        }
+
+    def stop(self):
+        """
+        Answer all waiting announces with a 503.
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        while self._queue:
+            entry = self._queue.popleft()
+            if entry[2] is not None:
+                self._drop(entry[2], 'dropped_stopped')
+
+    def _slot(self, infoHash):
+        digest = hashlib.sha1(infoHash).digest()
+        return (ord(digest[0]) << 8 | ord(digest[1])) * self.spreadWindow / 65536.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _cancelled(self, failure, entry):
+        # The client went away while waiting, its token is not needed.
+        entry[2] = None
+
+    def _drain(self):
+        self._timer = None
+        now = self.reactor.seconds()
+        self._refill(now)
+        while self._queue:
+            deadline, queued, request, send = self._queue[0]
+            if request is None:
+                self._queue.popleft()
+            elif deadline <= now:
+                self._queue.popleft()
+                self._drop(request, 'dropped_timeout')
+            elif self._tokens >= 1:
+                self._queue.popleft()
+                self._tokens -= 1
+                self._waitSeconds.observe(now - queued)
+                self._announces.inc(('sent',))
+                send()
+            else:
+                break
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None or not self._queue:
+            return
+        delay = min((1 - self._tokens) / self.rate,
+                    self._queue[0][0] - self.reactor.seconds())
+        self._timer = self.reactor.callLater(max(0, delay), self._drain)
+
+    def _deferTo(self, request, seconds):
+        """
+        Answer an announce with no peers and an interval of C{seconds}.
+        """
+        interval = int(seconds) + 1
+        request.setHeader('content-type', 'text/plain')
+        request.write('d8:intervali%de12:min intervali%de5:peers0:e'
+                      % (interval, interval))
+        request.finish()
+
+    def _drop(self, request, outcome):
+        self._announces.inc((outcome,))
+        request.setResponseCode(503)
+        request.setHeader('retry-after',
+                          str(int(len(self._queue) / self.rate) + 1))
+        request.setHeader('content-type', 'text/plain')
+        request.write('Tracker busy')
+        request.finish()
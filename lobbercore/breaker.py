@@ -0,0 +1,103 @@
+'''
+Circuit breaking of the upstream servers of the Lobber proxy.
+'''
+
+from twisted.internet import reactor
+from metrics import Registry
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Fails requests to an upstream server at once while it keeps failing,
+    instead of letting them pile up waiting for it.
+
+    The circuit opens after C{failureThreshold} failures in a row: failed
+    connections, expired deadlines and 5xx responses. While it is open
+    requests are refused. After C{resetTimeout} seconds it is half open and
+    lets one request through as a probe, closing again if the probe
+    succeeds and opening for another C{resetTimeout} if it fails. A probe
+    which has not reported back after C{resetTimeout} seconds is replaced by
+    another.
+
+    @ivar name: the name of the upstream server, for metrics.
+    @ivar state: C{CLOSED}, C{OPEN} or C{HALF_OPEN}.
+    """
+
+    def __init__(self, name, failureThreshold=5, resetTimeout=30,
+                 reactor=reactor, metrics=None):
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.reactor = reactor
+        if metrics is None:
+            metrics = Registry()
+        self.state = CLOSED
+        self.failures = 0
+        self._openedAt = None
+        self._probeStarted = None
+        self._stats = {'opened': 0, 'rejected': 0, 'probes': 0}
+        self._transitions = metrics.counter(
+            'circuit_transitions_total',
+            'Circuit breaker state changes, by upstream and new state.',
+            ('upstream', 'state'))
+        self._rejected = metrics.counter(
+            'circuit_rejected_total',
+            'Requests refused while the circuit of their upstream was open.',
+            ('upstream',))
+
+    def allow(self):
+        """
+        Return whether a request may be sent upstream now.
+        """
+        now = self.reactor.seconds()
+        if self.state == OPEN and now - self._openedAt >= self.resetTimeout:
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN and (
+                self._probeStarted is None or
+                now - self._probeStarted >= self.resetTimeout):
+            self._probeStarted = now
+            self._stats['probes'] += 1
+            return True
+        if self.state == CLOSED:
+            return True
+        self._stats['rejected'] += 1
+        self._rejected.inc((self.name,))
+        return False
+
+    def retryAfter(self):
+        """
+        Return the seconds until requests may be let through again.
+        """
+        if self.state != OPEN:
+            return 0
+        return max(0, self._openedAt + self.resetTimeout - self.reactor.seconds())
+
+    def success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.failures >= self.failureThreshold):
+            self._openedAt = self.reactor.seconds()
+            self._stats['opened'] += 1
+            self._transition(OPEN)
+
+    def _transition(self, state):
+        self.state = state
+        self._probeStarted = None
+        self._transitions.inc((self.name, state))
+
+    def getStats(self):
+        stats = dict(self._stats)
+        stats['state'] = self.state
+        stats['open'] = int(self.state == OPEN)
+        stats['failures'] = self.failures
+        stats['retry_after'] = self.retryAfter()
+        return stats
@@ -0,0 +1,496 @@
+'''
+HTTP response cache for the Lobber proxy.
+'''
+
+import os
+import re
+import json
+import time
+from hashlib import sha1
+from StringIO import StringIO
+from twisted.internet.defer import Deferred
+from twisted.web.http_headers import Headers
+
+# Response headers kept with a cached body.
+STORED_HEADERS = ('content-type', 'content-disposition', 'content-encoding',
+                  'etag', 'last-modified')
+
+
+class LRUCache(object):
+    """
+    A mapping which holds at most C{maxSize} worth of values and evicts the
+    least recently used ones first.
+
+    @ivar maxSize: the maximum total size of the values.
+    @ivar size: the current total size of the values.
+    """
+
+    def __init__(self, maxSize, sizeOf=None, onEvict=None):
+        """
+        @param sizeOf: callable returning the size of a value, each value
+            counts as one if not given.
+        @param onEvict: callable called with the key and value of evicted
+            entries.
+        """
+        self.maxSize = maxSize
+        self.size = 0
+        self._sizeOf = sizeOf or (lambda value: 1)
+        self._onEvict = onEvict
+        self._map = {}
+        # Circular doubly linked list of [prev, next, key, value], most
+        # recently used last.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def keys(self):
+        return self._map.keys()
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def peek(self, key, default=None):
+        """
+        Return the value of C{key} without marking it as used.
+        """
+        link = self._map.get(key)
+        if link is None:
+            return default
+        return link[3]
+
+    def set(self, key, value):
+        self.pop(key)
+        size = self._sizeOf(value)
+        if size > self.maxSize:
+            return
+        link = [None, None, key, value]
+        self._append(link)
+        self._map[key] = link
+        self.size += size
+        while self.size > self.maxSize:
+            oldest = self._root[1]
+            self.pop(oldest[2])
+            if self._onEvict is not None:
+                self._onEvict(oldest[2], oldest[3])
+
+    def pop(self, key, default=None):
+        link = self._map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        self.size -= self._sizeOf(link[3])
+        return link[3]
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+
+
+
+class CacheEntry(object):
+    """
+    A cached response.
+
+    @ivar headers: list of C{[name, value]} pairs of L{STORED_HEADERS}.
+    @ivar stored: the time the response was fetched or last revalidated.
+    """
+
+    def __init__(self, headers, body, stored=None):
+        self.headers = headers
+        self.body = body
+        if stored is None:
+            stored = time.time()
+        self.stored = stored
+
+    def getHeader(self, name):
+        for key, value in self.headers:
+            if key == name:
+                return value
+        return None
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+
+class DiskCache(object):
+    """
+    Content addressed on-disk cache tier. Response bodies are stored once
+    under their SHA-1 digest, and each cache key has a small metadata file
+    pointing at its body.
+    """
+
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self._keysDir = os.path.join(directory, 'keys')
+        self._bodiesDir = os.path.join(directory, 'bodies')
+        for d in (self._keysDir, self._bodiesDir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self._refs = {}
+        self._index = LRUCache(maxSize, sizeOf=lambda meta: meta['size'],
+                               onEvict=self._evicted)
+        self._load()
+
+    def get(self, key):
+        meta = self._index.get(key)
+        if meta is None:
+            return None
+        try:
+            f = open(self._bodyPath(meta['digest']), 'rb')
+            try:
+                body = f.read()
+            finally:
+                f.close()
+        except IOError:
+            self.remove(key)
+            return None
+        headers = [[str(name), str(value)] for name, value in meta['headers']]
+        return CacheEntry(headers, body, meta['stored'])
+
+    def set(self, key, entry):
+        self.remove(key)
+        if entry.size > self._index.maxSize:
+            return
+        digest = sha1(entry.body).hexdigest()
+        path = self._bodyPath(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._write(path, entry.body)
+        meta = {
+            'key': key,
+            'digest': digest,
+            'headers': entry.headers,
+            'stored': entry.stored,
+            'size': entry.size,
+        }
+        self._write(self._keyPath(key), json.dumps(meta))
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        self._index.set(key, meta)
+
+    def touch(self, key, stored):
+        """
+        Record that the entry for C{key} was revalidated at C{stored}.
+        """
+        meta = self._index.peek(key)
+        if meta is not None:
+            meta['stored'] = stored
+            self._write(self._keyPath(key), json.dumps(meta))
+
+    def remove(self, key):
+        meta = self._index.pop(key)
+        if meta is not None:
+            self._evicted(key, meta)
+
+    def getStats(self):
+        return {'disk_entries': len(self._index),
+                'disk_bytes': self._index.size}
+
+    def _evicted(self, key, meta):
+        self._unlink(self._keyPath(key))
+        digest = meta['digest']
+        self._refs[digest] -= 1
+        if not self._refs[digest]:
+            del self._refs[digest]
+            self._unlink(self._bodyPath(digest))
+
+    def _load(self):
+        metas = []
+        for name in os.listdir(self._keysDir):
+            try:
+                f = open(os.path.join(self._keysDir, name))
+                try:
+                    metas.append(json.load(f))
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                self._unlink(os.path.join(self._keysDir, name))
+        metas.sort(key=lambda meta: meta['stored'])
+        for meta in metas:
+            if os.path.exists(self._bodyPath(meta['digest'])):
+                self._refs[meta['digest']] = \
+                    self._refs.get(meta['digest'], 0) + 1
+                self._index.set(meta['key'], meta)
+            else:
+                self._unlink(self._keyPath(meta['key']))
+
+    def _keyPath(self, key):
+        return os.path.join(self._keysDir, sha1(key).hexdigest())
+
+    def _bodyPath(self, digest):
+        return os.path.join(self._bodiesDir, digest[:2], digest)
+
+    def _write(self, path, data):
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+
+class HTTPCache(object):
+    """
+    Two tier cache of upstream GET responses, an LRU memory tier in front of
+    a L{DiskCache}.
+
+    Which paths are cached is decided by C{rules}, a list of
+    C{[pattern, ttl, stale]} where C{pattern} is a regexp matched against
+    the path, C{ttl} the seconds a response is fresh and C{stale} the
+    seconds after that during which the cached response is still served
+    while it is revalidated in the background. Expired entries are
+    revalidated with If-None-Match/If-Modified-Since.
+    """
+
+    def __init__(self, rules, memorySize, disk=None, maxEntrySize=None):
+        self.rules = [(re.compile(pattern), ttl, stale)
+                      for pattern, ttl, stale in rules]
+        self.memory = LRUCache(memorySize, sizeOf=lambda entry: entry.size)
+        self.disk = disk
+        if maxEntrySize is None:
+            maxEntrySize = memorySize
+        self.maxEntrySize = maxEntrySize
+        self._revalidating = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'revalidations': 0,
+            'not_modified': 0,
+            'bytes_served': 0,
+            'bytes_stored': 0,
+        }
+
+    def ruleFor(self, key):
+        path = key.split('?', 1)[0]
+        for pattern, ttl, stale in self.rules:
+            if pattern.search(path):
+                return ttl, stale
+        return None
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        return entry
+
+    def store(self, key, entry):
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            self.disk.set(key, entry)
+        self.stats['bytes_stored'] += entry.size
+
+    def refresh(self, key, entry):
+        """
+        Mark C{entry} as revalidated by the upstream server.
+        """
+        self.stats['not_modified'] += 1
+        entry.stored = time.time()
+        if self.disk is not None:
+            self.disk.touch(key, entry.stored)
+
+    def render(self, request, key, headers, fetch):
+        """
+        Answer C{request} from the cache, or have C{fetch} get the response
+        from the upstream server.
+
+        @param key: the upstream path and query of the request.
+        @param headers: the headers to send upstream.
+        @param fetch: callable taking the headers to send upstream and the
+            request to relay the response to.
+        """
+        rule = self.ruleFor(key)
+        if rule is None:
+            fetch(headers, request)
+            return
+        ttl, stale = rule
+        entry = self.get(key)
+        for name in ('if-none-match', 'if-modified-since', 'range'):
+            headers.pop(name, None)
+        if entry is not None:
+            age = time.time() - entry.stored
+            if age < ttl:
+                self.stats['hits'] += 1
+                self._serve(request, entry)
+                return
+            if age < ttl + stale:
+                self.stats['stale_hits'] += 1
+                self._serve(request, entry)
+                if key not in self._revalidating:
+                    self._revalidating.add(key)
+                    fetch(self._conditional(headers, entry),
+                          CacheRecorder(self, key, BackgroundRequest(),
+                                        entry))
+                return
+            headers = self._conditional(headers, entry)
+            self.stats['revalidations'] += 1
+        else:
+            self.stats['misses'] += 1
+        fetch(headers, CacheRecorder(self, key, request, entry))
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['memory_entries'] = len(self.memory)
+        stats['memory_bytes'] = self.memory.size
+        if self.disk is not None:
+            stats.update(self.disk.getStats())
+        return stats
+
+    def _serve(self, request, entry):
+        etag = entry.getHeader('etag')
+        if etag is not None and request.getHeader('if-none-match') == etag:
+            request.setResponseCode(304)
+            request.finish()
+            return
+        request.setResponseCode(200)
+        for name, value in entry.headers:
+            request.responseHeaders.setRawHeaders(name, [value])
+        request.setHeader('content-length', str(entry.size))
+        request.write(entry.body)
+        request.finish()
+        self.stats['bytes_served'] += entry.size
+
+    def _conditional(self, headers, entry):
+        headers = dict(headers)
+        etag = entry.getHeader('etag')
+        if etag is not None:
+            headers['if-none-match'] = etag
+        lastModified = entry.getHeader('last-modified')
+        if lastModified is not None:
+            headers['if-modified-since'] = lastModified
+        return headers
+
+    def _finished(self, key):
+        self._revalidating.discard(key)
+
+
+
+class CacheRecorder(object):
+    """
+    Stands in for the request a response is relayed to and records the
+    response for the cache on its way through. A 304 answer to a
+    revalidation refreshes the cached entry, which then answers the request
+    like a cache hit: with a 304 if the client has it already, otherwise in
+    full.
+    """
+
+    def __init__(self, cache, key, request, stale=None):
+        self._cache = cache
+        self._key = key
+        self._request = request
+        self._stale = stale
+        self._code = None
+        self._body = []
+        self._size = 0
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def setResponseCode(self, code, message=None):
+        self._code = code
+        if code == 304 and self._stale is not None:
+            # Answered from the entry when the response is finished.
+            return
+        self._request.setResponseCode(code, message)
+
+    def write(self, data):
+        if self._body is not None:
+            self._size += len(data)
+            if self._size > self._cache.maxEntrySize:
+                self._body = None
+            else:
+                self._body.append(data)
+        self._request.write(data)
+
+    def finish(self):
+        self._cache._finished(self._key)
+        if self._code == 304 and self._stale is not None:
+            self._cache.refresh(self._key, self._stale)
+            self._cache._serve(self._request, self._stale)
+            return
+        if self._code == 200 and self._body is not None:
+            self._store()
+        self._request.finish()
+
+    def _store(self):
+        responseHeaders = self._request.responseHeaders
+        if 'no-store' in ','.join(
+                responseHeaders.getRawHeaders('cache-control', [])):
+            return
+        body = ''.join(self._body)
+        length = responseHeaders.getRawHeaders('content-length')
+        if length and length[0] != str(len(body)):
+            # Truncated response.
+            return
+        headers = []
+        for name in STORED_HEADERS:
+            value = responseHeaders.getRawHeaders(name)
+            if value:
+                headers.append([name, value[0]])
+        self._cache.store(self._key, CacheEntry(headers, body))
+
+
+
+class BackgroundRequest(object):
+    """
+    Stands in for a local request when the cache revalidates an entry on its
+    own. The response is discarded once the cache has recorded it.
+    """
+
+    code = None
+
+    def __init__(self):
+        self.content = StringIO()
+        self.responseHeaders = Headers()
+
+    def getHeader(self, name):
+        return None
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def write(self, data):
+        pass
+
+    def finish(self):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def notifyFinish(self):
+        return Deferred()
@@ -0,0 +1,233 @@
+'''
+Coalescing of identical concurrent GET requests relayed by the Lobber proxy.
+'''
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+from metrics import Registry
+
+# Request headers which change the response, always part of the key.
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'range')
+
+
+class SingleFlight(object):
+    """
+    Collapses identical GET requests made while one is in flight upstream,
+    so that one upstream response is relayed to all of them.
+
+    Requests are identical if their path and query, the Accept-Encoding of
+    the local client, their conditional and range headers, and the headers
+    in C{keyHeaders} are. A request arriving after the response has started
+    joins it if no more than C{maxReplay} bytes of the body have been
+    relayed, and is sent those first.
+
+    @ivar keyHeaders: lower case names of the headers which are part of the
+        key, such as those authenticating the client.
+    @ivar maxReplay: the most body bytes kept for late joiners.
+    """
+
+    def __init__(self, keyHeaders=('authorization', 'cookie'),
+                 maxReplay=1024 * 1024, metrics=None):
+        self.keyHeaders = tuple(CONDITIONAL_HEADERS) + tuple(
+            name.lower() for name in keyHeaders)
+        self.maxReplay = maxReplay
+        if metrics is None:
+            metrics = Registry()
+        self._flights = {}
+        self._requests = metrics.counter(
+            'coalesced_requests_total',
+            'GET requests through the proxy, by whether they were fetched '
+            'upstream or joined a fetch in flight.', ('outcome',))
+
+    def key(self, rest, headers, acceptEncoding):
+        """
+        Return the key of a request for C{rest} with C{headers}.
+        """
+        key = [rest, acceptEncoding]
+        for name in self.keyHeaders:
+            key.append(headers.get(name))
+        return tuple(key)
+
+    def join(self, key, request):
+        """
+        Add C{request} to the flight of C{key} and return C{None} if there
+        is one it can join, otherwise start a flight and return the
+        L{Flight} to relay the upstream response to.
+        """
+        flight = self._flights.get(key)
+        if flight is not None and flight.joinable:
+            self._requests.inc(('joined',))
+            flight.add(request)
+            return None
+        self._requests.inc(('fetched',))
+        flight = Flight(self, key, request)
+        self._flights[key] = flight
+        return flight
+
+    def landed(self, flight):
+        """
+        Called by C{flight} when it is over.
+        """
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def getStats(self):
+        return {'in_flight': len(self._flights)}
+
+
+
+class Flight(object):
+    """
+    Stands in for the requests of a L{SingleFlight} key as the request an
+    upstream response is relayed to, and relays it to each of them. The
+    upstream server is paused while any of them is slow to read, and the
+    upstream response dropped if all of them go away.
+
+    Other attributes are those of the first request.
+
+    @ivar joinable: whether requests may still join.
+    """
+
+    def __init__(self, singleFlight, key, request):
+        self.singleFlight = singleFlight
+        self.key = key
+        self.joinable = True
+        self.responseHeaders = Headers()
+        self.code = None
+        self.message = None
+        self._first = request
+        self._requests = []
+        self._body = []
+        self._size = 0
+        self._started = False
+        self._finished = False
+        self._producer = None
+        self._paused = set()
+        self._finishedDeferreds = []
+        self.add(request)
+
+    def __getattr__(self, name):
+        return getattr(self._first, name)
+
+    def add(self, request):
+        self._requests.append(request)
+        request.notifyFinish().addErrback(self._lost, request)
+        if self._producer is not None:
+            request.registerProducer(_FlightProducer(self, request), True)
+        if self._started:
+            self._start(request)
+            for data in self._body:
+                request.write(data)
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+        self.message = message
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def write(self, data):
+        if not self._started:
+            self._begin()
+        if self.joinable:
+            self._size += len(data)
+            if self._size > self.singleFlight.maxReplay:
+                self.joinable = False
+                self._body = None
+            else:
+                self._body.append(data)
+        for request in self._requests[:]:
+            request.write(data)
+
+    def finish(self):
+        if not self._started:
+            self._begin()
+        self._land()
+        for request in self._requests[:]:
+            request.finish()
+        for d in self._finishedDeferreds:
+            d.callback(None)
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        for request in self._requests:
+            request.registerProducer(_FlightProducer(self, request), True)
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._paused.clear()
+        for request in self._requests:
+            request.unregisterProducer()
+
+    def notifyFinish(self):
+        d = Deferred()
+        self._finishedDeferreds.append(d)
+        return d
+
+    def paused(self, request, paused):
+        """
+        Called when the local client of C{request} pauses or resumes reading.
+        """
+        wasPaused = bool(self._paused)
+        if paused:
+            self._paused.add(request)
+        else:
+            self._paused.discard(request)
+        if self._producer is not None and wasPaused != bool(self._paused):
+            if self._paused:
+                self._producer.pauseProducing()
+            else:
+                self._producer.resumeProducing()
+
+    def _begin(self):
+        self._started = True
+        for request in self._requests[:]:
+            self._start(request)
+
+    def _start(self, request):
+        if self.code is not None:
+            request.setResponseCode(self.code, self.message)
+        for name, values in self.responseHeaders.getAllRawHeaders():
+            request.responseHeaders.setRawHeaders(name, values)
+
+    def _land(self):
+        if not self._finished:
+            self._finished = True
+            self.joinable = False
+            self._body = None
+            self.singleFlight.landed(self)
+
+    def _lost(self, failure, request):
+        if request in self._requests:
+            self._requests.remove(request)
+            self.paused(request, False)
+        if not self._requests and not self._finished:
+            # Nobody is waiting for the response any more.
+            self._land()
+            if self._producer is not None:
+                self._producer.stopProducing()
+            for d in self._finishedDeferreds:
+                d.errback(Failure(failure.value))
+            self._finishedDeferreds = []
+
+
+
+class _FlightProducer(object):
+    """
+    The producer registered with each request of a L{Flight}.
+    """
+
+    def __init__(self, flight, request):
+        self.flight = flight
+        self.request = request
+
+    def pauseProducing(self):
+        self.flight.paused(self.request, True)
+
+    def resumeProducing(self):
+        self.flight.paused(self.request, False)
+
+    def stopProducing(self):
+        # One local client going away does not stop the others.
+        pass
@@ -1,33 +1,175 @@
+import re
+import time
+import hashlib
 import logging
 from deluge.plugins.pluginbase import CorePluginBase
 import deluge.component as component
 import deluge.configmanager
+from deluge.bencode import bdecode, bencode
 from deluge.core.rpcserver import export
 from twisted.web import server, client
 from twisted.internet.task import LoopingCall
-from twisted.internet import task, reactor
+from twisted.internet import task, reactor, defer
 from twisted.internet.error import ConnectError, CannotListenError, ConnectionRefusedError
 from twisted.web.error import Error
 import json
 from urlparse import urlparse
-from urllib import splitnport
+from urllib import quote
+from functools import partial
 
-from lobbercore.proxy import ReverseProxyTLSResource
+from lobbercore.proxy import ProxyResource, ProxyRoute
+from lobbercore.pool import HTTPConnectionPool, upstreamName
+from lobbercore.breaker import CircuitBreaker
+from lobbercore.resolver import CachingResolver
+from lobbercore.cache import HTTPCache, DiskCache
+from lobbercore.coalesce import SingleFlight
+from lobbercore.announce import AnnounceScheduler
+from lobbercore.feed import FeedParser, FeedFile
+from lobbercore.push import FeedSubscription
+from lobbercore.store import TorrentStore, ADDED, REMOVED
+from lobbercore.addqueue import AddQueue, AddBatcher
+from lobbercore.placement import Placement, load_volumes
+from lobbercore.scrape import ScrapeCache
+from lobbercore.persist import WriteBehind
+from lobbercore.source import load_sources, DEFAULT_SOURCE
+from lobbercore.metrics import Registry, MetricsResource
+from lobbercore.evaluator import Snapshot, STATUS_KEYS, RULE_SETS, compile_rules, evaluate
 
 DEFAULT_PREFS = {
+    # The Lobber instances to mirror, each a dict with a name, tracker_host,
+    # feed_url, lobber_key and optionally feed_push_path, the prefix of its
+    # paths through the proxy ('/<name>' by default, '' for requests matching
+    # no other source), hosts routed to it, and its own add_concurrency,
+    # proxy_max_connections, proxy_connect_timeout, proxy_compress,
+    # proxy_coalesce, cache_enabled or announce_rate. If empty, the one instance of
+    # feed_url, tracker_host, lobber_key and feed_push_path.
+    'sources': [],
     'feed_url': 'https://dev.lobber.se/torrent/all.json',
     'lobber_key': '',
     'proxy_port': 7001,
     'tracker_host': 'https://dev.lobber.se',
     'minutes_delay': 15,
+    # The feed is polled every feed_poll_min_delay seconds up to every
+    # minutes_delay minutes, more often while it has new torrents.
+    'feed_poll_min_delay': 60,
+    # Path of the feed's event stream on the tracker, '' to only poll. While
+    # subscribed the feed is polled every minutes_delay minutes.
+    'feed_push_path': '',
+    # If feed_delta_param is set, polls between full refreshes of the feed
+    # only ask for entries with a feed_cursor_field above the highest seen.
+    'feed_delta_param': '',
+    'feed_cursor_field': 'id',
+    'feed_full_refresh_polls': 12,
+    # Log every feed_debug_sample:th feed entry at debug level, 0 for none.
+    'feed_debug_sample': 0,
+    # Torrent add queue options. Failed adds are retried after add_retry_delay
+    # seconds, doubled for every attempt up to add_retry_max_delay.
+    'add_concurrency': 4,
+    'add_max_retries': 5,
+    'add_retry_delay': 30,
+    'add_retry_max_delay': 3600,
+    # Fetch torrent files through the proxy's upstream connections and add
+    # them from memory, instead of having Deluge download them from the
+    # proxy. Torrents are added add_batch_size at a time, or after waiting
+    # add_batch_delay seconds, and the torrent state saved once per batch.
+    'add_direct': True,
+    'add_batch_size': 50,
+    'add_batch_delay': 1,
+    # New torrents are held while adding them would take the space used on
+    # the download volume, with what downloads in progress have left to
+    # download, over admission_high_water of its size. Held torrents are
+    # checked, and the active torrents of each volume counted again, every
+    # admission_check_interval seconds.
+    'admission_enabled': True,
+    'admission_high_water': 0.9,
+    'admission_check_interval': 30,
+    # Volumes torrents are downloaded to, as paths or {'path': ..., 'weight':
+    # ...}, download_dir alone if empty. Each new torrent is placed on one by
+    # placement_policy: most_free, fewest_active or weighted_round_robin.
+    # Volumes it fits on are preferred, and it stays on the one it was
+    # placed on across restarts.
+    'storage_roots': [],
+    'placement_policy': 'most_free',
+    # Config changes are saved config_save_delay seconds after the first
+    # unsaved one, or at once when config_save_threshold are unsaved.
+    'config_save_delay': 5,
+    'config_save_threshold': 50,
+    # Upstream connection pool options
+    'proxy_max_idle_connections': 4,
+    'proxy_max_connections': 8,
+    'proxy_idle_timeout': 60,
+    'proxy_connect_timeout': 30,
+    # Requests to the tracker are answered with a 504 if it has not started
+    # answering proxy_first_byte_timeout seconds after they were sent, or has
+    # not answered proxy_total_timeout seconds after they reached the proxy.
+    # Event streams have no such deadline. None for no deadline.
+    'proxy_first_byte_timeout': 30,
+    'proxy_total_timeout': 120,
+    # After proxy_breaker_failures failed requests in a row the tracker is
+    # not contacted for proxy_breaker_reset seconds, requests are answered
+    # with a 503. Then one request at a time is let through until one
+    # succeeds. 0 to never stop contacting it.
+    'proxy_breaker_failures': 5,
+    'proxy_breaker_reset': 30,
+    # Tracker host names are resolved when the proxy starts and kept for
+    # their TTL, between proxy_dns_min_ttl and proxy_dns_max_ttl seconds,
+    # refreshed before it runs out. While DNS fails, addresses are used up to
+    # proxy_dns_max_stale seconds past it. The IPv6 and IPv4 addresses are
+    # tried in turn, proxy_dns_attempt_delay seconds apart. False to let the
+    # reactor resolve the tracker on every connection.
+    'proxy_dns_cache': True,
+    'proxy_dns_min_ttl': 10,
+    'proxy_dns_max_ttl': 3600,
+    'proxy_dns_max_stale': 3600,
+    'proxy_dns_attempt_delay': 0.25,
+    # Ask the tracker for gzip/deflate responses, decoded by the proxy for
+    # local clients which do not accept them.
+    'proxy_compress': True,
+    # Identical GETs made while one is in flight are answered with its
+    # response. Requests are identical if their path, query and the
+    # proxy_coalesce_key_headers are.
+    'proxy_coalesce': True,
+    'proxy_coalesce_key_headers': ['authorization', 'cookie'],
+    # Announces are sent to the tracker at most announce_rate a second, with
+    # bursts of announce_burst, 0 for no limit. Others wait up to
+    # announce_max_wait seconds in a queue of announce_max_queue. Announces
+    # in the first announce_spread_window seconds are spread over it.
+    'announce_rate': 10,
+    'announce_burst': 20,
+    'announce_max_queue': 1000,
+    'announce_max_wait': 20,
+    'announce_spread_window': 0,
+    # Proxy cache options, sizes in bytes
+    'cache_enabled': True,
+    'cache_memory_size': 32 * 1024 * 1024,
+    'cache_disk_size': 512 * 1024 * 1024,
+    'cache_max_entry_size': 16 * 1024 * 1024,
+    # [path regexp, seconds fresh, seconds served stale while revalidating]
+    'cache_rules': [['^/torrent/[^/]+\\.torrent$', 30 * 24 * 3600, 0],
+                    ['^/torrent/.*\\.json$', 60, 300]],
     # If download_dir is left blank Deluge settings will be used.
     'download_dir': '', # Ending slash important
     'unique_path': False,
     # Torrent monitoring options
     'monitor_torrents': False,
     'remove_data': False,
+    # A rule set in lobbercore.evaluator.RULE_SETS, 'custom' for evaluator_rules.
     'torrent_evaluator': 'total_seeders',
+    # Rules of the custom rule set, the first matching rule decides, e.g.
+    # {'action': 'Remove', 'when': [['finished', '==', True], ['ratio', '>=', 2]]}
+    'evaluator_rules': [],
+    # Seconds the monitor may spend executing actions per slice, and between slices.
+    'monitor_slice_budget': 0.05,
+    'monitor_slice_delay': 0.1,
+    # Only read to migrate it to the torrent store.
     'removed_torrents': [],
+    # Days before a removed torrent may be added again, 0 for never.
+    'removed_torrents_expiry_days': 0,
+    # Paused torrents are scraped scrape_batch_size at a time and the results
+    # cached for scrape_ttl seconds.
+    'scrape_path': '/tracker/scrape',
+    'scrape_ttl': 600,
+    'scrape_batch_size': 50,
     # total_seeders evaluator options
     'min_seeders': 1,
     'max_seeders': 2,
@@ -36,168 +178,685 @@ DEFAULT_PREFS = {
 
 log = logging.getLogger(__name__)
 
+# Status keys Admission reads to see what torrents have left to download,
+# and where they are.
+ADMISSION_KEYS = ['total_wanted', 'total_done', 'is_finished', 'save_path']
+
+def time_budget(seconds):
+    """
+    Returns a Cooperator termination predicate factory which ends a slice
+    when seconds have passed.
+    """
+    def factory():
+        end = time.time() + seconds
+        return lambda: time.time() >= end
+    return factory
+
 class Core(CorePluginBase):
 
     def enable(self):
         component.get("AlertManager").register_handler("scrape_reply_alert", self.on_scrape_reply_alert)
         self.config = deluge.configmanager.ConfigManager("lobbercore.conf", DEFAULT_PREFS)
         self.config.save() # Create the first config file
-        self.EVALUATORS = {
-            'total_seeders': self.total_seeders_evaluator,
-            }
+        self.metrics = Registry()
+        self.config_writer = WriteBehind(
+            self.config.save,
+            delay=self.config['config_save_delay'],
+            threshold=self.config['config_save_threshold'])
+        self.store = TorrentStore(deluge.configmanager.get_config_dir('lobbercore.db'))
+        if self.config['removed_torrents']:
+            self.store.migrate(self.config['removed_torrents'])
+            log.info('Migrated %d removed torrents to the torrent store.' % len(self.config['removed_torrents']))
+            self.config['removed_torrents'] = []
+            self.config_writer.mark_dirty()
+        if self.config['removed_torrents_expiry_days']:
+            self.store.expire(REMOVED, self.config['removed_torrents_expiry_days'] * 24 * 3600)
+        self.metrics.collect('store', self.store.get_stats)
+        self.metrics.collect('persistence', self.get_persistence_stats)
         self.start_plugin()
 
     def disable(self):
         component.get("AlertManager").deregister_handler("scrape_reply_alert")
         self.stop_plugin()
+        self.config_writer.flush()
+        self.store.close()
 
     def start_plugin(self):
+        self.sources = load_sources(self.config)
+        self.add_batcher = AddBatcher(
+            self.add_torrent_file,
+            self.save_torrent_state,
+            batch_size=self.config['add_batch_size'],
+            delay=self.config['add_batch_delay'])
+        for source in self.sources:
+            source.add_queue = AddQueue(
+                partial(self.add_feed_torrent, source),
+                concurrency=source.option(self.config, 'add_concurrency'),
+                max_retries=self.config['add_max_retries'],
+                retry_delay=self.config['add_retry_delay'],
+                retry_max_delay=self.config['add_retry_max_delay'])
         try:
             self.proxy = self.start_proxy()
         except CannotListenError:
             pass
-        self.fetch_json_timer = LoopingCall(self.fetch_json)
-        self.fetch_json_timer.start(self.config['minutes_delay']*60)
+        for source in self.sources:
+            source.scrape_cache = ScrapeCache(
+                self.proxy_url(source, self.config['scrape_path']),
+                on_scrape=self.on_scrape,
+                ttl=self.config['scrape_ttl'],
+                batch_size=self.config['scrape_batch_size'],
+                headers=source.headers())
+        self.metrics.collect('add_queue', partial(self.sources.get_stats, 'add_queue'),
+                             label='source')
+        self.metrics.collect('scrape', partial(self.sources.get_stats, 'scrape_cache'),
+                             label='source')
+        self.metrics.collect('feed', self.get_feed_stats, label='source')
+        self.metrics.collect('add_batch', self.add_batcher.get_stats)
+        self.placement = Placement(load_volumes(self.config, self.download_location()),
+                                   self.store, self.config['placement_policy'])
+        self.metrics.collect('volume', self.placement.get_stats, label='volume')
+        d = defer.maybeDeferred(component.get("Core").get_torrents_status, {}, ADMISSION_KEYS)
+        d.addCallback(self.placement.track)
+        d.addErrback(self.admission_error)
+        # Also without admission, to keep the active torrents of fewest_active.
+        self.admission_timer = LoopingCall(self.check_admission)
+        self.admission_timer.start(self.config['admission_check_interval'], now=False)
+        for source in self.sources:
+            if source.feed_push_path:
+                source.subscription = FeedSubscription(
+                    self.proxy_url(source, source.feed_push_path),
+                    partial(self.feed_pushed, source),
+                    on_state=partial(self.feed_push_state, source),
+                    headers=source.headers())
+                source.subscription.start()
+            source.feed_delay = self.config['minutes_delay'] * 60
+            if source.feed_url:
+                # The feeds are polled independently of each other.
+                self.schedule_fetch(source, 0)
         if self.config['monitor_torrents']:
+            self.monitor_cooperator = task.Cooperator(
+                terminationPredicateFactory=time_budget(self.config['monitor_slice_budget']),
+                scheduler=lambda x: reactor.callLater(self.config['monitor_slice_delay'], x))
             self.monitor_torrents_timer = LoopingCall(self.monitor_torrents)
             self.monitor_torrents_timer.start(5*60)
             log.info('Monitoring torrents.')
-        log.info("Lobber plugin started")
+        log.info("Lobber plugin started with %d sources" % len(self.sources))
 
     def stop_plugin(self):
+        for source in self.sources:
+            source.stopped = True
+            if source.fetch_json_call is not None and source.fetch_json_call.active():
+                source.fetch_json_call.cancel()
+            if source.subscription is not None:
+                source.subscription.stop()
         try:
-            self.fetch_json_timer.stop()
-        except AssertionError:
-            # Fetch loop not running
+            self.admission_timer.stop()
+        except (AssertionError, AttributeError):
+            # Admission check not running
             pass
         try:
             self.monitor_torrents_timer.stop()
-        except AssertionError:
+        except (AssertionError, AttributeError):
             # Montior loop not running
             pass
+        try:
+            self.monitor_cooperator.stop()
+        except AttributeError:
+            # Monitor never started
+            pass
+        for source in self.sources:
+            source.add_queue.stop()
+            source.scrape_cache.stop()
+        # After the add queues, so the held adds given up are not retried.
+        self.placement.stop()
+        self.add_batcher.stop()
         self.proxy.stopListening()
+        for source in self.sources:
+            if source.announces is not None:
+                source.announces.stop()
+            source.pool.closeCachedConnections()
         log.info("Lobber plugin stopped")
 
     def update(self):
         pass
 
+    def proxy_url(self, source, path):
+        """
+        Returns the URL of path on the tracker of source through the proxy.
+        """
+        # Ensure that url does not contain unicode.
+        return str('http://127.0.0.1:%s%s%s' % (self.config['proxy_port'], source.prefix, path))
+
     def start_proxy(self):
-        parse_result = urlparse(self.config['tracker_host'])
-        tracker_port = parse_result.port
-        if parse_result.scheme == 'https':
-            tls = True
-            if not tracker_port:
-                tracker_port = 443
-        else:
-            tls = False
-            if not tracker_port:
-                tracker_port = 80
-        tracker_host = splitnport(parse_result.netloc, parse_result.port)[0]
-        proxy = server.Site(
-            ReverseProxyTLSResource(
-		        tracker_host,
-		        tracker_port,
-		        '',
+        """
+        Starts the proxy with a route to the tracker of each source. Every
+        source has its own connection pool, cache and announce scheduler.
+        """
+        root = ProxyResource()
+        self.resolver = None
+        if self.config['proxy_dns_cache']:
+            self.resolver = CachingResolver(
+                minTTL=self.config['proxy_dns_min_ttl'],
+                maxTTL=self.config['proxy_dns_max_ttl'],
+                maxStale=self.config['proxy_dns_max_stale'],
+                metrics=self.metrics)
+        for source in self.sources:
+            self.start_source_proxy(source)
+            if self.resolver is not None:
+                self.resolver.resolve(source.host).addErrback(self.resolve_error, source)
+            route = ProxyRoute(
+                source.host,
+                source.port,
+                tls=source.tls,
                 path_rewrite=[['/tracker/announce$', '/tracker/uannounce']],
-		        tls=tls,
-		        headers={'X_LOBBER_KEY': self.config['lobber_key'], 'User-Agent': 'Lobber Storage Node/2.0'}))
+                headers={'X_LOBBER_KEY': source.lobber_key, 'User-Agent': 'Lobber Storage Node/2.0'},
+                pool=source.pool,
+                cache=source.cache,
+                announces=source.announces,
+                connectTimeout=source.option(self.config, 'proxy_connect_timeout'),
+                compress=source.option(self.config, 'proxy_compress'),
+                singleFlight=source.single_flight,
+                firstByteTimeout=source.option(self.config, 'proxy_first_byte_timeout'),
+                totalTimeout=source.option(self.config, 'proxy_total_timeout'),
+                streaming=source.feed_push_path and ['^%s$' % re.escape(source.feed_push_path)] or (),
+                breaker=source.breaker)
+            root.addRoute(route, source.prefix, source.hosts)
+            source.route = route
+            if source is self.sources.default:
+                root.default = route
+        self.metrics.collect('pool', self.get_proxy_stats, label='upstream')
+        self.metrics.collect('dns', self.get_dns_stats, label='host')
+        self.metrics.collect('cache', partial(self.sources.get_stats, 'cache', 'getStats'),
+                             label='source')
+        self.metrics.collect('announce', partial(self.sources.get_stats, 'announces', 'getStats'),
+                             label='source')
+        self.metrics.collect('coalesce', partial(self.sources.get_stats, 'single_flight', 'getStats'),
+                             label='source')
+        # Prometheus metrics, answered locally instead of by the tracker.
+        root.putChild('metrics', MetricsResource(self.metrics))
+        proxy = server.Site(root)
         bindto_host = '127.0.0.1'
         bindto_port = int(self.config['proxy_port'])
         log.info("Lobber proxy started")
         return reactor.listenTCP(bindto_port, proxy, interface=bindto_host)
 
-    def get_torrent_options(self, unique_path=None):
+    def resolve_error(self, failure, source):
+        log.warning('Resolving the tracker of %s failed: %s'
+                    % (source.name, failure.getErrorMessage()))
+
+    def start_source_proxy(self, source):
+        source.pool = HTTPConnectionPool(
+            reactor,
+            maxIdle=self.config['proxy_max_idle_connections'],
+            maxTotal=source.option(self.config, 'proxy_max_connections'),
+            idleTimeout=self.config['proxy_idle_timeout'],
+            metrics=self.metrics,
+            resolver=self.resolver,
+            attemptDelay=self.config['proxy_dns_attempt_delay'])
+        source.cache = None
+        if source.option(self.config, 'cache_enabled'):
+            if source.name == DEFAULT_SOURCE:
+                directory = 'lobbercore_cache'
+            else:
+                directory = 'lobbercore_cache_%s' % source.name
+            source.cache = HTTPCache(
+                self.config['cache_rules'],
+                self.config['cache_memory_size'] // len(self.sources),
+                DiskCache(deluge.configmanager.get_config_dir(directory),
+                          self.config['cache_disk_size'] // len(self.sources)),
+                maxEntrySize=self.config['cache_max_entry_size'])
+        source.single_flight = None
+        if source.option(self.config, 'proxy_coalesce'):
+            source.single_flight = SingleFlight(
+                keyHeaders=self.config['proxy_coalesce_key_headers'],
+                metrics=self.metrics)
+        source.breaker = None
+        if self.config['proxy_breaker_failures']:
+            source.breaker = CircuitBreaker(
+                upstreamName((source.host, source.port)),
+                failureThreshold=self.config['proxy_breaker_failures'],
+                resetTimeout=self.config['proxy_breaker_reset'],
+                metrics=self.metrics)
+        source.announces = None
+        if source.option(self.config, 'announce_rate'):
+            source.announces = AnnounceScheduler(
+                rate=source.option(self.config, 'announce_rate'),
+                burst=self.config['announce_burst'],
+                maxQueue=self.config['announce_max_queue'],
+                maxWait=self.config['announce_max_wait'],
+                spreadWindow=self.config['announce_spread_window'],
+                metrics=self.metrics)
+
+    def get_torrent_options(self, unique_path=None, download_dir=None):
         """
         Returns a dictionary with torrent options. If a unique path is supplied the storage
-        directory will be appended with it.
+        directory, download_dir or else the configured one, will be appended with it.
         """
         opts = {}
-        if self.config['download_dir']:
-            opts['download_location'] = self.config['download_dir']
+        download_dir = download_dir or self.config['download_dir']
+        if download_dir:
+            opts['download_location'] = download_dir.rstrip('/') + '/'
             if unique_path:
                 opts['download_location'] = '%s%s/' % (opts['download_location'], unique_path)
             log.debug('download_location: %s' % opts['download_location'])
         return opts
 
-    def process_json(self, j):
+    def add_torrents(self, source):
+        """
+        Coroutine which is sent the feed entries of source one at a time and
+        adds the torrents not known yet. Logs a summary when closed.
+        """
+        torrent_list = set(component.get("TorrentManager").get_torrent_list())
+        cursor_field = self.config['feed_cursor_field']
+        sample = self.config['feed_debug_sample']
+        seen = added = 0
+        entries = self.metrics.counter('feed_entries_total', 'Feed entries read, by outcome.',
+                                       ('outcome',))
+        try:
+            while True:
+                torrent = (yield)
+                seen += 1
+                if sample and not seen % sample:
+                    log.debug('Feed entry %d: %s' % (seen, json.dumps(torrent)))
+                try:
+                    if cursor_field in torrent and torrent[cursor_field] > source.feed_cursor:
+                        source.feed_cursor = torrent[cursor_field]
+                    info_hash = torrent['info_hash']
+                    self.sources.seen(info_hash, source)
+                    if not info_hash in torrent_list and not self.store.is_removed(info_hash):
+                        if self.adding(info_hash) is None and source.add_queue.put(torrent):
+                            added += 1
+                    else:
+                        self.store.seen(info_hash)
+                except (KeyError, TypeError):
+                    log.error('Malformed feed entry: %r' % (torrent,))
+        except GeneratorExit:
+            source.feed_added += added
+            entries.inc(('new',), added)
+            entries.inc(('known',), seen - added)
+            log.debug('Processed %d feed entries of %s, %d new.' % (seen, source.name, added))
+
+    def adding(self, info_hash):
+        """
+        Returns the source whose add queue holds info_hash, if any, so a
+        torrent in several feeds is only added once.
+        """
+        for source in self.sources:
+            if info_hash in source.add_queue.pending:
+                return source
+        return None
+
+    def add_feed_torrent(self, source, torrent):
+        path = '/torrent/%s.torrent' % torrent['id']
+        if self.config['add_direct'] and source.route is not None:
+            d = self.fetch_metainfo(source, torrent)
+            d.addCallback(self.metainfo_fetched, source, torrent)
+        else:
+            # Held until it fits, keeping its add queue slot.
+            d = self.admit(torrent, torrent.get('size'))
+            d.addCallback(lambda torrent_options: component.get("Core").add_torrent_url(
+                self.proxy_url(source, path), torrent_options, headers=None))
+        d.addCallback(self.feed_torrent_added, torrent)
+        d.addErrback(self.feed_torrent_failed, torrent)
+        return d
+
+    def fetch_metainfo(self, source, torrent):
+        """
+        Fetches the torrent file of a feed entry through the proxy. Returns
+        a Deferred firing with the torrent file and the size of the torrent,
+        failing if it is not the entry's torrent so the add is retried.
+        """
+        d = source.route.get('/torrent/%s.torrent' % torrent['id'])
+        d.addCallback(self.check_metainfo, torrent)
+        return d
+
+    def check_metainfo(self, request, torrent):
+        if request.code != 200:
+            raise Error(request.code, 'Torrent file of %s not fetched' % torrent['info_hash'])
         try:
-            result = json.loads(j)
+            info = bdecode(request.body)['info']
+        except Exception:
+            raise ValueError('Torrent file of %s is not valid' % torrent['info_hash'])
+        if hashlib.sha1(bencode(info)).hexdigest() != torrent['info_hash'].lower():
+            raise ValueError('Torrent file of %s has another info hash' % torrent['info_hash'])
+        size = info.get('length') or sum([f['length'] for f in info.get('files', [])])
+        return request.body, size
+
+    def metainfo_fetched(self, metainfo, source, torrent):
+        """
+        Queues the checked torrent file of a feed entry to be added once
+        admitted. A torrent held until it fits keeps its add queue slot but
+        not its torrent file, which is fetched again when it is admitted.
+        """
+        d = self.admit(torrent, metainfo[1])
+        if d.called:
+            d.addCallback(self.batch_metainfo, metainfo[0], source, torrent)
+        else:
+            d.addCallback(self.metainfo_admitted, source, torrent)
+        return d
+
+    def metainfo_admitted(self, torrent_options, source, torrent):
+        d = self.fetch_metainfo(source, torrent)
+        d.addCallback(lambda metainfo: self.batch_metainfo(
+            torrent_options, metainfo[0], source, torrent))
+        return d
+
+    def batch_metainfo(self, torrent_options, metainfo, source, torrent):
+        """
+        Hands the torrent file of an admitted feed entry to the add batcher.
+        The add queue slot of the entry is handed back once the batcher has
+        it, so that the next torrent files are fetched while this one waits
+        for a batch.
+        """
+        d = self.add_batcher.put('%s.torrent' % torrent['id'], metainfo, torrent_options)
+        source.add_queue.release(torrent['info_hash'])
+        return d
+
+    def download_location(self):
+        return self.config['download_dir'] or \
+            component.get("Core").get_config_value('download_location')
+
+    def admit(self, torrent, size):
+        """
+        Places the torrent of a feed entry on a volume and returns a Deferred
+        firing with its torrent options when it may be added there, with
+        size bytes reserved for it.
+        """
+        info_hash = torrent['info_hash']
+        volume = self.placement.place(info_hash, size)
+        if self.config['admission_enabled']:
+            d = volume.admission.admit(info_hash, size)
+        else:
+            d = defer.succeed(None)
+        download_dir = None
+        if self.config['storage_roots']:
+            download_dir = volume.path
+        if self.config['unique_path']:
+            d.addCallback(lambda _: self.get_torrent_options(info_hash, download_dir))
+        else:
+            d.addCallback(lambda _: self.get_torrent_options(download_dir=download_dir))
+        return d
+
+    def check_admission(self):
+        """
+        Updates the space reserved by torrents being downloaded and the
+        active torrents of each volume from the status of the torrents in
+        Deluge, and admits the held torrents which now fit.
+        """
+        d = defer.maybeDeferred(component.get("Core").get_torrents_status, {}, ADMISSION_KEYS)
+        d.addCallback(self.placement.refresh)
+        d.addCallback(lambda _: self.placement.check())
+        d.addErrback(self.admission_error)
+        return d
+
+    def admission_error(self, failure):
+        log.error('Checking the download volume failed: %s' % failure.getErrorMessage())
+
+    def add_torrent_file(self, filename, filedump, options):
+        """
+        Adds a torrent from its torrent file, without saving the torrent state.
+        """
+        return component.get("TorrentManager").add(filedump=filedump, filename=filename,
+                                                   options=options, save_state=False)
+
+    def save_torrent_state(self):
+        component.get("TorrentManager").save_state()
+
+    def feed_torrent_added(self, torrent_id, torrent):
+        if torrent_id:
+            self.store.set_state(torrent['info_hash'], ADDED)
+            self.placement.added(torrent['info_hash'])
+            log.info("Added: %s" % torrent['label'])
+        else:
+            self.placement.release(torrent['info_hash'])
+        return torrent_id
+
+    def feed_torrent_failed(self, failure, torrent):
+        self.placement.release(torrent['info_hash'])
+        return failure
+
+    def feed_parser(self, source):
+        """
+        Returns a FeedParser sending the entries it reads to add_torrents,
+        and the add_torrents coroutine which should be closed at the end of
+        the feed.
+        """
+        adder = self.add_torrents(source)
+        adder.next()
+        return FeedParser(adder.send), adder
+
+    def process_json(self, j, source=None):
+        started = time.time()
+        parser, adder = self.feed_parser(source or self.sources.default)
+        try:
+            parser.dataReceived(j)
+            parser.close()
         except ValueError:
-            log.error('Expected JSON, got:\n%s' % j)
-            return
-        log.debug('Processing JSON data:\n%s' % json.dumps(result, indent=4))
-        torrent_list = component.get("TorrentManager").get_torrent_list()
-        for torrent in result:
-            if not torrent['info_hash'] in torrent_list and not torrent['info_hash'] in self.config['removed_torrents']:
-                url = 'http://127.0.0.1:%s/torrent/%s.torrent' % (self.config['proxy_port'], torrent['id'])
-                if self.config['unique_path']:
-                    torrent_options = self.get_torrent_options(unique_path=torrent['info_hash'])
-                else:
-                    torrent_options = self.get_torrent_options()
-                component.get("Core").add_torrent_url(url, torrent_options, headers=None)
-                log.info("Added: %s" % torrent['label'])
-            else:
-                log.debug('Torrent with hash %s already added.' % torrent['info_hash'])
-                pass
+            log.error('Expected JSON, got:\n%s' % j[:1024])
+        adder.close()
+        self.metrics.histogram('feed_process_seconds', 'Time to process a feed document.').time(started)
 
     def fetch_json_error(self, failure):
         failure.trap(Error, TypeError)
         log.error('LobberCore: Error in fetch_json.')
         log.error(failure.getErrorMessage())
+        return 'error'
 
     def proxy_error(self, failure):
         failure.trap(ConnectionRefusedError)
         # Proxy not started, try to start it
         self.proxy = self.start_proxy()
             
-    def fetch_json(self):
-        parse_result = urlparse(self.config['feed_url'])
-        # Ensure that url does not contain unicode.
-        url = str('http://127.0.0.1:%s%s' % (self.config['proxy_port'], parse_result.path))
+    def fetch_json_not_modified(self, failure):
+        failure.trap(Error)
+        if failure.value.status != '304':
+            return failure
+        log.debug('Feed not modified.')
+        return 'not_modified'
+
+    def fetch_json_done(self, _, factory, feed, source, delta):
+        """
+        Remembers the validators of a full feed.
+        """
+        if not delta:
+            headers = factory.response_headers
+            source.feed_etag = headers.get('etag', [None])[0]
+            source.feed_last_modified = headers.get('last-modified', [None])[0]
+        if feed.error is not None:
+            log.error('Expected JSON feed: %s' % feed.error)
+            return 'error'
+        return 'ok'
+
+    def close_feed(self, result, adder):
+        adder.close()
+        return result
+
+    def fetch_json_finished(self, result, started, source):
+        """
+        Records the time of a fetch by its result, 'ok', 'not_modified' or
+        'error'.
+        """
+        source.fetching = False
+        if isinstance(result, str):
+            label = result
+            result = None
+        else:
+            label = 'error'
+        self.metrics.histogram(
+            'feed_fetch_seconds', 'Time to fetch and process the feed, by result.',
+            ('result',)).time(started, (label,))
+        return result
+
+    def schedule_fetch(self, source, delay):
+        if source.stopped:
+            return
+        if source.fetch_json_call is not None and source.fetch_json_call.active():
+            source.fetch_json_call.cancel()
+        source.fetch_json_call = reactor.callLater(delay, self.poll_feed, source)
+
+    def poll_feed(self, source):
+        """
+        Fetches the feed of source and schedules the next poll: twice as
+        soon if the fetch found new torrents, twice as late if it did not,
+        and after minutes_delay minutes while subscribed to the event
+        stream. A poll due while the last one is still running is left to
+        it.
+        """
+        if source.fetching:
+            return
+        added = source.feed_added
+        d = self.fetch_json(source)
+        d.addBoth(self.feed_polled, source, added)
+        return d
+
+    def feed_polled(self, result, source, added):
+        if source.stopped:
+            return result
+        max_delay = self.config['minutes_delay'] * 60
+        if source.subscription is not None and source.subscription.connected:
+            source.feed_delay = max_delay
+        elif source.feed_added > added:
+            source.feed_delay = max(self.config['feed_poll_min_delay'], source.feed_delay / 2)
+        else:
+            source.feed_delay = min(max_delay, source.feed_delay * 2)
+        log.debug('Next poll of the %s feed in %d seconds.' % (source.name, source.feed_delay))
+        self.schedule_fetch(source, source.feed_delay)
+        return result
+
+    def feed_pushed(self, source, entries):
+        """
+        Adds the torrents of a feed event.
+        """
+        adder = self.add_torrents(source)
+        adder.next()
+        for entry in entries:
+            adder.send(entry)
+        adder.close()
+
+    def feed_push_state(self, source, connected):
+        if not connected and not source.stopped and source.feed_url:
+            # Poll until the stream is back, starting soon to catch up.
+            source.feed_delay = self.config['feed_poll_min_delay']
+            self.schedule_fetch(source, source.feed_delay)
+
+    def fetch_json(self, source):
+        """
+        Fetches the feed of source and adds its torrents while it is being
+        read. Full fetches are conditional on the validators of the last
+        one, and if the feed supports a delta parameter only every
+        feed_full_refresh_polls fetch is a full one.
+        """
+        started = time.time()
+        source.fetching = True
+        parse_result = urlparse(source.feed_url)
+        path = parse_result.path
+        headers = source.headers()
+        delta = bool(self.config['feed_delta_param'] and source.feed_cursor is not None and
+                     source.feed_polls % self.config['feed_full_refresh_polls'])
+        source.feed_polls += 1
+        if delta:
+            path = '%s?%s=%s' % (path, self.config['feed_delta_param'], quote(str(source.feed_cursor)))
+        else:
+            if source.feed_etag:
+                headers['If-None-Match'] = source.feed_etag
+            if source.feed_last_modified:
+                headers['If-Modified-Since'] = source.feed_last_modified
+        url = self.proxy_url(source, path)
         log.debug('Fetching JSON data from %s.' % url)
-        r = client.getPage(
+        parser, adder = self.feed_parser(source)
+        feed = FeedFile(parser)
+        factory = client.HTTPDownloader(
             url,
+            feed,
             method='GET',
             postdata=None,
             agent='Lobber Storage Node/2.0',
-            # Ensure that headers does not contain unicode.
-            headers={'X_LOBBER_KEY': str(self.config['lobber_key'])})
-        r.addCallback(self.process_json)
+            headers=headers)
+        reactor.connectTCP('127.0.0.1', int(self.config['proxy_port']), factory)
+        r = factory.deferred
+        r.addCallback(self.fetch_json_done, factory, feed, source, delta)
+        r.addBoth(self.close_feed, adder)
+        r.addErrback(self.fetch_json_not_modified)
         r.addErrback(self.fetch_json_error)
+        r.addBoth(self.fetch_json_finished, started, source)
         r.addErrback(self.proxy_error)
         return r
 
     def on_scrape_reply_alert(self, alert):
-        evaluate = self.EVALUATORS[self.config['torrent_evaluator']]
-        reply = {'total_seeds': alert.complete,
-                 'total_peers': alert.incomplete,
-                 'info_hash': str(alert.handle.info_hash()),
-        }
-        evaluate(reply, scrape_reply=True)
+        info_hash = str(alert.handle.info_hash())
+        result = self.sources.source_of(info_hash).scrape_cache.update(info_hash, alert.complete, alert.incomplete)
+        self.on_scrape(info_hash, result)
+
+    def on_scrape(self, info_hash, result):
+        """
+        Evaluates a torrent with the scrape result just in.
+        """
+        if not self.config['monitor_torrents']:
+            return
+        torrent = component.get("TorrentManager").torrents.get(info_hash)
+        if torrent is None:
+            return
+        snapshot = Snapshot({info_hash: torrent.get_status(STATUS_KEYS)}, self.sources)
+        for torrent_id, action in evaluate(snapshot, self.get_rules()):
+            self.monitor_torrent_execute_action(torrent, action)
+
+    def get_rules(self):
+        """
+        Returns the compiled rules of the configured rule set.
+        """
+        rule_set = RULE_SETS[self.config['torrent_evaluator']]
+        return compile_rules(rule_set(self.config))
 
     def monitor_torrents(self):
         """
-        Loops over the list of torrents and resumes/pause/removes the torrent
-        depending on the evaluator used.
+        Resumes/pauses/removes torrents depending on the rule set used.
 
-        The evaluator should call monitor_torrent_execute_action with the torrent
-        and 'Resume', 'Pause', 'Remove' or None.
+        The status of all torrents is fetched in one call into a columnar
+        snapshot, the rules are applied to the whole snapshot at once, and the
+        resulting actions are executed in slices of at most
+        monitor_slice_budget seconds so the reactor is not blocked on large
+        libraries.
         """
         log.debug('Running monitor_torrents.')
-        evaluate = self.EVALUATORS[self.config['torrent_evaluator']]
-        torrent_list = component.get("TorrentManager").get_torrent_list()
-        for id in torrent_list:
-            evaluate(component.get("TorrentManager")[id])
+        started = time.time()
+        for source in self.sources:
+            source.scrape_cache.expire()
+        d = defer.maybeDeferred(component.get("Core").get_torrents_status, {}, STATUS_KEYS)
+        d.addCallback(self.evaluate_torrents)
+        d.addCallback(lambda _: self.metrics.histogram(
+            'monitor_pass_seconds', 'Time of a monitor pass, actions included.').time(started))
+        return d
+
+    def evaluate_torrents(self, statuses):
+        # Paused torrents not scraped yet are evaluated when the scrape is in.
+        started = time.time()
+        snapshot = Snapshot(statuses, self.sources)
+        actions = evaluate(snapshot, self.get_rules())
+        self.metrics.histogram(
+            'monitor_evaluate_seconds', 'Time to snapshot and evaluate all torrents.').time(started)
+        log.debug('Evaluated %d torrents, %d actions.' % (len(snapshot), len(actions)))
+        torrents = component.get("TorrentManager").torrents
+        def execute_all():
+            for torrent_id, action in actions:
+                # The torrent may have been removed since the status was fetched.
+                torrent = torrents.get(torrent_id)
+                if torrent is not None:
+                    self.monitor_torrent_execute_action(torrent, action)
+                yield None
+        d = self.monitor_cooperator.cooperate(execute_all()).whenDone()
+        d.addErrback(lambda f: f.trap(task.TaskStopped, task.SchedulerStopped))
+        return d
 
     def monitor_torrent_execute_action(self, torrent, action):
         log.debug('Monitor torrent, ID: %s, Action: %s' % (torrent.torrent_id, action))
         if action:
+            self.metrics.counter('monitor_actions_total', 'Monitor actions, by action.',
+                                 ('action',)).inc((action,))
             if action == 'Remove':
                 t_id = torrent.torrent_id
                 component.get("TorrentManager").remove(t_id, remove_data=self.config['remove_data'])
-                # Should removed torrents really be persistent between restarts?
-                self.config['removed_torrents'].append(t_id)
-                self.config.save()
+                self.store.set_state(t_id, REMOVED)
+                self.placement.removed(t_id)
             elif action == 'Pause':
                 if not torrent.handle.is_paused():
                     torrent.pause()
@@ -205,52 +864,102 @@ class Core(CorePluginBase):
                 if torrent.handle.is_paused():
                     torrent.resume()
 
-    def total_seeders_evaluator(self, torrent, scrape_reply=False):
-        """
-        Pause if seeders => min_seeders,
-        Resume if seeders < min_seeders,
-        Remove if seeders >= max_seeders.
-        """
-        if scrape_reply:
-            status = torrent
-            torrent = component.get("TorrentManager")[torrent['info_hash']]
-        else:
-            status = torrent.get_status(['total_seeds', 'state', 'is_finished'])
-            if not status['is_finished']:
-                return None
-            if status['state'] == 'Paused':
-                # Check the tracker for up to date information before evaluating.
-                torrent.scrape_tracker()
-                return None
-        # All information gathered, evaluate torrent.
-        seeders = status['total_seeds']
-        if seeders >= self.config['max_seeders']:
-            log.debug('Evaluator seeders >= max_seeders')
-            action = 'Remove'
-        elif seeders > self.config['min_seeders']:
-            log.debug('Evaluator seeders > min_seeders')
-            action = 'Pause'
-        elif seeders <= self.config['min_seeders']:
-            log.debug('Evaluator seeders <= min_seeders')
-            action = 'Resume'
-        else:
-            action = None
-            log.error('Something strange is up with seeder count.')
-        self.monitor_torrent_execute_action(torrent, action)
-
 
     @export
     def set_config(self, config):
         """Sets the config dictionary"""
         for key in config.keys():
             self.config[key] = config[key]
-        self.config.save()
+        self.config_writer.mark_dirty(len(config))
 
     @export
     def get_config(self):
         """Returns the config dictionary"""
         return self.config.config
 
+    @export
+    def get_stats(self):
+        """Returns all counters, latency histograms and component stats"""
+        return self.metrics.get_stats()
+
+    @export
+    def get_proxy_stats(self):
+        """Returns connection pool, TLS handshake and circuit breaker counters per upstream"""
+        stats = {}
+        for source in self.sources:
+            stats.update(source.pool.getStats())
+            if source.breaker is not None:
+                upstream = stats.setdefault(source.breaker.name, {})
+                upstream['circuit'] = source.breaker.getStats()
+        return stats
+
+    @export
+    def get_dns_stats(self):
+        """Returns the cached addresses and TTL left of each tracker host"""
+        if self.resolver is None:
+            return {}
+        return self.resolver.getStats()
+
+    @export
+    def get_cache_stats(self):
+        """Returns proxy cache hit/miss and size counters per source"""
+        return self.sources.get_stats('cache', 'getStats')
+
+    @export
+    def get_torrent_store_stats(self):
+        """Returns the number of torrents per state in the torrent store"""
+        return self.store.get_stats()
+
+    @export
+    def get_feed_stats(self):
+        """Returns poll and event stream counters per source"""
+        return dict((source.name, source.get_feed_stats()) for source in self.sources)
+
+    @export
+    def get_add_queue_stats(self):
+        """Returns queue depth, retry and latency counters of the add queue per source"""
+        return self.sources.get_stats('add_queue')
+
+    @export
+    def get_add_batch_stats(self):
+        """Returns batch counts and times of the torrents added from memory"""
+        return self.add_batcher.get_stats()
+
+    @export
+    def get_admission_stats(self):
+        """Returns the free space, reservations and held torrents of each volume"""
+        return self.placement.get_stats()
+
+    @export
+    def get_storage_stats(self):
+        """Returns the utilisation and active torrents of each volume, and the policy placing torrents"""
+        return {'policy': self.placement.policy,
+                'volumes': self.placement.get_stats()}
+
+    @export
+    def get_dead_letters(self):
+        """Returns the feed entries the add queues have given up on"""
+        dead_letters = {}
+        for source in self.sources:
+            dead_letters.update(source.add_queue.dead_letters)
+        return dead_letters
+
+    @export
+    def retry_dead_letters(self):
+        """Queues the feed entries the add queues have given up on again"""
+        return sum([source.add_queue.retry_dead_letters() for source in self.sources])
+
+    @export
+    def get_scrape_stats(self):
+        """Returns scrape request and scrape cache counters per source"""
+        return self.sources.get_stats('scrape_cache')
+
+    @export
+    def get_persistence_stats(self):
+        """Returns save counts and latencies of the config and torrent store"""
+        return {'config': self.config_writer.get_stats(),
+                'store': self.store.get_stats()['writes']}
+
     @export
     def reload(self):
         self.stop_plugin()
@@ -0,0 +1,93 @@
+'''
+Content encodings of the responses relayed by the Lobber proxy.
+'''
+
+import zlib
+
+# The encodings asked of upstream servers, in the Accept-Encoding header.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Content-Encoding values the proxy decodes, and their canonical names.
+ENCODINGS = {'gzip': 'gzip', 'x-gzip': 'gzip', 'deflate': 'deflate'}
+
+# Upper bounds of the compressed to decoded size ratio buckets.
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1, 2)
+
+
+def acceptsEncoding(header, encoding):
+    """
+    Return whether the Accept-Encoding header value C{header} accepts the
+    content encoding C{encoding}. A missing header accepts none.
+    """
+    if not header:
+        return False
+    qualities = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[ENCODINGS.get(name.strip().lower(), name.strip().lower())] = quality
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+
+class StreamDecoder(object):
+    """
+    Decodes a gzip or deflate response body as it arrives. Deflate bodies
+    are accepted both zlib wrapped, as RFC 2616 has it, and raw, as some
+    servers send them.
+
+    @ivar encoding: C{'gzip'} or C{'deflate'}.
+    @ivar decoded: the number of decoded bytes so far.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.decoded = 0
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._pending = None
+        else:
+            self._decompressor = zlib.decompressobj()
+            # Held until the two bytes of a zlib header are in.
+            self._pending = ''
+
+    def decode(self, data):
+        """
+        Return the decoded bytes of the next part C{data} of the body.
+
+        @raise zlib.error: if the body is not validly encoded.
+        """
+        if self._pending is not None:
+            data = self._pending + data
+            if len(data) < 2:
+                self._pending = data
+                return ''
+            self._pending = None
+            try:
+                return self._count(self._decompressor.decompress(data))
+            except zlib.error:
+                # No zlib header, a raw deflate stream.
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._count(self._decompressor.decompress(data))
+
+    def flush(self):
+        """
+        Return the decoded bytes still held at the end of the body.
+
+        @raise zlib.error: if the body is not validly encoded.
+        """
+        data = ''
+        if self._pending:
+            data, self._pending = self._pending, None
+            data = self._decompressor.decompress(data)
+        return self._count(data + self._decompressor.flush())
+
+    def _count(self, data):
+        self.decoded += len(data)
+        return data
@@ -0,0 +1,191 @@
+'''
+Batch evaluation of declarative monitoring rules over all torrents.
+'''
+
+import time
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Torrent status fields a snapshot is built from.
+STATUS_KEYS = ['total_seeds', 'total_peers', 'ratio', 'time_added', 'total_size',
+               'state', 'is_finished']
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+NAN = float('nan')
+
+
+class Snapshot(object):
+    """
+    The status of a set of torrents as columns, one array per field, with
+    numpy arrays when numpy is available and lists otherwise.
+
+    Columns:
+        seeds     seeders, from the scrape cache for paused torrents and NaN
+                  if a paused torrent has not been scraped yet
+        peers     leechers
+        ratio     share ratio
+        age       seconds since the torrent was added
+        size      total size in bytes
+        state     Deluge state name
+        paused    True if the state is Paused
+        finished  True if the download is complete
+    """
+
+    def __init__(self, statuses, scrapes=None, now=None):
+        """
+        statuses is a dict of torrent id to status dict with the
+        STATUS_KEYS fields, scrapes a ScrapeCache consulted for paused
+        torrents.
+        """
+        if now is None:
+            now = time.time()
+        self.ids = list(statuses)
+        seeds, peers, ratio, age, size, state, paused, finished = [], [], [], [], [], [], [], []
+        for torrent_id in self.ids:
+            status = statuses[torrent_id]
+            is_paused = status['state'] == 'Paused'
+            if is_paused and status['is_finished'] and scrapes is not None:
+                scrape = scrapes.get(torrent_id)
+                if scrape is None:
+                    seeds.append(NAN)
+                    peers.append(NAN)
+                else:
+                    seeds.append(scrape['complete'])
+                    peers.append(scrape['incomplete'])
+            else:
+                seeds.append(status['total_seeds'])
+                peers.append(status['total_peers'])
+            ratio.append(status['ratio'])
+            age.append(now - status['time_added'])
+            size.append(status['total_size'])
+            state.append(status['state'])
+            paused.append(is_paused)
+            finished.append(bool(status['is_finished']))
+        self.columns = {
+            'seeds': seeds,
+            'peers': peers,
+            'ratio': ratio,
+            'age': age,
+            'size': size,
+            'state': state,
+            'paused': paused,
+            'finished': finished,
+        }
+        if numpy is not None:
+            for name, column in self.columns.items():
+                if name in ('seeds', 'peers', 'ratio', 'age', 'size'):
+                    self.columns[name] = numpy.array(column, dtype=float)
+                elif name == 'state':
+                    self.columns[name] = numpy.array(column, dtype=object)
+                else:
+                    self.columns[name] = numpy.array(column, dtype=bool)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def compile_rules(rules):
+    """
+    Validates a list of rules and returns them as (action, conditions)
+    tuples. A rule is a dict with an action ('Resume', 'Pause' or 'Remove')
+    and a list of [column, operator, value] conditions which must all hold.
+    """
+    compiled = []
+    for rule in rules:
+        action = rule['action']
+        if action not in ('Resume', 'Pause', 'Remove'):
+            raise ValueError('Unknown action %r' % action)
+        conditions = []
+        for column, op, value in rule['when']:
+            if op == 'in':
+                conditions.append((column, None, list(value)))
+            elif op in OPERATORS:
+                conditions.append((column, OPERATORS[op], value))
+            else:
+                raise ValueError('Unknown operator %r' % op)
+        compiled.append((action, conditions))
+    return compiled
+
+
+def mask(column, op, value):
+    """
+    Returns a boolean column telling where op(column, value) holds, op None
+    meaning membership in value.
+    """
+    if numpy is not None:
+        if op is None:
+            return numpy.in1d(column, value)
+        # NaN, an unknown value, compares false without a warning.
+        with numpy.errstate(invalid='ignore'):
+            return op(column, value)
+    if op is None:
+        return [x in value for x in column]
+    return [op(x, value) for x in column]
+
+
+def evaluate(snapshot, rules):
+    """
+    Applies compiled rules to a snapshot and returns a list of (torrent id,
+    action) for the torrents a rule matched. The first rule matching a
+    torrent decides its action.
+    """
+    n = len(snapshot)
+    if numpy is not None:
+        actions = numpy.empty(n, dtype=object)
+        undecided = numpy.ones(n, dtype=bool)
+        for action, conditions in rules:
+            match = undecided.copy()
+            for column, op, value in conditions:
+                match &= mask(snapshot.columns[column], op, value)
+            actions[match] = action
+            undecided &= ~match
+        decided = numpy.flatnonzero(~undecided)
+        return [(snapshot.ids[i], actions[i]) for i in decided]
+    actions = [None] * n
+    for action, conditions in rules:
+        match = [a is None for a in actions]
+        for column, op, value in conditions:
+            match = [m and c for m, c in zip(match, mask(snapshot.columns[column], op, value))]
+        actions = [action if m else a for m, a in zip(match, actions)]
+    return [(snapshot.ids[i], a) for i, a in enumerate(actions) if a is not None]
+
+
+def total_seeders_rules(config):
+    """
+    Finished torrents are removed if seeders >= max_seeders, paused if
+    seeders > min_seeders and resumed otherwise. Paused torrents are left
+    alone until they have been scraped.
+    """
+    return [
+        {'action': 'Remove', 'when': [['finished', '==', True],
+                                      ['seeds', '>=', config['max_seeders']]]},
+        {'action': 'Pause', 'when': [['finished', '==', True],
+                                     ['seeds', '>', config['min_seeders']]]},
+        {'action': 'Resume', 'when': [['finished', '==', True],
+                                      ['seeds', '<=', config['min_seeders']]]},
+    ]
+
+
+def custom_rules(config):
+    """
+    The rules in the evaluator_rules setting.
+    """
+    return config['evaluator_rules']
+
+
+RULE_SETS = {
+    'total_seeders': total_seeders_rules,
+    'custom': custom_rules,
+}
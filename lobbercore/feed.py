@@ -0,0 +1,113 @@
+'''
+Incremental parsing of the Lobber JSON torrent feed.
+'''
+
+import re
+import json
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class FeedParser(object):
+    """
+    Incremental parser for a JSON array. Each element is decoded and passed
+    to C{entryReceived} as soon as it has been read, so only the element
+    being read is ever held in memory, not the whole feed.
+
+    @ivar count: the number of elements read so far.
+    @ivar maxEntrySize: the size an unfinished element may grow to before
+        the feed is considered broken.
+    """
+
+    maxEntrySize = 1024 * 1024
+
+    def __init__(self, entryReceived):
+        self.entryReceived = entryReceived
+        self.count = 0
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._started = False
+        self._separator = False
+        self._done = False
+
+    def dataReceived(self, data):
+        """
+        Parse the next part of the feed.
+
+        @raise ValueError: if the feed is not a JSON array.
+        """
+        buf = self._buffer + data
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            c = buf[pos]
+            if self._done:
+                raise ValueError('Extra data after JSON array')
+            elif not self._started:
+                if c != '[':
+                    raise ValueError('Expected a JSON array')
+                self._started = True
+                pos += 1
+            elif self._separator or (c == ']' and not self.count):
+                if c == ']':
+                    self._done = True
+                elif c != ',':
+                    raise ValueError('Expected , or ] in JSON array')
+                self._separator = False
+                pos += 1
+            else:
+                try:
+                    entry, end = self._decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if len(buf) - pos > self.maxEntrySize:
+                        raise
+                    # Wait for the rest of the element.
+                    break
+                if end == len(buf) and c in '-0123456789':
+                    # A number may go on in the next part.
+                    break
+                self.count += 1
+                self._separator = True
+                pos = end
+                self.entryReceived(entry)
+        self._buffer = buf[pos:]
+
+    def close(self):
+        """
+        Signal the end of the feed.
+
+        @raise ValueError: if the feed ended before the array did.
+        """
+        if not self._done:
+            raise ValueError('Incomplete JSON array')
+
+
+
+class FeedFile(object):
+    """
+    File-like object passing what is written to it to a L{FeedParser}, for
+    use with L{twisted.web.client.HTTPDownloader}.
+
+    @ivar error: the L{ValueError} raised by the parser, if any.
+    """
+
+    error = None
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.parser.dataReceived(data)
+            except ValueError as e:
+                self.error = e
+
+    def close(self):
+        if self.error is None:
+            try:
+                self.parser.close()
+            except ValueError as e:
+                self.error = e
@@ -0,0 +1,225 @@
+'''
+Counters and latency histograms, exposed as a dict and as Prometheus text.
+'''
+
+import time
+from bisect import bisect_left
+from twisted.web.resource import Resource
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'lobber_'
+
+
+def format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    A count per combination of label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get_stats(self):
+        if not self.labels:
+            return self.values.get((), 0)
+        return dict((','.join(map(str, k)), v) for k, v in self.values.iteritems())
+
+    def render_text(self, lines):
+        for labels, value in sorted(self.values.iteritems()):
+            lines.append('%s%s%s %s' % (PREFIX, self.name, format_labels(self.labels, labels),
+                                        format_value(value)))
+
+
+class Histogram(object):
+    """
+    Observed values per combination of label values, counted in buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            # [bucket counts, sum, count, max]
+            series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0, 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+        if value > series[3]:
+            series[3] = value
+
+    def time(self, start, labels=()):
+        """
+        Observes the seconds passed since start.
+        """
+        self.observe(time.time() - start, labels)
+
+    def quantile(self, counts, count, q):
+        """
+        Returns the upper bound of the bucket holding the q quantile.
+        """
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def summarize(self, series):
+        counts, total, count, maximum = series
+        return {
+            'count': count,
+            'sum': total,
+            'avg': total / count,
+            'max': maximum,
+            'p50': self.quantile(counts, count, 0.5),
+            'p95': self.quantile(counts, count, 0.95),
+            'p99': self.quantile(counts, count, 0.99),
+        }
+
+    def get_stats(self):
+        if not self.labels:
+            series = self.values.get(())
+            return series and self.summarize(series) or {'count': 0}
+        return dict((','.join(map(str, k)), self.summarize(v)) for k, v in self.values.iteritems())
+
+    def render_text(self, lines):
+        name = PREFIX + self.name
+        for labels, (counts, total, count, maximum) in sorted(self.values.iteritems()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (name, format_labels(self.labels, labels,
+                                                                     ('le', format_value(bound))),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(self.labels, labels), format_value(total)))
+            lines.append('%s_count%s %d' % (name, format_labels(self.labels, labels), count))
+
+
+class Registry(object):
+    """
+    Holds the metrics of the plugin, and collectors: functions returning a
+    dict of the numbers a component keeps itself, such as queue depths,
+    which are exported as gauges.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+
+    def counter(self, name, help, labels=()):
+        """
+        Returns the counter called name, creating it the first time.
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Counter(name, help, labels)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        """
+        Returns the histogram called name, creating it the first time.
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Histogram(name, help, labels, buckets)
+        return metric
+
+    def collect(self, name, function, label=None):
+        """
+        Registers function as the collector called name, replacing any
+        earlier one. If label is given, function returns a dict of dicts and
+        the outer keys are exported as that label.
+        """
+        self.collectors[name] = (function, label)
+
+    def get_stats(self):
+        stats = {}
+        for name, metric in self.metrics.iteritems():
+            stats[name] = metric.get_stats()
+        for name, (function, label) in self.collectors.iteritems():
+            stats[name] = function()
+        return stats
+
+    def render_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, metric.help))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, metric.kind))
+            metric.render_text(lines)
+        for name, (function, label) in sorted(self.collectors.iteritems()):
+            gauges = {}
+            if label is None:
+                self.flatten(gauges, name, function(), ())
+            else:
+                for key, values in function().iteritems():
+                    self.flatten(gauges, name, values, ((label, key),))
+            for gauge, samples in sorted(gauges.iteritems()):
+                lines.append('# TYPE %s%s gauge' % (PREFIX, gauge))
+                for labels, value in samples:
+                    lines.append('%s%s%s %s' % (PREFIX, gauge,
+                                                format_labels([l[0] for l in labels],
+                                                              [l[1] for l in labels]),
+                                                format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def flatten(self, gauges, prefix, values, labels):
+        for key, value in values.iteritems():
+            name = '%s_%s' % (prefix, key)
+            if isinstance(value, dict):
+                self.flatten(gauges, name, value, labels)
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                gauges.setdefault(name, []).append((labels, value))
+
+
+class MetricsResource(Resource):
+    """
+    Serves the metrics of a L{Registry} in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render_text()
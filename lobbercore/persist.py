@@ -0,0 +1,80 @@
+'''
+Write-behind saving of plugin config and state.
+'''
+
+import time
+import logging
+from twisted.internet import reactor
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehind(object):
+    """
+    Coalesces changes into few saves. Changes are only counted when marked,
+    and save is called delay seconds after the first unsaved change, at once
+    when threshold changes are unsaved, or when flush is called.
+
+    save is expected to write atomically, e.g. to a temporary file which is
+    then renamed over the old one as Deluge's Config.save does, or in one
+    database transaction.
+    """
+
+    def __init__(self, save, delay=5, threshold=100, reactor=reactor):
+        self.save = save
+        self.delay = delay
+        self.threshold = threshold
+        self.reactor = reactor
+        self.dirty = 0
+        self.flush_call = None
+        self.stats = {
+            'changes': 0,
+            'flushes': 0,
+            'errors': 0,
+            'flush_time_total': 0.0,
+            'flush_time_max': 0.0,
+        }
+
+    def mark_dirty(self, count=1):
+        """
+        Records count unsaved changes.
+        """
+        self.dirty += count
+        self.stats['changes'] += count
+        if self.dirty >= self.threshold:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = self.reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        """
+        Saves now if there are unsaved changes.
+        """
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        if not self.dirty:
+            return
+        start = time.time()
+        try:
+            self.save()
+        except Exception as e:
+            # Keep the changes dirty so the next flush tries again.
+            self.stats['errors'] += 1
+            log.error('Saving failed: %s' % e)
+            return
+        elapsed = time.time() - start
+        self.dirty = 0
+        self.stats['flushes'] += 1
+        self.stats['flush_time_total'] += elapsed
+        self.stats['flush_time_max'] = max(self.stats['flush_time_max'], elapsed)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = self.dirty
+        if stats['flushes']:
+            stats['flush_time_avg'] = stats['flush_time_total'] / stats['flushes']
+        else:
+            stats['flush_time_avg'] = 0.0
+        return stats
@@ -0,0 +1,218 @@
+'''
+Placement of new torrents on the storage volumes of the node.
+'''
+
+import os
+import logging
+from lobbercore.admission import Admission
+
+log = logging.getLogger(__name__)
+
+MOST_FREE = 'most_free'
+FEWEST_ACTIVE = 'fewest_active'
+WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+POLICIES = (MOST_FREE, FEWEST_ACTIVE, WEIGHTED_ROUND_ROBIN)
+
+
+class Volume(object):
+    """
+    A storage root torrents are downloaded to, with the admission of
+    torrents to its filesystem, its weight in weighted round robin and its
+    active torrents, those on it which are not finished.
+    """
+
+    def __init__(self, path, weight=1, high_water=0.9, statvfs=os.statvfs):
+        self.path = path
+        self.weight = weight
+        self.admission = Admission(path, high_water=high_water, statvfs=statvfs)
+        self.torrents = set()
+        # Smooth weighted round robin state
+        self.current = 0
+
+    @property
+    def active(self):
+        return len(self.torrents)
+
+    def available(self):
+        """
+        Returns the bytes which may still be admitted to the volume.
+        """
+        total, free = self.admission.usage()
+        return self.admission.high_water * total - (total - free) - self.admission.reserved
+
+    def fits(self, size):
+        try:
+            return self.available() >= size
+        except OSError:
+            return False
+
+    def get_stats(self):
+        try:
+            self.admission.usage()
+        except OSError:
+            log.exception('Checking the free space of %s failed.' % self.path)
+        stats = self.admission.get_stats()
+        stats['active'] = self.active
+        stats['weight'] = self.weight
+        if stats['total_bytes']:
+            stats['utilisation'] = 1.0 - float(stats['free_bytes']) / stats['total_bytes']
+        else:
+            stats['utilisation'] = 0.0
+        return stats
+
+
+class Placement(object):
+    """
+    Picks the volume of each new torrent by policy, and keeps the torrent
+    there: placements are recorded in the torrent store so a torrent added
+    again, or retried after a restart, goes to the same volume while it is
+    configured.
+
+    Volumes the torrent fits on are preferred. Of those, most_free picks the
+    one with the most space left to admit, fewest_active the one with the
+    fewest torrents and weighted_round_robin takes turns in proportion to
+    the weights.
+    """
+
+    def __init__(self, volumes, store, policy=MOST_FREE):
+        if policy not in POLICIES:
+            raise ValueError('Unknown placement policy %r' % (policy,))
+        self.volumes = volumes
+        self.by_path = dict((volume.path, volume) for volume in volumes)
+        self.store = store
+        self.policy = policy
+
+    def __iter__(self):
+        return iter(self.volumes)
+
+    def place(self, info_hash, size):
+        """
+        Returns the volume of info_hash, placing it if it has none.
+        """
+        volume = self.volume_of(info_hash)
+        if volume is None:
+            volume = self.choose(size)
+            self.store.set_placement(info_hash, volume.path)
+            log.debug('Placed %s on %s.' % (info_hash, volume.path))
+        return volume
+
+    def volume_of(self, info_hash):
+        return self.by_path.get(self.store.get_placement(info_hash))
+
+    def choose(self, size):
+        if len(self.volumes) == 1:
+            return self.volumes[0]
+        candidates = [volume for volume in self.volumes if volume.fits(size)] or self.volumes
+        if self.policy == FEWEST_ACTIVE:
+            return min(candidates, key=lambda volume: volume.active)
+        if self.policy == WEIGHTED_ROUND_ROBIN:
+            for volume in candidates:
+                volume.current += volume.weight
+            chosen = max(candidates, key=lambda volume: volume.current)
+            chosen.current -= sum([volume.weight for volume in candidates])
+            return chosen
+        return max(candidates, key=self.available)
+
+    def available(self, volume):
+        try:
+            return volume.available()
+        except OSError:
+            return 0
+
+    def volume_at(self, save_path):
+        """
+        Returns the volume save_path is under, if any.
+        """
+        found = None
+        for volume in self.volumes:
+            root = volume.path.rstrip('/') + '/'
+            if (save_path.rstrip('/') + '/').startswith(root):
+                if found is None or len(volume.path) > len(found.path):
+                    found = volume
+        return found
+
+    def added(self, info_hash):
+        volume = self.volume_of(info_hash)
+        if volume is not None:
+            volume.admission.added(info_hash)
+            volume.torrents.add(info_hash)
+
+    def removed(self, info_hash):
+        for volume in self.volumes:
+            volume.torrents.discard(info_hash)
+        self.release(info_hash)
+
+    def release(self, info_hash):
+        """
+        Releases the space reserved for info_hash, and admits what fits then.
+        """
+        volume = self.volume_of(info_hash)
+        if volume is not None and info_hash in volume.admission.reservations:
+            volume.admission.release(info_hash)
+            volume.admission.check()
+
+    def by_volume(self, statuses):
+        """
+        Returns the statuses, which need save_path, of the torrents on each
+        volume.
+        """
+        by_volume = dict((volume, {}) for volume in self.volumes)
+        for torrent_id, status in statuses.items():
+            volume = self.volume_at(status['save_path'])
+            if volume is not None:
+                by_volume[volume][torrent_id] = status
+        return by_volume
+
+    def track(self, statuses):
+        """
+        Reserves space for the unfinished torrents in statuses on the volumes
+        they are saved to, and counts the active torrents of each volume.
+        """
+        for volume, volume_statuses in self.by_volume(statuses).items():
+            volume.admission.track(volume_statuses)
+        self.count(statuses)
+
+    def refresh(self, statuses):
+        """
+        Updates the reservations from the statuses of all torrents in Deluge,
+        and counts the active torrents of each volume again, so torrents
+        which finished or were removed outside the plugin are no longer
+        counted.
+        """
+        for volume in self.volumes:
+            volume.admission.refresh(statuses)
+        self.count(statuses)
+
+    def count(self, statuses):
+        for volume, volume_statuses in self.by_volume(statuses).items():
+            volume.torrents = set(torrent_id for torrent_id, status in volume_statuses.items()
+                                  if not status['is_finished'])
+
+    def check(self):
+        for volume in self.volumes:
+            volume.admission.check()
+
+    def get_stats(self):
+        return dict((volume.path, volume.get_stats()) for volume in self.volumes)
+
+    def stop(self):
+        for volume in self.volumes:
+            volume.admission.stop()
+
+
+def load_volumes(config, default_path, statvfs=os.statvfs):
+    """
+    Returns the volumes of the storage_roots of config, given as paths or
+    dictionaries with a path and a weight, or the volume of default_path if
+    there are none.
+    """
+    high_water = config['admission_high_water']
+    if not config['storage_roots']:
+        return [Volume(default_path, high_water=high_water, statvfs=statvfs)]
+    volumes = []
+    for root in config['storage_roots']:
+        if not isinstance(root, dict):
+            root = {'path': root}
+        volumes.append(Volume(root['path'], weight=root.get('weight', 1),
+                              high_water=high_water, statvfs=statvfs))
+    return volumes
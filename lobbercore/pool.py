@@ -0,0 +1,225 @@
+'''
+Persistent upstream connections for the Lobber proxy.
+'''
+
+import time
+from collections import deque
+from twisted.internet import reactor
+from tls import CachingClientContextFactory
+from resolver import HappyEyeballsConnector
+from metrics import Registry
+
+
+def upstreamName(key):
+    """
+    Return the C{host:port} name of the upstream server of pool key C{key}.
+    """
+    return '%s:%d' % key[:2]
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps persistent HTTP/1.1 connections to the upstream servers of the
+    proxy, keyed by C{(host, port, tls)}, so that proxied requests do not pay
+    for a new TCP and TLS handshake each.
+
+    Requests are handed to the pool as client factories (see
+    L{lobbercore.proxy.PersistentProxyClientFactory}). An idle connection is
+    reused if there is one, a new connection is opened if C{maxTotal} allows
+    it, otherwise the request is queued until a connection is released.
+
+    TLS connections to the same upstream share one
+    L{CachingClientContextFactory}, so new connections resume the TLS session
+    of earlier ones.
+
+    @ivar maxIdle: the maximum number of idle connections kept per key.
+    @type maxIdle: C{int}
+
+    @ivar maxTotal: the maximum number of open connections per key.
+    @type maxTotal: C{int}
+
+    @ivar idleTimeout: seconds an idle connection is kept before it is closed.
+    @type idleTimeout: C{int}
+
+    @ivar reactor: the reactor used to create connections.
+    @type reactor: object providing L{twisted.internet.interfaces.IReactorTCP}
+
+    @ivar resolver: the L{lobbercore.resolver.CachingResolver} upstream host
+        names are resolved with, connecting to their addresses as
+        L{HappyEyeballsConnector} does, C{attemptDelay} seconds apart, or
+        C{None} to connect by name.
+
+    @ivar metrics: the L{Registry} connect and TLS handshake latencies are
+        recorded in, and which the proxy records its requests in.
+    @type metrics: L{Registry}
+    """
+
+    def __init__(self, reactor=reactor, maxIdle=4, maxTotal=8, idleTimeout=60,
+                 metrics=None, resolver=None, attemptDelay=0.25):
+        self.reactor = reactor
+        self.resolver = resolver
+        self.attemptDelay = attemptDelay
+        self.maxIdle = maxIdle
+        self.maxTotal = maxTotal
+        self.idleTimeout = idleTimeout
+        if metrics is None:
+            metrics = Registry()
+        self.metrics = metrics
+        self._connectSeconds = metrics.histogram(
+            'upstream_connect_seconds', 'Time to connect to the upstream server.',
+            ('upstream',))
+        self._handshakeSeconds = metrics.histogram(
+            'upstream_tls_handshake_seconds', 'Time of TLS handshakes with the upstream server.',
+            ('upstream', 'resumed'))
+        self._open = {}
+        self._idle = {}
+        self._queue = {}
+        self._timeouts = {}
+        self._contextFactories = {}
+
+    def request(self, key, clientFactory):
+        """
+        Send the request held by C{clientFactory} to the upstream server
+        identified by C{key}.
+        """
+        clientFactory.pool = self
+        clientFactory.key = key
+        idle = self._idle.get(key)
+        if idle:
+            protocol = idle.pop()
+            self._timeouts.pop(protocol).cancel()
+            protocol.proxyRequest(clientFactory)
+        elif self._open.get(key, 0) < self.maxTotal:
+            self._connect(key, clientFactory)
+        else:
+            self._queue.setdefault(key, deque()).append(clientFactory)
+            d = clientFactory.father.notifyFinish()
+            d.addErrback(lambda _: self.dequeue(key, clientFactory))
+
+    def connectionMade(self, key, protocol):
+        """
+        Called by a protocol when its connection has been made, before any
+        TLS handshake starts.
+        """
+        self._connectSeconds.time(protocol.factory.connectStarted,
+                                  (upstreamName(key),))
+        if key[2]:
+            self.contextFactoryFor(key).prepareConnection(
+                protocol.transport.getHandle())
+
+    def release(self, key, protocol):
+        """
+        Called by a protocol when it has relayed a complete response and its
+        connection can be used for another request.
+        """
+        if key[2]:
+            self.contextFactoryFor(key).saveSession(
+                protocol.transport.getHandle())
+        queue = self._queue.get(key)
+        if queue:
+            protocol.proxyRequest(queue.popleft())
+            return
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.maxIdle:
+            protocol.transport.loseConnection()
+            return
+        idle.append(protocol)
+        self._timeouts[protocol] = self.reactor.callLater(
+            self.idleTimeout, self._expire, key, protocol)
+
+    def connectionLost(self, key, protocol):
+        """
+        Called by a protocol when its connection has been closed.
+        """
+        idle = self._idle.get(key, [])
+        if protocol in idle:
+            idle.remove(protocol)
+        timeout = self._timeouts.pop(protocol, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        self._closed(key)
+
+    def connectionFailed(self, key):
+        """
+        Called by a client factory when a new connection could not be made.
+        """
+        self._closed(key)
+
+    def dequeue(self, key, clientFactory):
+        """
+        Drop the request held by C{clientFactory} if it is waiting for a
+        connection.
+        """
+        queue = self._queue.get(key)
+        if queue and clientFactory in queue:
+            queue.remove(clientFactory)
+
+    def contextFactoryFor(self, key):
+        """
+        Return the TLS context factory shared by connections to C{key}.
+        """
+        contextFactory = self._contextFactories.get(key)
+        if contextFactory is None:
+            name = upstreamName(key)
+            def handshakeDone(seconds, resumed):
+                self._handshakeSeconds.observe(seconds, (name, resumed))
+            contextFactory = CachingClientContextFactory(handshakeDone)
+            self._contextFactories[key] = contextFactory
+        return contextFactory
+
+    def getStats(self):
+        """
+        Return connection and TLS handshake counters per upstream.
+        """
+        stats = {}
+        for key in set(self._open.keys() + self._contextFactories.keys()):
+            host, port, tls = key
+            upstream = {
+                'open': self._open.get(key, 0),
+                'idle': len(self._idle.get(key, [])),
+                'queued': len(self._queue.get(key, [])),
+            }
+            if tls:
+                upstream.update(self.contextFactoryFor(key).getStats())
+            stats[upstreamName(key)] = upstream
+        return stats
+
+    def closeCachedConnections(self):
+        """
+        Close all idle connections.
+        """
+        for idle in self._idle.values():
+            for protocol in idle[:]:
+                protocol.transport.loseConnection()
+
+    def _connect(self, key, clientFactory):
+        host, port, tls = key
+        self._open[key] = self._open.get(key, 0) + 1
+        clientFactory.connectStarted = time.time()
+        timeout = getattr(clientFactory, 'connectTimeout', 30)
+        if self.resolver is not None:
+            contextFactory = None
+            if tls:
+                contextFactory = self.contextFactoryFor(key)
+            HappyEyeballsConnector(self.reactor, self.resolver, host, port, clientFactory,
+                                   timeout, contextFactory, self.attemptDelay).connect()
+        elif tls:
+            self.reactor.connectSSL(host, port, clientFactory,
+                                    self.contextFactoryFor(key), timeout)
+        else:
+            self.reactor.connectTCP(host, port, clientFactory, timeout)
+
+    def _expire(self, key, protocol):
+        """
+        Close C{protocol}, which has been idle for C{idleTimeout} seconds.
+        It is no longer handed requests while its connection closes.
+        """
+        del self._timeouts[protocol]
+        self._idle[key].remove(protocol)
+        protocol.transport.loseConnection()
+
+    def _closed(self, key):
+        self._open[key] -= 1
+        queue = self._queue.get(key)
+        if queue and self._open[key] < self.maxTotal:
+            self._connect(key, queue.popleft())
@@ -5,112 +5,788 @@ Created on Nov 3, 2010
 '''
 
 import re
-import urlparse
-from urllib import quote as urlquote
-from twisted.internet import reactor, ssl
-from twisted.web.resource import Resource
+import time
+import zlib
+from StringIO import StringIO
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import TimeoutError
+from twisted.protocols.basic import FileSender
+from twisted.web.resource import Resource, NoResource
+from twisted.web.http import HTTPClient, _ChunkedTransferDecoder
+from twisted.web.http_headers import Headers
 from twisted.web.server import NOT_DONE_YET
-from twisted_web_proxy import ProxyClientFactory
+from twisted_web_proxy import ProxyClient, ProxyClientFactory
+from pool import HTTPConnectionPool, upstreamName
+from encoding import (ACCEPT_ENCODING, ENCODINGS, RATIO_BUCKETS, acceptsEncoding,
+                      StreamDecoder)
 
-class ReverseProxyTLSResource(Resource):
+# Response codes that never carry a body.
+NO_BODY_CODES = (204, 304)
+
+
+def gatewayError(request, code, message, retryAfter=None):
     """
-    Resource that renders the results gotten from another server
+    Answer C{request} with the error C{code} of the proxy itself.
+    """
+    request.setResponseCode(code)
+    request.setHeader('content-type', 'text/plain')
+    if retryAfter is not None:
+        request.setHeader('retry-after', str(int(retryAfter) + 1))
+    request.write(message)
+    request.finish()
+
+
+class PersistentProxyClient(ProxyClient):
+    """
+    A L{ProxyClient} speaking HTTP/1.1 to the upstream server, which hands its
+    connection back to the L{HTTPConnectionPool} of its factory once a
+    response has been relayed instead of closing it.
+
+    Bodies are streamed in both directions. The request body is read from
+    the file holding it with a L{FileSender}, and the client registers itself
+    as a streaming producer with the original request so that reading from
+    the upstream server is paused while the local client is slow to read.
 
-    Put this resource in the tree to cause everything below it to be relayed
-    to a different server.
+    A gzip or deflate encoded response is relayed as it is if the local
+    client accepts its encoding, and decoded on the way otherwise.
 
-    @ivar proxyClientFactoryClass: a proxy client factory class, used to create
-        new connections.
-    @type proxyClientFactoryClass: L{ClientFactory}
+    The deadlines of the request are kept by the factory, which calls
+    L{expire} when one runs out. A connection closed before the status
+    line is answered with a 502.
 
-    @ivar reactor: the reactor used to create connections.
-    @type reactor: object providing L{twisted.internet.interfaces.IReactorTCP}
+    @ivar _keepAlive: whether the upstream server allows the connection to be
+        reused after the current response.
+    @ivar _reused: whether the current request was sent on a connection
+        taken from the pool.
+    @ivar _responseStarted: whether a status line has been received for the
+        current request.
+    @ivar _paused: whether reading from the upstream server is paused.
+    @ivar _requestSent: when the request was sent upstream.
+    @ivar _bodyLength: the length of the request body.
+    @ivar _code: the status code of the current response.
+    @ivar _encoding: the content encoding of the current response, or
+        C{None}.
+    @ivar _decoder: the L{StreamDecoder} of the current response if it is
+        decoded for the local client, or C{None}.
+    @ivar _received: the number of response body bytes received.
+    @ivar _decodeSeconds: the time spent decoding the current response.
     """
+    _keepAlive = True
+    _reused = False
+    _responseStarted = False
+    _noBody = False
+    _chunkDecoder = None
+    _paused = False
+    _requestSent = None
+    _bodyLength = 0
+    _code = None
+    _encoding = None
+    _decoder = None
+    _received = 0
+    _decodeSeconds = 0.0
 
-    proxyClientFactoryClass = ProxyClientFactory
+    def __init__(self, command, rest, version, headers, data, father):
+        """
+        @param data: a file holding the request body.
+        """
+        ProxyClient.__init__(self, command, rest, version, headers, data,
+                             father)
+        self.headers["connection"] = "keep-alive"
+        # The body has been decoded already, send it with a known length.
+        self.headers.pop("transfer-encoding", None)
+        data.seek(0, 2)
+        self._bodyLength = data.tell()
+        if self._bodyLength or "content-length" in self.headers:
+            self.headers["content-length"] = str(self._bodyLength)
+
+    def connectionMade(self):
+        if not self._reused:
+            self.factory.pool.connectionMade(self.factory.key, self)
+        self.factory.client = self
+        self.father.registerProducer(self, True)
+        # The request line and headers go out in one write.
+        head = ['%s %s HTTP/1.1\r\n' % (self.command, self.rest)]
+        for header, value in self.headers.iteritems():
+            head.append('%s: %s\r\n' % (header, value))
+        head.append('\r\n')
+        # Ensure that headers does not contain unicode.
+        self.transport.write(str(''.join(head)))
+        self._requestSent = time.time()
+        self.factory.requestSent()
+        if self._bodyLength:
+            self.data.seek(0, 0)
+            FileSender().beginFileTransfer(self.data, self.transport)
+
+    def pauseProducing(self):
+        self._paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        """
+        The local client has gone away, drop the upstream connection as the
+        rest of the response is of no use.
+        """
+        self._finished = True
+        self._keepAlive = False
+        self.factory.cancelDeadlines()
+        self.transport.loseConnection()
 
+    def expire(self, message):
+        """
+        A deadline of the request has run out. Answer it with a 504 if its
+        response has not started, otherwise end the response relayed so
+        far, and drop the upstream connection.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self._keepAlive = False
+        self.father.unregisterProducer()
+        if self._responseStarted:
+            self.father.finish()
+        else:
+            gatewayError(self.father, 504, message)
+        if self._paused:
+            self.resumeProducing()
+        self.transport.loseConnection()
 
-    def __init__(self, host, port, path, path_rewrite=None, reactor=reactor,
-                 tls=False, headers={}):
+    def proxyRequest(self, factory):
         """
-        @param host: the host of the web server to proxy.
-        @type host: C{str}
+        Reuse this connection for the request held by C{factory}.
+        """
+        self.__init__(factory.command, factory.rest, factory.version,
+                      factory.headers, factory.data, factory.father)
+        self.factory = factory
+        self._finished = False
+        self._keepAlive = True
+        self._reused = True
+        self._responseStarted = False
+        self._noBody = False
+        self._chunkDecoder = None
+        self._paused = False
+        self._code = None
+        self._encoding = None
+        self._decoder = None
+        self._received = 0
+        self._decodeSeconds = 0.0
+        self.firstLine = True
+        self.length = None
+        self._header = ""
+        self.setLineMode()
+        self.connectionMade()
 
-        @param port: the port of the web server to proxy.
-        @type port: C{port}
+    def handleStatus(self, version, code, message):
+        self._responseStarted = True
+        self.factory.pool.metrics.histogram(
+            'upstream_first_byte_seconds',
+            'Time from sending a request upstream to its status line.',
+            ('upstream',)).time(self._requestSent, (upstreamName(self.factory.key),))
+        self._keepAlive = version == 'HTTP/1.1'
+        code = self._code = int(code)
+        self.factory.responseStarted(code)
+        self._noBody = (self.command == 'HEAD' or code in NO_BODY_CODES or
+                        100 <= code < 200)
+        ProxyClient.handleStatus(self, version, code, message)
 
-        @param path: the base path to fetch data from. Note that you shouldn't
-            put any trailing slashes in it, it will be added automatically in
-            request. For example, if you put B{/foo}, a request on B{/bar} will
-            be proxied to B{/foo/bar}.  Any required encoding of special
-            characters (such as " " or "/") should have been done already.
+    def handleHeader(self, key, value):
+        # Hop-by-hop headers describe the upstream connection only and are
+        # not relayed.
+        lkey = key.lower()
+        if lkey == 'connection':
+            if value.lower() == 'close':
+                self._keepAlive = False
+            elif value.lower() == 'keep-alive':
+                self._keepAlive = True
+        elif lkey == 'transfer-encoding':
+            if value.lower() == 'chunked':
+                self._chunkDecoder = _ChunkedTransferDecoder(
+                    self.handleResponsePart, self._chunkedFinished)
+        elif lkey == 'content-type' and value.lower().startswith('text/event-stream'):
+            # An event stream goes on for as long as it is wanted.
+            self.factory.cancelDeadlines()
+            ProxyClient.handleHeader(self, key, value)
+        elif lkey == 'content-encoding' and value.lower() in ENCODINGS:
+            self._encoding = ENCODINGS[value.lower()]
+            # A partial body can not be decoded on its own.
+            if (self._noBody or self._code == 206 or
+                    acceptsEncoding(self.factory.acceptEncoding, self._encoding)):
+                ProxyClient.handleHeader(self, key, value)
+            else:
+                self._decoder = StreamDecoder(self._encoding)
+        elif lkey != 'keep-alive':
+            ProxyClient.handleHeader(self, key, value)
 
-        @param path_rewrite: list of lists with two regexp strings
-        used for rewriting the path.
+    def handleEndHeaders(self):
+        if self._decoder is not None:
+            # The decoded length is not known until the end.
+            self.father.responseHeaders.removeHeader('content-length')
 
-        @param tls: use tls or not
+    def handleResponsePart(self, buffer):
+        if self._finished:
+            return
+        self._received += len(buffer)
+        if self._decoder is not None:
+            started = time.time()
+            try:
+                buffer = self._decoder.decode(buffer)
+            except zlib.error:
+                self._decodeFailed()
+                return
+            self._decodeSeconds += time.time() - started
+            if not buffer:
+                return
+        self.father.write(buffer)
 
-        @type path: C{str}
+    def _decodeFailed(self):
         """
-        Resource.__init__(self)
-        self.host = host
-        self.port = port
-        self.path = path
-        self.path_rewrite = path_rewrite
-        self.tls = tls
-        self.reactor = reactor
-        self.headers = headers
+        End the response relayed so far, the rest of the body can not be
+        decoded.
+        """
+        self.factory.pool.metrics.counter(
+            'decode_errors_total', 'Upstream responses which failed to decode.',
+            ('upstream',)).inc((upstreamName(self.factory.key),))
+        self._finished = True
+        self._keepAlive = False
+        self.father.unregisterProducer()
+        self.father.finish()
+        self.transport.loseConnection()
 
-    def getChild(self, path, request):
+    def _bodyFinished(self):
         """
-        Create and return a proxy resource with the same proxy configuration
-        as this one, except that its path also contains the segment given by
-        C{path} at the end.
+        Write what the decoder still holds and record the encoding, size
+        and decoding time of the response body.
         """
-        return ReverseProxyTLSResource(
-            self.host, 
-            self.port, 
-            self.path + '/' + urlquote(path, safe=""),
-            self.path_rewrite,
-            self.reactor,
-            self.tls,
-            self.headers)
+        metrics = self.factory.pool.metrics
+        if self._decoder is not None:
+            started = time.time()
+            try:
+                tail = self._decoder.flush()
+            except zlib.error:
+                tail = ''
+            self._decodeSeconds += time.time() - started
+            if tail:
+                self.father.write(tail)
+        upstream = upstreamName(self.factory.key)
+        metrics.counter(
+            'upstream_body_bytes_total',
+            'Response body bytes received from the upstream server, by encoding.',
+            ('upstream', 'encoding')).inc((upstream, self._encoding or 'identity'),
+                                          self._received)
+        if self._encoding is None:
+            return
+        if self._decoder is None:
+            handling = 'passed'
+        else:
+            handling = 'decoded'
+            metrics.counter(
+                'decoded_bytes_total', 'Bytes of compressed responses after decoding.',
+                ('upstream',)).inc((upstream,), self._decoder.decoded)
+            metrics.counter(
+                'decode_seconds_total', 'Time spent decoding compressed responses.',
+                ('upstream',)).inc((upstream,), self._decodeSeconds)
+            if self._decoder.decoded:
+                metrics.histogram(
+                    'compression_ratio', 'Compressed to decoded size of decoded responses.',
+                    ('upstream',), RATIO_BUCKETS).observe(
+                        self._received / float(self._decoder.decoded), (upstream,))
+        metrics.counter(
+            'compressed_responses_total',
+            'Compressed upstream responses, by whether they were decoded for the client.',
+            ('upstream', 'handling')).inc((upstream, handling))
 
+    def lineReceived(self, line):
+        HTTPClient.lineReceived(self, line)
+        if not line and not self.line_mode and (
+                self._noBody or self.length == 0):
+            self.length = 0
+            self.setLineMode()
+            self.handleResponseEnd()
 
-    def render(self, request):
+    def rawDataReceived(self, data):
+        if self._chunkDecoder is not None:
+            self._chunkDecoder.dataReceived(data)
+        elif self.length is not None:
+            HTTPClient.rawDataReceived(self, data)
+        else:
+            # No framing, the response ends when the connection does.
+            self._keepAlive = False
+            self.handleResponsePart(data)
+
+    def _chunkedFinished(self, rest):
+        self._chunkDecoder = None
+        self.handleResponseEnd()
+        self.setLineMode(rest)
+
+    def handleResponseEnd(self):
+        """
+        Finish the original request and hand the connection back to the pool
+        if the upstream server allows it to be reused.
         """
-        Render a request by forwarding it to the proxied server.
+        if not self._finished:
+            self.factory.cancelDeadlines()
+            self._bodyFinished()
+            self._finished = True
+            self.factory.pool.metrics.histogram(
+                'upstream_response_seconds',
+                'Time from sending a request upstream to the end of its response.',
+                ('upstream', 'reused')).time(
+                    self._requestSent, (upstreamName(self.factory.key), self._reused))
+            self.father.unregisterProducer()
+            self.father.finish()
+            if self._paused:
+                self.resumeProducing()
+            if self._keepAlive and self.length in (None, 0) and \
+                    self._chunkDecoder is None:
+                self.factory.pool.release(self.factory.key, self)
+            else:
+                self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.pool.connectionLost(self.factory.key, self)
+        if self._reused and not self._responseStarted and not self._finished:
+            # The server closed the idle connection as it was being reused,
+            # send the request again on a new connection.
+            self._finished = True
+            self.father.unregisterProducer()
+            self.factory.client = None
+            self.factory.pool.request(self.factory.key, self.factory)
+            return
+        if not self._responseStarted and not self._finished:
+            self._finished = True
+            self.factory.cancelDeadlines()
+            self.factory.failed()
+            self.father.unregisterProducer()
+            gatewayError(self.father, 502, 'Upstream closed the connection')
+            return
+        # The response is complete unless it was delimited by the connection.
+        self._keepAlive = False
+        ProxyClient.connectionLost(self, reason)
+
+
+
+class PersistentProxyClientFactory(ProxyClientFactory):
+    """
+    A L{ProxyClientFactory} whose connections are managed by an
+    L{HTTPConnectionPool}. The pool sets C{pool} and C{key} when the request
+    is handed to it, and gives new connections C{connectTimeout} seconds.
+    C{acceptEncoding} is the Accept-Encoding header of the local client,
+    C{None} if responses should always be decoded.
+
+    The request is answered with a 504 if it has no status line
+    C{firstByteTimeout} seconds after it was sent, or no complete response
+    C{totalTimeout} seconds after L{startDeadlines}, waiting for a
+    connection included. C{None} is no deadline. A failed connection is
+    answered with a 502, a timed out one with a 504.
+
+    @ivar breaker: the L{CircuitBreaker} told how the request went, or
+        C{None}.
+    @ivar client: the L{PersistentProxyClient} the request was sent with,
+        C{None} until it is.
+    """
+
+    protocol = PersistentProxyClient
+    pool = None
+    key = None
+    connectTimeout = 30
+    acceptEncoding = None
+    firstByteTimeout = None
+    totalTimeout = None
+    breaker = None
+    client = None
+    reactor = reactor
+    _connector = None
+    _firstByteCall = None
+    _totalCall = None
+    _done = False
+
+    def buildProtocol(self, addr):
+        p = ProxyClientFactory.buildProtocol(self, addr)
+        p.factory = self
+        return p
+
+    def startedConnecting(self, connector):
+        self._connector = connector
+
+    def startDeadlines(self):
+        """
+        Start the total deadline, before the request is handed to the pool.
         """
-        # RFC 2616 tells us that we can omit the port if it's the default port,
-        # but we have to provide it otherwise
-        if (self.tls and self.port == 443) or (not self.tls and self.port == 80):
-            host = self.host
+        if self.totalTimeout:
+            self._totalCall = self.reactor.callLater(
+                self.totalTimeout, self._expired, 'total')
+        self.father.notifyFinish().addErrback(lambda _: self.cancelDeadlines())
+
+    def requestSent(self):
+        if self.firstByteTimeout:
+            if self._firstByteCall is not None and self._firstByteCall.active():
+                self._firstByteCall.cancel()
+            self._firstByteCall = self.reactor.callLater(
+                self.firstByteTimeout, self._expired, 'first_byte')
+
+    def responseStarted(self, code):
+        if self._firstByteCall is not None and self._firstByteCall.active():
+            self._firstByteCall.cancel()
+        self._firstByteCall = None
+        if self.breaker is not None:
+            if code >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    def failed(self):
+        if self.breaker is not None:
+            self.breaker.failure()
+
+    def cancelDeadlines(self):
+        self._done = True
+        for call in (self._firstByteCall, self._totalCall):
+            if call is not None and call.active():
+                call.cancel()
+        self._firstByteCall = self._totalCall = None
+
+    def _expired(self, deadline):
+        if deadline == 'total':
+            self._totalCall = None
         else:
-            host = "%s:%d" % (self.host, self.port)
-        request.received_headers['host'] = host
-        request.content.seek(0, 0)
+            self._firstByteCall = None
+        self.cancelDeadlines()
+        self.pool.metrics.counter(
+            'upstream_deadlines_expired_total',
+            'Requests whose deadline ran out, by upstream and deadline.',
+            ('upstream', 'deadline')).inc((upstreamName(self.key), deadline))
+        self.failed()
+        message = 'Upstream did not answer in time'
+        if self.client is not None:
+            self.client.expire(message)
+            return
+        # Still waiting for a connection.
+        self.pool.dequeue(self.key, self)
+        if self._connector is not None and self._connector.state == 'connecting':
+            self._connector.stopConnecting()
+        gatewayError(self.father, 504, message)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool.metrics.counter(
+            'upstream_connect_failures_total',
+            'Failed connection attempts to the upstream server.',
+            ('upstream',)).inc((upstreamName(self.key),))
+        self.pool.connectionFailed(self.key)
+        if self._done:
+            # Given up on already.
+            return
+        self.cancelDeadlines()
+        self.failed()
+        if reason.check(TimeoutError):
+            gatewayError(self.father, 504, 'Upstream connection timed out')
+        else:
+            gatewayError(self.father, 502, 'Could not connect upstream')
+
+
+class ProxyRoute(object):
+    """
+    A route of the L{ProxyResource}, compiled once: the upstream server its
+    requests are relayed to, the path rewrites and headers applied to them,
+    and its policies.
+
+    @ivar key: the L{HTTPConnectionPool} key of the upstream server.
+    @ivar rewrites: list of compiled patterns and their replacements, applied
+        in order to the path of each request.
+    @ivar headers: the headers added to each request, lower case names and
+        C{str} values, the Host header of the upstream server included.
+    @ivar pool: the L{HTTPConnectionPool} upstream connections are taken
+        from.
+    @ivar cache: the L{HTTPCache} GET requests for the paths it has a rule
+        for are answered from, or C{None} for no caching.
+    @ivar announces: the L{AnnounceScheduler} pacing the announces, or
+        C{None} for no rate limit.
+    @ivar connectTimeout: seconds to wait for a new upstream connection.
+    @ivar compress: whether gzip and deflate encoded responses are asked
+        for. They are decoded for local clients which do not accept them,
+        and for the cache.
+    @ivar singleFlight: the L{SingleFlight} identical GET requests in flight
+        are collapsed by, or C{None}.
+    @ivar firstByteTimeout: seconds to wait for the status line of a
+        request sent upstream, or C{None}.
+    @ivar totalTimeout: seconds to wait for the complete response to a
+        request, or C{None}.
+    @ivar streaming: compiled patterns of the paths of long lived responses,
+        such as event streams, which have no first byte or total deadline.
+    @ivar breaker: the L{CircuitBreaker} of the upstream server, or C{None}.
+    """
+
+    proxyClientFactoryClass = PersistentProxyClientFactory
+
+    def __init__(self, host, port, tls=False, path_rewrite=None, headers=None,
+                 pool=None, cache=None, announces=None, connectTimeout=30,
+                 compress=True, singleFlight=None, firstByteTimeout=None,
+                 totalTimeout=None, streaming=(), breaker=None, reactor=reactor):
+        """
+        @param path_rewrite: list of lists with two regexp strings used for
+            rewriting the path.
+        @param headers: dict of headers added to each request.
+        @param streaming: regexp strings matching the paths of long lived
+            responses.
+        """
+        self.key = (host, port, tls)
+        self.rewrites = [(re.compile(pattern), repl)
+                         for pattern, repl in path_rewrite or ()]
+        # RFC 2616 tells us that we can omit the port if it's the default
+        # port, but we have to provide it otherwise
+        if (tls and port == 443) or (not tls and port == 80):
+            hostHeader = host
+        else:
+            hostHeader = "%s:%d" % (host, port)
+        # Ensure that headers do not contain unicode.
+        self.headers = {'host': str(hostHeader)}
+        for name, value in (headers or {}).items():
+            self.headers[str(name).lower()] = str(value)
+        self.compress = compress
+        if compress:
+            self.headers['accept-encoding'] = ACCEPT_ENCODING
+        if pool is None:
+            pool = HTTPConnectionPool(reactor)
+        self.pool = pool
+        self.cache = cache
+        self.announces = announces
+        self.connectTimeout = connectTimeout
+        self.singleFlight = singleFlight
+        self.firstByteTimeout = firstByteTimeout
+        self.totalTimeout = totalTimeout
+        self.streaming = [re.compile(pattern) for pattern in streaming]
+        self.breaker = breaker
+        self.reactor = reactor
+        self._requestSeconds = pool.metrics.histogram(
+            'proxy_request_seconds', 'Time to answer requests to the proxy.',
+            ('method', 'code'))
 
-        path, _, qs = urlparse.urlparse(request.uri)[2:5]
-        if path and self.path_rewrite:
-            for pattern, repl in self.path_rewrite:
-                path = re.sub(pattern, repl, path, 1)
-        if qs:
-            rest = path + '?' + qs
+    def render(self, request, path):
+        """
+        Relay C{request} for C{path}, the path with any route prefix removed,
+        to the upstream server.
+        """
+        started = time.time()
+        request.notifyFinish().addCallbacks(
+            self._finished, self._aborted, (request, started), None,
+            (request, started))
+        request.content.seek(0, 0)
+        announce = self.announces is not None and self.announces.matches(path)
+        for pattern, repl in self.rewrites:
+            path = pattern.sub(repl, path, 1)
+        query = request.uri.find('?')
+        if query >= 0:
+            rest = path + request.uri[query:]
         else:
             rest = path
-            
-        for key,value in self.headers.items():
-            request.requestHeaders.setRawHeaders(key,[value])
-        
-        clientFactory = self.proxyClientFactoryClass(
-            request.method, rest, request.clientproto,
-            request.getAllHeaders(), request.content.read(), request)
-        
-        if self.tls:
-            context = ssl.ClientContextFactory()
-            context.method = ssl.SSL.TLSv1_METHOD
-            self.reactor.connectSSL(self.host, self.port, clientFactory,
-                                    context)
+        headers = request.getAllHeaders()
+        acceptEncoding = headers.get('accept-encoding')
+        headers.update(self.headers)
+        if announce:
+            self.announces.schedule(
+                request, request.args.get('info_hash', [None])[0],
+                request.args.get('event', [None])[0],
+                lambda: self.proxyRequest(request.method, rest, request.clientproto,
+                                          headers, request.content, request,
+                                          acceptEncoding))
+        elif (self.cache is not None and request.method == 'GET' and
+              self.cache.ruleFor(rest) is not None):
+            self.cache.render(request, rest, headers, self.fetcher(request, rest))
         else:
-            self.reactor.connectTCP(self.host, self.port, clientFactory)
+            self.relay(request, request, rest, headers, acceptEncoding)
         return NOT_DONE_YET
+
+    def get(self, path):
+        """
+        Fetch C{path} from the upstream server for the plugin itself,
+        without a local connection, through the cache and single flight
+        like any other request.
+
+        @return: a L{Deferred} firing with the finished L{InternalRequest}.
+        """
+        request = InternalRequest(path)
+        d = request.notifyFinish()
+        self.render(request, path.split('?', 1)[0])
+        d.addCallback(lambda _: request)
+        return d
+
+    def fetcher(self, request, rest):
+        """
+        Return a callable relaying C{request} for C{rest} upstream with the
+        given headers, for the cache. Responses are decoded before they are
+        cached.
+        """
+        def fetch(headers, father):
+            self.relay(request, father, rest, headers)
+        return fetch
+
+    def relay(self, request, father, rest, headers, acceptEncoding=None):
+        """
+        Relay C{request} upstream and its response to C{father}, joining
+        an identical GET in flight if there is one.
+        """
+        # A request answered from the cache has let go of its body by the
+        # time the cache revalidates, the body is taken from father.
+        data = father.content
+        if self.singleFlight is not None and request.method == 'GET':
+            father = self.singleFlight.join(
+                self.singleFlight.key(rest, headers, acceptEncoding), father)
+            if father is None:
+                return
+        self.proxyRequest(request.method, rest, request.clientproto,
+                          headers, data, father, acceptEncoding)
+
+    def proxyRequest(self, method, rest, version, headers, data, father,
+                     acceptEncoding=None):
+        """
+        Send a request to the proxied server and relay the response to
+        C{father}, decoded unless C{acceptEncoding} accepts its encoding.
+        The request is refused with a 503 while the circuit of the upstream
+        server is open.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            gatewayError(father, 503, 'Upstream unavailable',
+                         self.breaker.retryAfter())
+            return
+        clientFactory = self.proxyClientFactoryClass(
+            method, rest, version, headers, data, father)
+        clientFactory.connectTimeout = self.connectTimeout
+        clientFactory.acceptEncoding = acceptEncoding
+        clientFactory.breaker = self.breaker
+        clientFactory.reactor = self.reactor
+        path = rest.split('?', 1)[0]
+        if not [pattern for pattern in self.streaming if pattern.search(path)]:
+            clientFactory.firstByteTimeout = self.firstByteTimeout
+            clientFactory.totalTimeout = self.totalTimeout
+        clientFactory.startDeadlines()
+        self.pool.request(self.key, clientFactory)
+
+    def _finished(self, _, request, started):
+        self._requestSeconds.time(started, (request.method, request.code))
+
+    def _aborted(self, _, request, started):
+        self._requestSeconds.time(started, (request.method, 'aborted'))
+
+
+
+class ProxyResource(Resource):
+    """
+    The root of the proxy, a leaf resource routing each request to a
+    L{ProxyRoute} by the host it was made to or by the first segment of its
+    path, without building a resource per path segment.
+
+    Requests routed by path have the routing segment removed before they
+    are relayed. Requests whose first path segment names a child put on
+    this resource are rendered by the child, before any routing.
+
+    @ivar hosts: maps lower case host names, without port, to routes.
+    @ivar prefixes: maps first path segments to routes.
+    @ivar default: the route of requests matching no other, or C{None} to
+        answer them with a 404.
+    """
+
+    isLeaf = True
+
+    def __init__(self, default=None):
+        Resource.__init__(self)
+        self.hosts = {}
+        self.prefixes = {}
+        self.default = default
+
+    def addRoute(self, route, prefix='', hosts=()):
+        """
+        Route requests whose first path segment is C{prefix}, or whose host
+        is one of C{hosts}, to C{route}.
+        """
+        if prefix.strip('/'):
+            self.prefixes[prefix.strip('/')] = route
+        for host in hosts:
+            self.hosts[host.lower()] = route
+
+    def render(self, request):
+        path = request.path
+        end = path.find('/', 1)
+        if end < 0:
+            end = len(path)
+        segment = path[1:end]
+        child = self.children.get(segment)
+        if child is not None:
+            return child.render(request)
+        route = None
+        if self.hosts:
+            host = request.getHeader('host')
+            if host is not None:
+                if not host.endswith(']'):
+                    host = host.rsplit(':', 1)[0]
+                route = self.hosts.get(host.lower())
+        if route is None:
+            route = self.prefixes.get(segment)
+            if route is not None:
+                path = path[end:] or '/'
+            else:
+                route = self.default
+        if route is None:
+            return NoResource().render(request)
+        return route.render(request, path)
+
+
+
+class InternalRequest(object):
+    """
+    A GET request made by the plugin itself through a L{ProxyRoute}. The
+    response is kept in memory.
+
+    @ivar code: the response status code, 200 unless set, like for a
+        L{twisted.web.server.Request}.
+    @ivar body: the response body, once finished.
+    """
+
+    method = 'GET'
+    clientproto = 'HTTP/1.1'
+    code = 200
+    body = None
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.path = uri.split('?', 1)[0]
+        self.args = {}
+        self.content = StringIO()
+        self.requestHeaders = Headers()
+        self.responseHeaders = Headers()
+        self._body = []
+        self._finishedDeferreds = []
+
+    def getAllHeaders(self):
+        return {}
+
+    def getHeader(self, name):
+        return None
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def write(self, data):
+        self._body.append(data)
+
+    def finish(self):
+        self.body = ''.join(self._body)
+        finished, self._finishedDeferreds = self._finishedDeferreds, []
+        for d in finished:
+            d.callback(None)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def notifyFinish(self):
+        d = Deferred()
+        self._finishedDeferreds.append(d)
+        return d
@@ -0,0 +1,164 @@
+'''
+Subscription to the Lobber feed's server-sent event stream.
+'''
+
+import json
+import logging
+from urlparse import urlparse
+from twisted.internet import reactor
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.policies import TimeoutMixin
+from twisted.web.http import HTTPClient
+
+log = logging.getLogger(__name__)
+
+
+class EventStreamProtocol(HTTPClient, TimeoutMixin):
+    """
+    Reads a text/event-stream response and passes each event to the
+    factory. The connection is dropped if nothing, not even a comment, has
+    been received for the factory's idle_timeout seconds.
+    """
+
+    def connectionMade(self):
+        self.setTimeout(self.factory.idle_timeout)
+        self.buffer = ''
+        self.event = {}
+        self.sendCommand('GET', self.factory.path)
+        self.sendHeader('Host', self.factory.host)
+        self.sendHeader('Accept', 'text/event-stream')
+        self.sendHeader('User-Agent', 'Lobber Storage Node/2.0')
+        for name, value in self.factory.headers.items():
+            self.sendHeader(name, value)
+        if self.factory.last_event_id is not None:
+            self.sendHeader('Last-Event-ID', self.factory.last_event_id)
+        self.endHeaders()
+
+    def handleStatus(self, version, status, message):
+        if status != '200':
+            log.error('Feed event stream answered %s %s' % (status, message))
+            self.transport.loseConnection()
+
+    def handleEndHeaders(self):
+        self.factory.stream_started(self)
+
+    def rawDataReceived(self, data):
+        self.resetTimeout()
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.line_received(line.rstrip('\r'))
+
+    def line_received(self, line):
+        if not line:
+            if 'data' in self.event:
+                self.factory.event_received(self.event.get('event', 'message'),
+                                            self.event.get('id'),
+                                            '\n'.join(self.event['data']))
+            self.event = {}
+        elif line.startswith(':'):
+            # A comment, sent to keep the connection alive.
+            pass
+        else:
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'data':
+                self.event.setdefault('data', []).append(value)
+            elif field in ('event', 'id'):
+                self.event[field] = value
+
+    def timeoutConnection(self):
+        log.warning('Feed event stream idle, reconnecting.')
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        self.factory.stream_lost(self)
+
+
+class FeedSubscription(ReconnectingClientFactory):
+    """
+    Holds a connection to the feed's event stream through the proxy and
+    calls on_entries with the feed entries of each torrent event, and
+    on_state with True or False when the stream is established or lost.
+    Lost connections are retried with an exponential backoff of at most
+    retry_max_delay seconds.
+
+    A torrent event's data is a feed entry or a JSON array of them.
+    """
+
+    protocol = EventStreamProtocol
+    noisy = False
+
+    def __init__(self, url, on_entries, on_state=None, headers=None,
+                 retry_max_delay=300, idle_timeout=120, reactor=reactor):
+        parse_result = urlparse(url)
+        self.host = parse_result.netloc
+        self.port = parse_result.port or 80
+        self.path = parse_result.path
+        if parse_result.query:
+            self.path += '?' + parse_result.query
+        self.on_entries = on_entries
+        self.on_state = on_state
+        self.headers = headers or {}
+        self.maxDelay = retry_max_delay
+        self.idle_timeout = idle_timeout
+        self.reactor = reactor
+        self.last_event_id = None
+        self.connected = False
+        self.connector = None
+        self.stats = {
+            'connects': 0,
+            'disconnects': 0,
+            'events': 0,
+            'entries': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        self.continueTrying = True
+        self.connector = self.reactor.connectTCP('127.0.0.1', self.port, self)
+
+    def stop(self):
+        self.stopTrying()
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def stream_started(self, protocol):
+        self.resetDelay()
+        self.connected = True
+        self.stats['connects'] += 1
+        log.info('Subscribed to the feed event stream.')
+        if self.on_state is not None:
+            self.on_state(True)
+
+    def stream_lost(self, protocol):
+        if self.connected:
+            self.connected = False
+            self.stats['disconnects'] += 1
+            log.info('Feed event stream lost.')
+            if self.on_state is not None:
+                self.on_state(False)
+
+    def event_received(self, event, event_id, data):
+        if event_id is not None:
+            self.last_event_id = event_id
+        if event not in ('torrent', 'message'):
+            return
+        self.stats['events'] += 1
+        try:
+            entries = json.loads(data)
+        except ValueError:
+            self.stats['errors'] += 1
+            log.error('Malformed feed event: %r' % data[:1024])
+            return
+        if not isinstance(entries, list):
+            entries = [entries]
+        self.stats['entries'] += len(entries)
+        self.on_entries(entries)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['connected'] = self.connected
+        return stats
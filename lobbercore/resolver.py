@@ -0,0 +1,299 @@
+'''
+Cached name resolution and happy eyeballs connections for the upstream
+servers of the Lobber proxy.
+'''
+
+import time
+import socket
+from twisted.internet import reactor, defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.error import DNSLookupError, UserError
+from twisted.internet.protocol import ClientFactory, Protocol
+from twisted.names import client, dns
+from twisted.python import log
+from twisted.python.failure import Failure
+from metrics import Registry
+
+
+def interleave(ipv6, ipv4):
+    """
+    Return the addresses of C{ipv6} and C{ipv4} in the order they are
+    tried in, alternating families starting with IPv6 as RFC 8305 has it.
+    """
+    addresses = []
+    for i in range(max(len(ipv6), len(ipv4))):
+        addresses.extend(ipv6[i:i + 1])
+        addresses.extend(ipv4[i:i + 1])
+    return addresses
+
+
+class CachedAddresses(object):
+    """
+    The addresses of a host name and when they were resolved.
+
+    @ivar addresses: the addresses, in the order they are tried in.
+    @ivar resolved: when they were resolved.
+    @ivar expires: when their TTL runs out.
+    @ivar refreshAt: when they are looked up again in the background.
+    """
+
+    def __init__(self, addresses, resolved, ttl, refreshRatio):
+        self.addresses = addresses
+        self.resolved = resolved
+        self.expires = resolved + ttl
+        self.refreshAt = resolved + ttl * refreshRatio
+
+
+class CachingResolver(object):
+    """
+    Resolves the host names of upstream servers to their IPv6 and IPv4
+    addresses and keeps them for their TTL, so that requests do not wait
+    for DNS or take a thread of the reactor's resolver.
+
+    An entry is looked up again in the background once C{refreshRatio} of
+    its TTL has passed. A lookup which fails or finds no address leaves the
+    entry as it was, and an expired entry is used for up to C{maxStale}
+    seconds more while lookups fail. Concurrent lookups of a host are made
+    once. TTLs are kept between C{minTTL} and C{maxTTL} seconds.
+
+    @ivar resolver: the L{twisted.names} resolver names are looked up with.
+    """
+
+    def __init__(self, resolver=None, minTTL=10, maxTTL=3600, refreshRatio=0.75,
+                 maxStale=3600, reactor=reactor, metrics=None):
+        if resolver is None:
+            resolver = client.createResolver()
+        self.resolver = resolver
+        self.minTTL = minTTL
+        self.maxTTL = maxTTL
+        self.refreshRatio = refreshRatio
+        self.maxStale = maxStale
+        self.reactor = reactor
+        if metrics is None:
+            metrics = Registry()
+        self._entries = {}
+        self._pending = {}
+        self._lookups = metrics.counter(
+            'dns_lookups_total',
+            'Upstream host name resolutions, by outcome.', ('outcome',))
+        self._lookupSeconds = metrics.histogram(
+            'dns_lookup_seconds', 'Time of upstream host name lookups.')
+
+    def resolve(self, host):
+        """
+        Return a L{Deferred} firing with the addresses of C{host}, at once
+        if they are cached and not expired.
+        """
+        if isIPAddress(host) or isIPv6Address(host):
+            return defer.succeed([host])
+        now = self.reactor.seconds()
+        entry = self._entries.get(host)
+        if entry is not None and now < entry.expires:
+            self._lookups.inc(('hit',))
+            if now >= entry.refreshAt and host not in self._pending:
+                self._lookups.inc(('refresh',))
+                self.lookup(host).addErrback(lambda _: None)
+            return defer.succeed(entry.addresses)
+        self._lookups.inc((entry is None and 'miss' or 'expired',))
+        return self.lookup(host)
+
+    def lookup(self, host):
+        """
+        Look C{host} up, unless a lookup of it is in flight already, and
+        return a L{Deferred} firing with its addresses.
+        """
+        d = defer.Deferred()
+        waiters = self._pending.get(host)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._pending[host] = [d]
+        lookups = defer.DeferredList([self.resolver.lookupIPV6Address(host),
+                                      self.resolver.lookupAddress(host)],
+                                     consumeErrors=True)
+        lookups.addCallback(self._looked, host, time.time())
+        return d
+
+    def _looked(self, results, host, started):
+        self._lookupSeconds.time(started)
+        ipv6, ipv4, ttls = [], [], []
+        for success, result in results:
+            if not success:
+                continue
+            for record in result[0]:
+                if record.type == dns.AAAA:
+                    ipv6.append(socket.inet_ntop(socket.AF_INET6, record.payload.address))
+                elif record.type == dns.A:
+                    ipv4.append(record.payload.dottedQuad())
+                else:
+                    continue
+                ttls.append(record.ttl)
+        now = self.reactor.seconds()
+        entry = self._entries.get(host)
+        if ipv6 or ipv4:
+            ttl = max(self.minTTL, min([self.maxTTL] + ttls))
+            entry = CachedAddresses(interleave(ipv6, ipv4), now, ttl, self.refreshRatio)
+            self._entries[host] = entry
+            result = entry.addresses
+        elif entry is not None and now < entry.expires + self.maxStale:
+            self._lookups.inc(('stale',))
+            log.msg('Resolving %s failed, using addresses from %d seconds ago.'
+                    % (host, now - entry.resolved))
+            result = entry.addresses
+        else:
+            self._lookups.inc(('error',))
+            result = Failure(DNSLookupError(host))
+        for d in self._pending.pop(host):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def getStats(self):
+        """
+        Return the addresses and seconds of TTL left of each cached host.
+        """
+        now = self.reactor.seconds()
+        stats = {}
+        for host, entry in self._entries.items():
+            stats[host] = {
+                'addresses': len(entry.addresses),
+                'ttl': entry.expires - now,
+                'stale': int(now >= entry.expires),
+            }
+        return stats
+
+
+class HappyEyeballsConnector(object):
+    """
+    Connects a client factory to a host by name, trying its addresses as
+    RFC 8305 does: the next address is tried if the previous ones have not
+    connected in C{attemptDelay} seconds, or as soon as they have all
+    failed, and the first connection made is used. The others are dropped.
+
+    The connector is given to the client factory as the connector of the
+    connection attempt, so it can be stopped like one.
+
+    @ivar state: C{'connecting'}, C{'connected'} or C{'disconnected'}.
+    """
+
+    state = 'connecting'
+
+    def __init__(self, reactor, resolver, host, port, factory, timeout=30,
+                 contextFactory=None, attemptDelay=0.25):
+        self.reactor = reactor
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.factory = factory
+        self.timeout = timeout
+        self.contextFactory = contextFactory
+        self.attemptDelay = attemptDelay
+        self._addresses = []
+        self._attempts = []
+        self._next = None
+
+    def connect(self):
+        self.factory.startedConnecting(self)
+        d = self.resolver.resolve(self.host)
+        d.addCallbacks(self._resolved, self._failed)
+
+    def stopConnecting(self):
+        if self.state != 'connecting':
+            return
+        self._failed(Failure(UserError(string='Connecting stopped')))
+        self._stop()
+
+    def _resolved(self, addresses):
+        if self.state != 'connecting':
+            return
+        self._addresses = list(addresses)
+        self._attempt()
+
+    def _attempt(self):
+        self._next = None
+        address = self._addresses.pop(0)
+        attempt = _Attempt(self)
+        if self.contextFactory is not None:
+            self.reactor.connectSSL(address, self.port, attempt,
+                                    self.contextFactory, self.timeout)
+        else:
+            self.reactor.connectTCP(address, self.port, attempt, self.timeout)
+        if self._addresses and self.state == 'connecting':
+            self._next = self.reactor.callLater(self.attemptDelay, self._attempt)
+
+    def _attemptFailed(self, connector, reason):
+        if connector in self._attempts:
+            self._attempts.remove(connector)
+        if self.state != 'connecting':
+            return
+        if self._next is not None:
+            # Do not wait for the delay to try the next address.
+            self._next.cancel()
+            self._attempt()
+        elif not self._attempts:
+            self._failed(reason)
+
+    def _connected(self, connector):
+        self.state = 'connected'
+        self._attempts.remove(connector)
+        self._stop()
+
+    def _stop(self):
+        if self._next is not None:
+            self._next.cancel()
+            self._next = None
+        attempts, self._attempts = self._attempts, []
+        for connector in attempts:
+            if connector.state == 'connecting':
+                connector.stopConnecting()
+
+    def _failed(self, reason):
+        if self.state != 'connecting':
+            return
+        self.state = 'disconnected'
+        self.factory.clientConnectionFailed(self, reason)
+
+
+class _Attempt(ClientFactory):
+    """
+    The client factory of one connection attempt of a
+    L{HappyEyeballsConnector}, building the protocol of the real factory if
+    it connects first.
+    """
+
+    noisy = False
+    _connector = None
+    won = False
+
+    def __init__(self, eyeballs):
+        self.eyeballs = eyeballs
+
+    def startedConnecting(self, connector):
+        self._connector = connector
+        self.eyeballs._attempts.append(connector)
+
+    def buildProtocol(self, addr):
+        if self.eyeballs.state != 'connecting':
+            return _Dropped()
+        self.won = True
+        self.eyeballs._connected(self._connector)
+        return self.eyeballs.factory.buildProtocol(addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.eyeballs._attemptFailed(connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if not self.won:
+            return
+        self.eyeballs.state = 'disconnected'
+        self.eyeballs.factory.clientConnectionLost(self.eyeballs, reason)
+
+
+class _Dropped(Protocol):
+    """
+    The protocol of a connection made after another attempt won.
+    """
+
+    def connectionMade(self):
+        self.transport.loseConnection()
@@ -0,0 +1,132 @@
+'''
+Batched tracker scrapes with a TTL cache of the results.
+'''
+
+import time
+import logging
+from binascii import hexlify, unhexlify
+from urllib import quote
+from deluge.bencode import bdecode
+from twisted.internet import reactor
+from twisted.web import client
+
+log = logging.getLogger(__name__)
+
+
+class ScrapeCache(object):
+    """
+    Caches the seeders and leechers the tracker reports per info hash for ttl
+    seconds. Info hashes asked for which are not cached are collected and
+    scraped batch_size at a time with multi info_hash scrape requests, and
+    on_scrape is called with the info hash and result for each reply.
+    """
+
+    def __init__(self, url, on_scrape=None, ttl=600, batch_size=50, delay=1,
+                 headers=None, reactor=reactor):
+        """
+        url is the scrape URL, normally through the local proxy, and delay
+        the seconds to wait for more info hashes before scraping.
+        """
+        self.url = url
+        self.on_scrape = on_scrape
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.delay = delay
+        self.headers = headers or {}
+        self.reactor = reactor
+        self.results = {}
+        self.wanted = set()
+        self.in_flight = set()
+        self.scrape_call = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'requests': 0,
+            'errors': 0,
+            'scraped': 0,
+        }
+
+    def get(self, info_hash):
+        """
+        Returns a dict with the complete and incomplete counts of info_hash
+        if a fresh result is cached, otherwise schedules a scrape and
+        returns None.
+        """
+        result = self.results.get(info_hash)
+        if result is not None and time.time() - result['time'] < self.ttl:
+            self.stats['hits'] += 1
+            return result
+        self.stats['misses'] += 1
+        self.want(info_hash)
+        return None
+
+    def want(self, info_hash):
+        if info_hash in self.in_flight:
+            return
+        self.wanted.add(info_hash)
+        if self.scrape_call is None:
+            self.scrape_call = self.reactor.callLater(self.delay, self.scrape)
+
+    def update(self, info_hash, complete, incomplete):
+        """
+        Stores a scrape result.
+        """
+        result = {'complete': complete, 'incomplete': incomplete, 'time': time.time()}
+        self.results[info_hash] = result
+        return result
+
+    def scrape(self):
+        self.scrape_call = None
+        wanted = list(self.wanted)
+        self.wanted.clear()
+        for i in range(0, len(wanted), self.batch_size):
+            self.scrape_batch(wanted[i:i + self.batch_size])
+
+    def scrape_batch(self, info_hashes):
+        self.in_flight.update(info_hashes)
+        query = '&'.join('info_hash=%s' % quote(unhexlify(h), safe='') for h in info_hashes)
+        # Ensure that url does not contain unicode.
+        url = str('%s?%s' % (self.url, query))
+        self.stats['requests'] += 1
+        d = client.getPage(url, agent='Lobber Storage Node/2.0', headers=self.headers)
+        d.addCallback(self.scrape_done)
+        d.addErrback(self.scrape_error)
+        d.addBoth(self.scrape_finished, info_hashes)
+        return d
+
+    def scrape_done(self, body):
+        files = bdecode(body).get('files', {})
+        for binary_hash, info in files.iteritems():
+            info_hash = hexlify(binary_hash)
+            result = self.update(info_hash, info.get('complete', 0), info.get('incomplete', 0))
+            self.stats['scraped'] += 1
+            if self.on_scrape is not None:
+                self.on_scrape(info_hash, result)
+
+    def scrape_error(self, failure):
+        self.stats['errors'] += 1
+        log.error('Scrape failed: %s' % failure.getErrorMessage())
+
+    def scrape_finished(self, result, info_hashes):
+        self.in_flight.difference_update(info_hashes)
+
+    def expire(self):
+        """
+        Drops results older than the ttl.
+        """
+        cutoff = time.time() - self.ttl
+        for info_hash in [h for h, r in self.results.iteritems() if r['time'] < cutoff]:
+            del self.results[info_hash]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['cached'] = len(self.results)
+        stats['wanted'] = len(self.wanted)
+        stats['in_flight'] = len(self.in_flight)
+        return stats
+
+    def stop(self):
+        if self.scrape_call is not None:
+            self.scrape_call.cancel()
+            self.scrape_call = None
+        self.wanted.clear()
@@ -0,0 +1,196 @@
+'''
+The Lobber instances mirrored by the plugin, each with its own feed, tracker
+and key.
+'''
+
+import re
+import logging
+from urlparse import urlparse
+from urllib import splitnport
+
+log = logging.getLogger(__name__)
+
+# Name of the source made of the feed_url, tracker_host and lobber_key keys.
+DEFAULT_SOURCE = 'default'
+
+# Source names end up in proxy paths, cache directories and metric labels.
+SOURCE_NAME = re.compile('^[A-Za-z0-9_.-]+$')
+
+# Plugin wide settings a source may override.
+SOURCE_OPTIONS = ('add_concurrency', 'proxy_max_connections', 'proxy_connect_timeout',
+                  'proxy_first_byte_timeout', 'proxy_total_timeout', 'proxy_compress',
+                  'proxy_coalesce', 'cache_enabled', 'announce_rate')
+
+
+class Source(object):
+    """
+    A Lobber instance: its tracker and feed, the key sent to them, how
+    requests to the proxy are routed to it, and the feed and upstream state
+    kept for it.
+
+    Requests are routed to a source if their Host header is one of hosts,
+    or if their first path segment is the source's prefix. The plugin's own
+    requests, for the feed, torrent files and scrapes, use the prefix. The
+    source with an empty prefix gets the requests matching no route.
+
+    options overrides plugin wide settings in SOURCE_OPTIONS for the
+    source, such as its add concurrency or whether its responses are cached.
+    """
+
+    def __init__(self, name, tracker_host, feed_url='', lobber_key='',
+                 prefix='', hosts=(), feed_push_path='', options=None):
+        self.name = name
+        self.tracker_host = tracker_host
+        self.feed_url = feed_url
+        # Ensure that headers do not contain unicode.
+        self.lobber_key = str(lobber_key)
+        self.prefix = str(prefix).rstrip('/')
+        self.hosts = [str(host).lower() for host in hosts]
+        self.feed_push_path = feed_push_path
+        self.options = options or {}
+        parse_result = urlparse(tracker_host)
+        self.tls = parse_result.scheme == 'https'
+        self.port = parse_result.port
+        if not self.port:
+            if self.tls:
+                self.port = 443
+            else:
+                self.port = 80
+        self.host = splitnport(parse_result.netloc, parse_result.port)[0]
+        # Feed state
+        self.feed_etag = None
+        self.feed_last_modified = None
+        self.feed_cursor = None
+        self.feed_polls = 0
+        self.feed_added = 0
+        self.feed_delay = 0
+        self.fetch_json_call = None
+        self.fetching = False
+        # Set when the plugin stops. A fetch still running then must not
+        # poll again, the plugin polls a new Source once started again.
+        self.stopped = False
+        self.subscription = None
+        self.add_queue = None
+        self.scrape_cache = None
+        # Upstream state, set up by the proxy
+        self.pool = None
+        self.cache = None
+        self.single_flight = None
+        self.announces = None
+        self.breaker = None
+        self.route = None
+
+    def headers(self):
+        return {'X_LOBBER_KEY': self.lobber_key}
+
+    def option(self, config, key):
+        """
+        Returns the source's setting of key, or else the plugin wide one.
+        """
+        return self.options.get(key, config[key])
+
+    def get_feed_stats(self):
+        stats = {
+            'polls': self.feed_polls,
+            'added': self.feed_added,
+            'delay': self.feed_delay,
+        }
+        if self.subscription is not None:
+            stats['push'] = self.subscription.get_stats()
+        return stats
+
+
+class Sources(object):
+    """
+    The sources of the plugin, and which one each torrent came from.
+
+    Only torrents of sources other than the default one are remembered, so
+    a single source costs nothing per torrent. Torrents not seen in a feed
+    since the plugin started belong to the default source.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.default = sources[0]
+        for source in sources:
+            if not source.prefix:
+                self.default = source
+                break
+        self.torrents = {}
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def seen(self, info_hash, source):
+        """
+        Remembers that info_hash is a torrent of source.
+        """
+        if source is not self.default:
+            self.torrents[info_hash] = source
+        elif self.torrents:
+            self.torrents.pop(info_hash, None)
+
+    def source_of(self, info_hash):
+        return self.torrents.get(info_hash, self.default)
+
+    def get(self, info_hash):
+        """
+        Returns the cached scrape result of info_hash from the tracker of
+        its source, like L{ScrapeCache.get}.
+        """
+        return self.source_of(info_hash).scrape_cache.get(info_hash)
+
+    def get_stats(self, attribute, method='get_stats'):
+        """
+        Returns the stats of attribute of each source which has it, by
+        source name.
+        """
+        stats = {}
+        for source in self.sources:
+            component = getattr(source, attribute)
+            if component is not None:
+                stats[source.name] = getattr(component, method)()
+        return stats
+
+
+def load_sources(config):
+    """
+    Returns the Sources of the sources list of config, or the single source
+    of its feed_url, tracker_host and lobber_key if the list is empty.
+    Entries without a name or tracker, or whose name or prefix is taken, are
+    logged and left out.
+    """
+    if not config['sources']:
+        return Sources([Source(DEFAULT_SOURCE, config['tracker_host'],
+                               feed_url=config['feed_url'],
+                               lobber_key=config['lobber_key'],
+                               feed_push_path=config['feed_push_path'])])
+    sources = []
+    names = set()
+    prefixes = set()
+    for entry in config['sources']:
+        name = entry.get('name')
+        if not name or not SOURCE_NAME.match(name) or not entry.get('tracker_host'):
+            log.error('Source needs a name and a tracker_host: %r' % (entry,))
+            continue
+        prefix = entry.get('prefix', '/' + name)
+        if name in names or prefix.rstrip('/') in prefixes:
+            log.error('Source name or prefix already used: %r' % (entry,))
+            continue
+        source = Source(name, entry['tracker_host'],
+                        feed_url=entry.get('feed_url', ''),
+                        lobber_key=entry.get('lobber_key', ''),
+                        prefix=prefix,
+                        hosts=entry.get('hosts', ()),
+                        feed_push_path=entry.get('feed_push_path', ''),
+                        options=dict((key, entry[key]) for key in SOURCE_OPTIONS
+                                     if key in entry))
+        names.add(source.name)
+        prefixes.add(source.prefix)
+        sources.append(source)
+    if not sources:
+        raise ValueError('No usable source in the sources config.')
+    return Sources(sources)
@@ -0,0 +1,132 @@
+'''
+Persistent record of the torrents the plugin has seen, added and removed.
+'''
+
+import time
+import logging
+import sqlite3
+from twisted.internet import reactor
+from lobbercore.persist import WriteBehind
+
+log = logging.getLogger(__name__)
+
+KNOWN = 'known'
+ADDED = 'added'
+REMOVED = 'removed'
+
+
+class TorrentStore(object):
+    """
+    Keeps the state of every info hash the plugin has dealt with in an
+    SQLite database, with an in-memory index for constant time lookups, and
+    the storage root each torrent added was placed on.
+
+    Writes are batched: they are applied to the index at once and written to
+    the database in one transaction when flush_delay seconds have passed or
+    batch_size writes are pending, whichever comes first.
+    """
+
+    def __init__(self, path, flush_delay=5, batch_size=500, reactor=reactor):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS torrents ('
+                        'info_hash TEXT PRIMARY KEY, '
+                        'state TEXT NOT NULL, '
+                        'updated REAL NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS placements ('
+                        'info_hash TEXT PRIMARY KEY, '
+                        'path TEXT NOT NULL)')
+        self.db.commit()
+        self.index = dict(self.db.execute('SELECT info_hash, state FROM torrents'))
+        self.placements = dict(self.db.execute('SELECT info_hash, path FROM placements'))
+        self.pending = {}
+        self.pending_placements = {}
+        self.writer = WriteBehind(self.write, flush_delay, batch_size, reactor)
+
+    def __contains__(self, info_hash):
+        return info_hash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_state(self, info_hash):
+        return self.index.get(info_hash)
+
+    def is_removed(self, info_hash):
+        return self.index.get(info_hash) == REMOVED
+
+    def set_state(self, info_hash, state):
+        if self.index.get(info_hash) == state:
+            return
+        self.index[info_hash] = state
+        self.pending[info_hash] = (state, time.time())
+        self.writer.mark_dirty()
+
+    def seen(self, info_hash):
+        """
+        Records info_hash as known unless it already has a state.
+        """
+        if info_hash not in self.index:
+            self.set_state(info_hash, KNOWN)
+
+    def get_placement(self, info_hash):
+        return self.placements.get(info_hash)
+
+    def set_placement(self, info_hash, path):
+        if self.placements.get(info_hash) == path:
+            return
+        self.placements[info_hash] = path
+        self.pending_placements[info_hash] = path
+        self.writer.mark_dirty()
+
+    def flush(self):
+        self.writer.flush()
+
+    def write(self):
+        rows = [(h, state, updated) for h, (state, updated) in self.pending.iteritems()]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO torrents (info_hash, state, updated) '
+                                'VALUES (?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO placements (info_hash, path) '
+                                'VALUES (?, ?)', self.pending_placements.items())
+        self.pending = {}
+        self.pending_placements = {}
+        log.debug('Stored state of %d torrents.' % len(rows))
+
+    def expire(self, state, max_age):
+        """
+        Forgets torrents which have been in state for more than max_age seconds.
+        """
+        self.flush()
+        cutoff = time.time() - max_age
+        expired = self.db.execute('SELECT info_hash FROM torrents WHERE state = ? AND updated < ?',
+                                  (state, cutoff)).fetchall()
+        if expired:
+            self.db.execute('DELETE FROM torrents WHERE state = ? AND updated < ?', (state, cutoff))
+            self.db.executemany('DELETE FROM placements WHERE info_hash = ?', expired)
+            self.db.commit()
+            for (info_hash,) in expired:
+                del self.index[info_hash]
+                self.placements.pop(info_hash, None)
+            log.info('Expired %d %s torrents.' % (len(expired), state))
+        return len(expired)
+
+    def migrate(self, removed_torrents):
+        """
+        Imports the removed_torrents list the plugin config used to keep.
+        """
+        for info_hash in removed_torrents:
+            self.set_state(info_hash, REMOVED)
+        self.flush()
+
+    def get_stats(self):
+        stats = {KNOWN: 0, ADDED: 0, REMOVED: 0}
+        for state in self.index.itervalues():
+            stats[state] = stats.get(state, 0) + 1
+        stats['pending'] = len(self.pending)
+        stats['placements'] = len(self.placements)
+        stats['writes'] = self.writer.get_stats()
+        return stats
+
+    def close(self):
+        self.flush()
+        self.db.close()
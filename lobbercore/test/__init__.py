@@ -0,0 +1,3 @@
+'''
+Tests for the Lobber core plugin, run with trial.
+'''
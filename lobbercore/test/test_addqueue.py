@@ -0,0 +1,129 @@
+'''
+Tests for L{lobbercore.addqueue}.
+'''
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from lobbercore.addqueue import AddQueue, AddBatcher
+
+
+def entries(n):
+    return [{'info_hash': '%040x' % i} for i in range(n)]
+
+
+class AddQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.adds = {}
+        self.queue = AddQueue(self.add, concurrency=4, retry_delay=10, reactor=self.clock)
+
+    def add(self, torrent):
+        d = defer.Deferred()
+        self.adds[torrent['info_hash']] = d
+        return d
+
+    def test_concurrency(self):
+        """
+        At most concurrency adds are in flight, the next starting when one
+        is done.
+        """
+        for torrent in entries(10):
+            self.queue.put(torrent)
+        self.assertEqual(len(self.adds), 4)
+        self.adds['%040x' % 0].callback(True)
+        self.assertEqual(len(self.adds), 5)
+        self.assertEqual(self.queue.get_stats()['added'], 1)
+        self.assertEqual(self.queue.get_stats()['active'], 4)
+
+    def test_release(self):
+        """
+        An add which hands its slot back lets the next one start, and counts
+        as added when it is done.
+        """
+        for torrent in entries(10):
+            self.queue.put(torrent)
+        self.queue.release('%040x' % 0)
+        self.queue.release('%040x' % 0)
+        self.assertEqual(len(self.adds), 5)
+        self.adds['%040x' % 0].callback(True)
+        stats = self.queue.get_stats()
+        self.assertEqual((stats['added'], stats['active'], stats['released']), (1, 4, 0))
+        self.assertEqual(len(self.adds), 5)
+
+    def test_retry(self):
+        """
+        A failed add is retried after a backoff.
+        """
+        self.queue.put(entries(1)[0])
+        self.adds.pop('%040x' % 0).errback(ValueError('not found'))
+        self.assertEqual(self.queue.get_stats()['retrying'], 1)
+        self.clock.advance(15)
+        self.assertIn('%040x' % 0, self.adds)
+        self.assertEqual(self.queue.get_stats()['retried'], 1)
+
+
+class AddBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.added = []
+        self.saves = 0
+        self.batcher = AddBatcher(self.add, self.save, batch_size=50, delay=1,
+                                  reactor=self.clock)
+
+    def add(self, torrent):
+        self.added.append(torrent['info_hash'])
+        return torrent['info_hash']
+
+    def save(self):
+        self.saves += 1
+
+    def test_batchSize(self):
+        """
+        A full batch is added at once, with one save.
+        """
+        results = []
+        for torrent in entries(50):
+            self.batcher.put(torrent).addCallback(results.append)
+        self.assertEqual((len(self.added), self.saves), (50, 1))
+        self.assertEqual(results, [torrent['info_hash'] for torrent in entries(50)])
+
+    def test_delay(self):
+        """
+        A batch which does not fill up is added delay seconds after its
+        first torrent.
+        """
+        self.batcher.put(entries(1)[0])
+        self.clock.advance(0.5)
+        self.assertEqual(self.added, [])
+        self.clock.advance(0.5)
+        self.assertEqual((len(self.added), self.saves), (1, 1))
+
+    def test_failedAdd(self):
+        """
+        An add which raises fails its Deferred only.
+        """
+        failures = []
+        self.batcher.put({}).addErrback(failures.append)
+        self.batcher.put(entries(1)[0])
+        self.clock.advance(1)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual((self.added, self.saves), (['%040x' % 0], 1))
+
+    def test_queueThroughput(self):
+        """
+        Adds which release their queue slot once handed to the batcher fill
+        whole batches instead of batches of the queue's concurrency.
+        """
+        def add(torrent):
+            d = self.batcher.put(torrent)
+            queue.release(torrent['info_hash'])
+            return d
+        queue = AddQueue(add, concurrency=4, reactor=self.clock)
+        for torrent in entries(200):
+            queue.put(torrent)
+        self.assertEqual(self.batcher.get_stats()['batches'], 4)
+        self.assertEqual(queue.get_stats()['added'], 200)
+        self.assertEqual(self.saves, 4)
@@ -0,0 +1,84 @@
+'''
+Tests for L{lobbercore.admission}.
+'''
+
+import os
+from twisted.internet import defer
+from twisted.trial import unittest
+from lobbercore.admission import Admission
+
+
+class FakeStatvfs(object):
+    """
+    A volume of total bytes, of which used are used.
+    """
+
+    def __init__(self, total, used):
+        self.total = total
+        self.used = used
+
+    def __call__(self, path):
+        return self
+
+    f_frsize = 1
+
+    @property
+    def f_blocks(self):
+        return self.total
+
+    @property
+    def f_bavail(self):
+        return self.total - self.used
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = FakeStatvfs(1000, 500)
+        path = self.mktemp()
+        os.makedirs(path)
+        self.admission = Admission(path, high_water=0.9, statvfs=self.volume)
+
+    def test_admitted(self):
+        """
+        A torrent which fits under the high water mark is admitted at once
+        and its size reserved.
+        """
+        admitted = []
+        self.admission.admit('a', 300).addCallback(admitted.append)
+        self.assertEqual(admitted, [None])
+        self.assertEqual(self.admission.reserved, 300)
+
+    def test_held(self):
+        """
+        Torrents which do not fit wait, and are admitted in order once space
+        is freed.
+        """
+        admitted = []
+        self.admission.admit('a', 300)
+        self.admission.admit('b', 300).addCallback(lambda _: admitted.append('b'))
+        self.admission.admit('c', 10).addCallback(lambda _: admitted.append('c'))
+        self.assertEqual(admitted, [])
+        self.admission.release('a')
+        self.admission.check()
+        self.assertEqual(admitted, ['b', 'c'])
+        self.assertEqual(self.admission.get_stats()['waited'], 2)
+
+    def test_tooLarge(self):
+        """
+        A torrent larger than the volume's high water mark fails at once.
+        """
+        d = self.admission.admit('a', 950)
+        self.assertFailure(d, ValueError)
+        return d
+
+    def test_stop(self):
+        """
+        Stopping fails the adds of the waiting torrents.
+        """
+        self.admission.admit('a', 400)
+        d = self.admission.admit('b', 300)
+        self.admission.stop()
+        self.assertEqual(self.admission.get_stats()['waiting'], 0)
+        self.assertFailure(d, defer.CancelledError)
+        return d
@@ -0,0 +1,194 @@
+'''
+Tests for L{lobbercore.announce}.
+'''
+
+from twisted.internet import task
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from lobbercore.announce import AnnounceScheduler
+
+
+
+class AnnounceSchedulerTests(unittest.TestCase):
+    """
+    Tests for the token bucket of L{AnnounceScheduler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = AnnounceScheduler(rate=2, burst=3, maxQueue=2,
+                                           maxWait=10, reactor=self.clock)
+        self.sent = []
+
+    def announce(self, event=None):
+        """
+        Schedule an announce and return its request.
+        """
+        request = DummyRequest([])
+        self.scheduler.schedule(request, 'a' * 20, event,
+                                lambda: self.sent.append(request))
+        return request
+
+    def test_burst(self):
+        """
+        Announces are sent at once while the bucket has tokens, then wait for
+        the tokens refilled at C{rate} a second.
+        """
+        requests = [self.announce() for i in range(5)]
+        self.assertEqual(self.sent, requests[:3])
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, requests[:4])
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, requests)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_refill(self):
+        """
+        The bucket is refilled in proportion to the time passed, up to
+        C{burst} tokens.
+        """
+        for i in range(3):
+            self.announce()
+        self.assertEqual(self.scheduler.getStats()['tokens'], 0)
+        self.clock.advance(1)
+        self.assertEqual(self.scheduler.getStats()['tokens'], 2)
+        self.clock.advance(100)
+        self.assertEqual(self.scheduler.getStats()['tokens'], 3)
+        for i in range(4):
+            self.announce()
+        self.assertEqual(len(self.sent), 6)
+        self.assertEqual(self.scheduler.getStats()['queued'], 1)
+
+    def test_overflow(self):
+        """
+        An announce finding C{maxQueue} announces waiting is answered with
+        a 503 telling when to try again.
+        """
+        for i in range(5):
+            self.announce()
+        request = self.announce()
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.outgoingHeaders['retry-after'], '2')
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(len(self.sent), 3)
+
+    def test_maxWait(self):
+        """
+        An announce which has waited C{maxWait} seconds for a token is
+        answered with a 503.
+        """
+        self.scheduler.rate = 0.05
+        for i in range(3):
+            self.announce()
+        request = self.announce()
+        self.clock.advance(10)
+        self.assertEqual(request.responseCode, 503)
+        self.assertNotIn(request, self.sent)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancelled(self):
+        """
+        An announce whose client went away while it waited takes no token.
+        """
+        for i in range(3):
+            self.announce()
+        gone = self.announce()
+        waiting = self.announce()
+        gone.processingFailed(Failure(Exception('Connection lost')))
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent[3:], [waiting])
+
+    def test_stop(self):
+        """
+        Stopping answers the waiting announces with a 503.
+        """
+        for i in range(3):
+            self.announce()
+        request = self.announce()
+        self.scheduler.stop()
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class SpreadWindowTests(unittest.TestCase):
+    """
+    Tests for the spreading of startup announces of L{AnnounceScheduler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = AnnounceScheduler(rate=100, burst=100,
+                                           spreadWindow=100,
+                                           reactor=self.clock)
+        self.sent = []
+
+    def infoHash(self, low, high):
+        """
+        Return an info hash whose slot is between C{low} and C{high}
+        seconds into the window.
+        """
+        for i in range(1000):
+            infoHash = '%020d' % i
+            if low <= self.scheduler._slot(infoHash) < high:
+                return infoHash
+
+    def announce(self, infoHash, event=None):
+        request = DummyRequest([])
+        self.scheduler.schedule(request, infoHash, event,
+                                lambda: self.sent.append(request))
+        return request
+
+    def test_deferred(self):
+        """
+        A startup announce before the slot of its torrent is answered
+        without contacting the tracker, with an interval reaching the slot.
+        """
+        infoHash = self.infoHash(50, 60)
+        self.clock.advance(10)
+        request = self.announce(infoHash)
+        self.assertEqual(self.sent, [])
+        interval = int(self.scheduler._slot(infoHash) - 10) + 1
+        self.assertEqual(''.join(request.written),
+                         'd8:intervali%de12:min intervali%de5:peers0:e'
+                         % (interval, interval))
+        self.assertEqual(request.finished, 1)
+
+    def test_slot(self):
+        """
+        An announce at or after the slot of its torrent is sent.
+        """
+        infoHash = self.infoHash(50, 60)
+        self.clock.advance(self.scheduler._slot(infoHash))
+        request = self.announce(infoHash)
+        self.assertEqual(self.sent, [request])
+
+    def test_spread(self):
+        """
+        The slots of many torrents are spread over the whole window.
+        """
+        slots = [self.scheduler._slot('%020d' % i) for i in range(1000)]
+        self.assertTrue(0 <= min(slots) < 1)
+        self.assertTrue(99 < max(slots) < 100)
+        for start in range(0, 100, 10):
+            inWindow = [s for s in slots if start <= s < start + 10]
+            self.assertTrue(50 < len(inWindow) < 150)
+
+    def test_events(self):
+        """
+        Stopped and completed announces are sent at once.
+        """
+        infoHash = self.infoHash(50, 60)
+        for event in ('stopped', 'completed'):
+            self.announce(infoHash, event)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_afterWindow(self):
+        """
+        Announces after the window are sent at once.
+        """
+        infoHash = self.infoHash(90, 100)
+        self.clock.advance(100)
+        request = self.announce(infoHash, 'started')
+        self.assertEqual(self.sent, [request])
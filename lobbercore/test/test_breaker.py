@@ -0,0 +1,77 @@
+'''
+Tests for L{lobbercore.breaker}.
+'''
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from lobbercore.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    """
+    Tests for L{CircuitBreaker}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker('tracker', failureThreshold=3, resetTimeout=30,
+                                      reactor=self.clock)
+
+    def open(self):
+        for i in range(3):
+            self.breaker.failure()
+
+    def test_opens(self):
+        """
+        The circuit opens after C{failureThreshold} failures in a row, and
+        refuses requests while it is open.
+        """
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.open()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retryAfter(), 30)
+        self.assertEqual(self.breaker.getStats()['rejected'], 1)
+
+    def test_probe(self):
+        """
+        After C{resetTimeout} seconds one request at a time is let through,
+        and the circuit closes when it succeeds.
+        """
+        self.open()
+        self.clock.advance(30)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_probeFails(self):
+        """
+        A failed probe opens the circuit for another C{resetTimeout}.
+        """
+        self.open()
+        self.clock.advance(30)
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.clock.advance(29)
+        self.assertFalse(self.breaker.allow())
+
+    def test_lostProbe(self):
+        """
+        A probe which has not reported back after C{resetTimeout} seconds is
+        replaced.
+        """
+        self.open()
+        self.clock.advance(30)
+        self.breaker.allow()
+        self.clock.advance(30)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.getStats()['probes'], 2)
@@ -0,0 +1,136 @@
+'''
+Tests for L{lobbercore.cache}.
+'''
+
+import time
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from lobbercore.cache import HTTPCache
+
+KEY = '/torrent/feed.json'
+BODY = '[{"id": 1}]'
+
+
+class FakeUpstream(object):
+    """
+    Answers the requests the cache fetches with C{code}, and the body and
+    etag of the current version of the resource.
+    """
+
+    def __init__(self, code=200, etag='"v1"'):
+        self.code = code
+        self.etag = etag
+        self.fetched = []
+
+    def __call__(self, headers, father):
+        self.fetched.append(headers)
+        if headers.get('if-none-match') == self.etag:
+            father.setResponseCode(304)
+        else:
+            father.setResponseCode(self.code)
+            father.responseHeaders.setRawHeaders('etag', [self.etag])
+            father.responseHeaders.setRawHeaders('content-length', [str(len(BODY))])
+            father.write(BODY)
+        father.finish()
+
+
+
+class HTTPCacheTests(unittest.TestCase):
+    """
+    Tests for L{HTTPCache}.
+    """
+
+    def setUp(self):
+        self.cache = HTTPCache([['^/torrent/.*\\.json$', 60, 300]], 1024 * 1024)
+        self.upstream = FakeUpstream()
+
+    def render(self, etag=None):
+        request = DummyRequest([])
+        if etag is not None:
+            request.headers['if-none-match'] = etag
+        self.cache.render(request, KEY, {}, self.upstream)
+        return request
+
+    def expire(self, age):
+        self.cache.get(KEY).stored -= age
+
+    def test_miss(self):
+        """
+        A response missing from the cache is fetched and stored.
+        """
+        request = self.render()
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(self.cache.get(KEY).getHeader('etag'), '"v1"')
+
+    def test_freshConditional(self):
+        """
+        A fresh entry answers a request with its etag with a 304, without
+        contacting the upstream server.
+        """
+        self.render()
+        request = self.render('"v1"')
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(request.written, [])
+        self.assertEqual(len(self.upstream.fetched), 1)
+
+    def test_staleRevalidatedInBackground(self):
+        """
+        A stale entry is served, and revalidated in the background.
+        """
+        self.render()
+        self.expire(100)
+        request = self.render()
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(self.upstream.fetched[-1]['if-none-match'], '"v1"')
+        self.assertEqual(self.cache.getStats()['not_modified'], 1)
+        self.assertTrue(time.time() - self.cache.get(KEY).stored < 60)
+
+    def test_expiredNotModified(self):
+        """
+        An expired entry the upstream server answers a revalidation of with
+        a 304 is refreshed and served in full to clients without it.
+        """
+        self.render()
+        self.expire(1000)
+        request = self.render()
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(request.outgoingHeaders['content-length'], str(len(BODY)))
+        self.assertEqual(self.cache.getStats()['not_modified'], 1)
+
+    def test_expiredNotModifiedConditional(self):
+        """
+        An expired entry the upstream server answers a revalidation of with
+        a 304 answers a client which has it already with a 304.
+        """
+        self.render()
+        self.expire(1000)
+        request = self.render('"v1"')
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(request.written, [])
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(self.upstream.fetched[-1]['if-none-match'], '"v1"')
+
+    def test_expiredModified(self):
+        """
+        An expired entry which has changed upstream is replaced, and the new
+        version sent to a client with the old one.
+        """
+        self.render()
+        self.expire(1000)
+        self.upstream.etag = '"v2"'
+        request = self.render('"v1"')
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(self.cache.get(KEY).getHeader('etag'), '"v2"')
+
+    def test_uncachedPath(self):
+        """
+        Paths no rule covers are fetched with the request's own headers.
+        """
+        request = DummyRequest([])
+        self.cache.render(request, '/tracker/announce', {'if-none-match': '"v1"'},
+                          self.upstream)
+        self.assertEqual(self.upstream.fetched, [{'if-none-match': '"v1"'}])
+        self.assertEqual(self.cache.get('/tracker/announce'), None)
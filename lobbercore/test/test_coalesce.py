@@ -0,0 +1,211 @@
+'''
+Tests for L{lobbercore.coalesce}.
+'''
+
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from lobbercore.coalesce import SingleFlight
+from lobbercore.proxy import ProxyRoute, gatewayError
+from lobbercore.test.test_proxy import LocalRequest, FakePool
+
+BODY = '[{"id": 1}]'
+
+
+class RecordingProducer(object):
+    """
+    The upstream side of a flight, recording whether it is paused.
+    """
+
+    paused = False
+    stopped = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+
+class SingleFlightTests(unittest.TestCase):
+    """
+    Tests for L{SingleFlight} and L{Flight}.
+    """
+
+    def setUp(self):
+        self.singleFlight = SingleFlight(maxReplay=10)
+        self.key = self.singleFlight.key('/feed.json', {}, None)
+
+    def join(self, key=None):
+        """
+        Join the flight of C{key} with a new request and return the request
+        and the flight if it started one.
+        """
+        request = LocalRequest('/feed.json')
+        flight = self.singleFlight.join(key or self.key, request)
+        return request, flight
+
+    def respond(self, flight, body=BODY):
+        flight.setResponseCode(200)
+        flight.setHeader('content-type', 'application/json')
+        flight.write(body)
+        flight.finish()
+
+    def test_coalesced(self):
+        """
+        Identical requests in flight get the one upstream response.
+        """
+        first, flight = self.join()
+        requests = [first] + [self.join()[0] for i in range(3)]
+        self.assertEqual(self.singleFlight.getStats()['in_flight'], 1)
+        self.respond(flight)
+        for request in requests:
+            self.assertEqual(request.responseCode, 200)
+            self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                             ['application/json'])
+            self.assertEqual(''.join(request.written), BODY)
+            self.assertEqual(request.finished, 1)
+        self.assertEqual(self.singleFlight.getStats()['in_flight'], 0)
+
+    def test_key(self):
+        """
+        Requests differing in their query, Accept-Encoding, conditional or
+        key headers are not coalesced.
+        """
+        key = self.singleFlight.key
+        keys = set([key('/feed.json', {}, None),
+                    key('/feed.json?since=1', {}, None),
+                    key('/feed.json', {}, 'gzip'),
+                    key('/feed.json', {'if-none-match': '"v1"'}, None),
+                    key('/feed.json', {'authorization': 'Basic eA=='}, None)])
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(key('/feed.json', {'user-agent': 'x'}, None),
+                         key('/feed.json', {}, None))
+        for k in keys:
+            self.assertNotIdentical(self.join(k)[1], None)
+
+    def test_error(self):
+        """
+        An error answering the flight reaches every request in it.
+        """
+        first, flight = self.join()
+        second, _ = self.join()
+        gatewayError(flight, 504, 'Upstream did not answer in time')
+        for request in (first, second):
+            self.assertEqual(request.responseCode, 504)
+            self.assertEqual(''.join(request.written), 'Upstream did not answer in time')
+            self.assertEqual(request.finished, 1)
+
+    def test_lateJoiner(self):
+        """
+        A request arriving after the response has started is sent the body
+        relayed so far.
+        """
+        first, flight = self.join()
+        flight.setResponseCode(200)
+        flight.write(BODY[:4])
+        late, joined = self.join()
+        self.assertIdentical(joined, None)
+        self.assertEqual(late.written, [BODY[:4]])
+        flight.write(BODY[4:])
+        flight.finish()
+        self.assertEqual(''.join(late.written), BODY)
+        self.assertEqual(late.responseCode, 200)
+
+    def test_maxReplay(self):
+        """
+        A request arriving after more than C{maxReplay} bytes of the body
+        have been relayed starts a flight of its own.
+        """
+        first, flight = self.join()
+        flight.write(BODY)
+        late, second = self.join()
+        self.assertNotIdentical(second, None)
+        self.respond(second)
+        flight.finish()
+        self.assertEqual(''.join(first.written), BODY)
+        self.assertEqual(''.join(late.written), BODY)
+
+    def test_afterLanding(self):
+        """
+        A request arriving after the response is complete starts a new
+        flight, and the landed one is not affected by it.
+        """
+        first, flight = self.join()
+        self.respond(flight)
+        late, second = self.join()
+        self.assertNotIdentical(second, None)
+        self.assertNotIdentical(second, flight)
+        self.assertEqual(late.written, [])
+        self.respond(second, '[]')
+        self.assertEqual(''.join(late.written), '[]')
+        self.assertEqual(''.join(first.written), BODY)
+        self.assertEqual(first.finished, 1)
+
+    def test_lost(self):
+        """
+        A request going away leaves the others in the flight. When all are
+        gone the upstream response is dropped.
+        """
+        first, flight = self.join()
+        second, _ = self.join()
+        producer = RecordingProducer()
+        flight.registerProducer(producer, True)
+        finished = flight.notifyFinish()
+        lost = []
+        finished.addErrback(lost.append)
+        first.processingFailed(Failure(ConnectionDone()))
+        self.assertFalse(producer.stopped)
+        second.processingFailed(Failure(ConnectionDone()))
+        self.assertTrue(producer.stopped)
+        self.assertEqual(len(lost), 1)
+        self.assertNotIdentical(self.join()[1], None)
+
+    def test_paused(self):
+        """
+        The upstream server is paused while any request is slow to read.
+        """
+        first, flight = self.join()
+        second, _ = self.join()
+        producer = RecordingProducer()
+        flight.registerProducer(producer, True)
+        first.producer.pauseProducing()
+        second.producer.pauseProducing()
+        first.producer.resumeProducing()
+        self.assertTrue(producer.paused)
+        second.producer.resumeProducing()
+        self.assertFalse(producer.paused)
+
+
+
+class CoalescedRouteTests(unittest.TestCase):
+    """
+    Tests for L{ProxyRoute} with a L{SingleFlight}.
+    """
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.route = ProxyRoute('tracker.example', 80, pool=self.pool,
+                                singleFlight=SingleFlight())
+
+    def render(self, uri, **kwargs):
+        request = LocalRequest(uri, **kwargs)
+        self.route.render(request, request.path)
+        return request
+
+    def test_coalesced(self):
+        """
+        Identical GETs are sent upstream once, others are each sent.
+        """
+        requests = [self.render('/feed.json') for i in range(3)]
+        self.render('/feed.json', method='POST')
+        self.render('/feed.json', headers={'accept-encoding': 'gzip'})
+        self.assertEqual(len(self.pool.requests), 3)
+        flight = self.pool.requests[0].father
+        gatewayError(flight, 502, 'Could not connect upstream')
+        for request in requests:
+            self.assertEqual(request.responseCode, 502)
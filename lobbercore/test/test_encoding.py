@@ -0,0 +1,141 @@
+'''
+Tests for L{lobbercore.encoding}.
+'''
+
+import zlib
+from twisted.trial import unittest
+from lobbercore.encoding import acceptsEncoding, StreamDecoder
+
+BODY = ''.join('{"id": %d, "info_hash": "%040x"}, ' % (i, i * 7919)
+               for i in range(200))
+
+
+def compress(wbits):
+    """
+    Return C{BODY} compressed into a stream with the zlib C{wbits}: gzip,
+    zlib wrapped or raw deflate.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(BODY) + compressor.flush()
+
+GZIP = compress(16 + zlib.MAX_WBITS)
+ZLIB = compress(zlib.MAX_WBITS)
+RAW = compress(-zlib.MAX_WBITS)
+
+
+
+class AcceptsEncodingTests(unittest.TestCase):
+    """
+    Tests for L{acceptsEncoding}.
+    """
+
+    def test_missing(self):
+        """
+        A missing header accepts no encoding.
+        """
+        self.assertFalse(acceptsEncoding(None, 'gzip'))
+        self.assertFalse(acceptsEncoding('', 'gzip'))
+
+    def test_listed(self):
+        """
+        Encodings listed are accepted, under any of their names.
+        """
+        self.assertTrue(acceptsEncoding('gzip, deflate', 'deflate'))
+        self.assertTrue(acceptsEncoding('X-GZIP', 'gzip'))
+        self.assertFalse(acceptsEncoding('deflate', 'gzip'))
+
+    def test_quality(self):
+        """
+        An encoding with a quality of 0 is refused, also through C{*}.
+        """
+        self.assertFalse(acceptsEncoding('gzip;q=0, deflate', 'gzip'))
+        self.assertTrue(acceptsEncoding('gzip; q=0.5', 'gzip'))
+        self.assertFalse(acceptsEncoding('gzip;q=bad', 'gzip'))
+        self.assertTrue(acceptsEncoding('*', 'gzip'))
+        self.assertFalse(acceptsEncoding('*, gzip;q=0', 'gzip'))
+
+
+
+class StreamDecoderTests(unittest.TestCase):
+    """
+    Tests for L{StreamDecoder}.
+    """
+
+    def decode(self, encoding, chunks):
+        """
+        Decode C{chunks} and return the decoded body and the decoder.
+        """
+        decoder = StreamDecoder(encoding)
+        parts = [decoder.decode(chunk) for chunk in chunks]
+        parts.append(decoder.flush())
+        return ''.join(parts), decoder
+
+    def split(self, data, size):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_gzip(self):
+        """
+        A gzip body is decoded, whole or split anywhere.
+        """
+        for size in (len(GZIP), 1000, 7, 1):
+            body, decoder = self.decode('gzip', self.split(GZIP, size))
+            self.assertEqual(body, BODY)
+            self.assertEqual(decoder.decoded, len(BODY))
+
+    def test_zlibDeflate(self):
+        """
+        A zlib wrapped deflate body is decoded, whole or split anywhere.
+        """
+        for size in (len(ZLIB), 1000, 7, 1):
+            body, decoder = self.decode('deflate', self.split(ZLIB, size))
+            self.assertEqual(body, BODY)
+
+    def test_rawDeflate(self):
+        """
+        A raw deflate body is decoded, whole or split anywhere.
+        """
+        for size in (len(RAW), 1000, 7, 2):
+            body, decoder = self.decode('deflate', self.split(RAW, size))
+            self.assertEqual(body, BODY)
+            self.assertEqual(decoder.decoded, len(BODY))
+
+    def test_splitHeader(self):
+        """
+        Whether a deflate body is zlib wrapped is only decided once two
+        bytes are in, whatever the size of the first parts.
+        """
+        for data in (ZLIB, RAW):
+            chunks = ['', data[:1], '', data[1:2], data[2:3], data[3:]]
+            body, decoder = self.decode('deflate', chunks)
+            self.assertEqual(body, BODY)
+            body, decoder = self.decode('deflate', self.split(data, 1))
+            self.assertEqual(body, BODY)
+
+    def test_truncated(self):
+        """
+        A truncated body decodes as far as it goes.
+        """
+        for encoding, data in (('gzip', GZIP), ('deflate', ZLIB),
+                               ('deflate', RAW)):
+            body, decoder = self.decode(encoding, self.split(data[:len(data) // 2], 100))
+            self.assertTrue(0 < len(body) < len(BODY))
+            self.assertTrue(BODY.startswith(body))
+            self.assertEqual(decoder.decoded, len(body))
+
+    def test_truncatedHeader(self):
+        """
+        A deflate body ending within its first two bytes is decoded at the
+        end.
+        """
+        decoder = StreamDecoder('deflate')
+        self.assertEqual(decoder.decode(ZLIB[:1]), '')
+        self.assertEqual(decoder.flush(), '')
+
+    def test_corrupt(self):
+        """
+        A body which is not validly encoded raises L{zlib.error}.
+        """
+        decoder = StreamDecoder('gzip')
+        self.assertRaises(zlib.error, decoder.decode, 'not gzip at all')
+        decoder = StreamDecoder('deflate')
+        self.assertRaises(zlib.error, decoder.decode, '\xff' * 20)
@@ -0,0 +1,147 @@
+'''
+Tests for L{lobbercore.feed}.
+'''
+
+import json
+from twisted.trial import unittest
+from lobbercore.feed import FeedParser, FeedFile
+
+ENTRIES = [
+    {'id': 1, 'info_hash': 'a' * 40, 'size': 1024},
+    {'id': 2, 'label': u'r\xe4ksm\xf6rg\xe5s \u2603'},
+    {'id': 3, 'tags': [1, 2.5, None, True]},
+    42,
+]
+
+FEED = json.dumps(ENTRIES, ensure_ascii=False).encode('utf-8')
+
+
+
+class FeedParserTests(unittest.TestCase):
+    """
+    Tests for L{FeedParser}.
+    """
+
+    def setUp(self):
+        self.entries = []
+        self.parser = FeedParser(self.entries.append)
+
+    def feed(self, chunks):
+        for chunk in chunks:
+            self.parser.dataReceived(chunk)
+        self.parser.close()
+
+    def test_whole(self):
+        """
+        A feed read at once gives all of its entries.
+        """
+        self.feed([FEED])
+        self.assertEqual(self.entries, ENTRIES)
+        self.assertEqual(self.parser.count, len(ENTRIES))
+
+    def test_empty(self):
+        """
+        An empty array gives no entries.
+        """
+        self.feed([' [ ', ' ] '])
+        self.assertEqual(self.entries, [])
+
+    def test_split(self):
+        """
+        Entries split across chunks at any point, including inside multibyte
+        UTF-8 characters, are read as soon as they are complete.
+        """
+        for size in (1, 2, 3, 7):
+            del self.entries[:]
+            self.parser = FeedParser(self.entries.append)
+            self.feed([FEED[i:i + size] for i in range(0, len(FEED), size)])
+            self.assertEqual(self.entries, ENTRIES)
+
+    def test_incremental(self):
+        """
+        An entry is passed on when the chunk completing it is read, before
+        the feed ends.
+        """
+        self.parser.dataReceived('[{"id": 1}, {"id"')
+        self.assertEqual(self.entries, [{'id': 1}])
+        self.parser.dataReceived(': 2}')
+        self.assertEqual(self.entries, [{'id': 1}, {'id': 2}])
+
+    def test_number(self):
+        """
+        A number at the end of a chunk is not read until the chunk after it
+        shows where it ends.
+        """
+        self.parser.dataReceived('[12')
+        self.assertEqual(self.entries, [])
+        self.parser.dataReceived('34]')
+        self.parser.close()
+        self.assertEqual(self.entries, [1234])
+
+    def test_notArray(self):
+        """
+        A feed which is not an array is refused.
+        """
+        self.assertRaises(ValueError, self.parser.dataReceived, '{"id": 1}')
+
+    def test_missingSeparator(self):
+        """
+        Entries not separated by commas are refused.
+        """
+        self.assertRaises(ValueError, self.parser.dataReceived, '[1 2]')
+
+    def test_trailingGarbage(self):
+        """
+        Data after the end of the array is refused, even when it arrives in
+        a later chunk, and the entries before it have been read.
+        """
+        self.parser.dataReceived('[1, 2] \n')
+        self.assertRaises(ValueError, self.parser.dataReceived, 'x')
+        self.assertEqual(self.entries, [1, 2])
+        parser = FeedParser(self.entries.append)
+        self.assertRaises(ValueError, parser.dataReceived, '[]]')
+
+    def test_incomplete(self):
+        """
+        A feed ending before its array does is refused when closed.
+        """
+        self.parser.dataReceived('[1, {"id": 2')
+        self.assertRaises(ValueError, self.parser.close)
+        self.assertEqual(self.entries, [1])
+
+    def test_maxEntrySize(self):
+        """
+        An unfinished entry growing past C{maxEntrySize} is refused.
+        """
+        self.parser.maxEntrySize = 10
+        self.parser.dataReceived('[{"id": "')
+        self.assertRaises(ValueError, self.parser.dataReceived, 'x' * 20)
+
+
+
+class FeedFileTests(unittest.TestCase):
+    """
+    Tests for L{FeedFile}.
+    """
+
+    def test_error(self):
+        """
+        The first error of the parser is kept and what is written after it
+        is dropped.
+        """
+        entries = []
+        feed = FeedFile(FeedParser(entries.append))
+        feed.write('[1, 2 3')
+        feed.write(', 4]')
+        feed.close()
+        self.assertIsInstance(feed.error, ValueError)
+        self.assertEqual(entries, [1, 2])
+
+    def test_incomplete(self):
+        """
+        A feed ending early leaves the error of the parser's close.
+        """
+        feed = FeedFile(FeedParser(lambda entry: None))
+        feed.write('[1, ')
+        feed.close()
+        self.assertIsInstance(feed.error, ValueError)
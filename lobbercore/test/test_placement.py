@@ -0,0 +1,173 @@
+'''
+Tests for L{lobbercore.placement}.
+'''
+
+from twisted.internet import task
+from twisted.trial import unittest
+from lobbercore.placement import Placement, Volume, load_volumes
+from lobbercore.placement import MOST_FREE, FEWEST_ACTIVE, WEIGHTED_ROUND_ROBIN
+from lobbercore.store import TorrentStore
+from lobbercore.test.test_admission import FakeStatvfs
+
+
+def status(save_path, is_finished=False):
+    return {'save_path': save_path, 'is_finished': is_finished,
+            'total_wanted': 100, 'total_done': 0}
+
+
+
+class PlacementTests(unittest.TestCase):
+    """
+    Tests for L{Placement}.
+    """
+
+    def setUp(self):
+        self.store = TorrentStore(self.mktemp(), reactor=task.Clock())
+        self.disks = [FakeStatvfs(1000, 100), FakeStatvfs(1000, 500),
+                      FakeStatvfs(1000, 300)]
+        self.volumes = [Volume('/data/%d' % i, weight=i + 1, statvfs=disk)
+                        for i, disk in enumerate(self.disks)]
+
+    def tearDown(self):
+        self.store.db.close()
+
+    def placement(self, policy):
+        return Placement(self.volumes, self.store, policy)
+
+    def paths(self, placement, sizes):
+        """
+        Place a torrent of each of C{sizes} and return the paths of the
+        volumes they were placed on.
+        """
+        return [placement.place('%040d' % i, size).path for i, size in enumerate(sizes)]
+
+    def test_unknownPolicy(self):
+        """
+        An unknown policy raises L{ValueError}.
+        """
+        self.assertRaises(ValueError, self.placement, 'random')
+
+    def test_mostFree(self):
+        """
+        most_free places a torrent on the volume with the most space left
+        to admit, counting the space reserved.
+        """
+        placement = self.placement(MOST_FREE)
+        self.assertEqual(self.paths(placement, [10]), ['/data/0'])
+        self.volumes[0].admission.reserve('a', 500)
+        self.assertEqual(placement.place('b', 10).path, '/data/2')
+
+    def test_fewestActive(self):
+        """
+        fewest_active places a torrent on the volume with the fewest active
+        torrents, counting the torrents added since.
+        """
+        placement = self.placement(FEWEST_ACTIVE)
+        placement.track({'a': status('/data/0'), 'b': status('/data/0/b'),
+                         'c': status('/data/1')})
+        self.assertEqual([volume.active for volume in self.volumes], [2, 1, 0])
+        paths = []
+        for info_hash in 'defg':
+            paths.append(placement.place(info_hash, 10).path)
+            placement.added(info_hash)
+        self.assertEqual(paths, ['/data/2', '/data/1', '/data/2', '/data/0'])
+
+    def test_weightedRoundRobin(self):
+        """
+        weighted_round_robin takes turns in proportion to the weights,
+        evenly spread.
+        """
+        placement = self.placement(WEIGHTED_ROUND_ROBIN)
+        paths = self.paths(placement, [10] * 6)
+        self.assertEqual(paths, ['/data/2', '/data/1', '/data/0',
+                                 '/data/2', '/data/1', '/data/2'])
+
+    def test_fits(self):
+        """
+        Volumes a torrent fits on are preferred, whatever the policy, and
+        all are candidates if it fits on none.
+        """
+        for policy in (FEWEST_ACTIVE, WEIGHTED_ROUND_ROBIN):
+            placement = self.placement(policy)
+            self.assertEqual(self.paths(placement, [700, 700]), ['/data/0', '/data/0'])
+        placement = self.placement(MOST_FREE)
+        self.assertEqual(placement.place('a', 5000).path, '/data/0')
+
+    def test_sticky(self):
+        """
+        A torrent placed again goes to the volume it was placed on.
+        """
+        placement = self.placement(WEIGHTED_ROUND_ROBIN)
+        first = placement.place('a', 10)
+        for i in range(3):
+            self.assertIdentical(placement.place('a', 10), first)
+        self.assertEqual(self.store.get_placement('a'), first.path)
+
+    def test_removed(self):
+        """
+        A torrent removed by the plugin is no longer active, and its space
+        is released.
+        """
+        placement = self.placement(FEWEST_ACTIVE)
+        volume = placement.place('a', 10)
+        volume.admission.admit('a', 10)
+        placement.added('a')
+        self.assertEqual(volume.active, 1)
+        placement.removed('a')
+        placement.removed('a')
+        self.assertEqual(volume.active, 0)
+        self.assertEqual(volume.admission.reserved, 0)
+
+    def test_refresh(self):
+        """
+        The active torrents of each volume are counted again from the
+        statuses of the torrents in Deluge, no longer counting those which
+        finished or are gone, so fewest_active does not drift.
+        """
+        placement = self.placement(FEWEST_ACTIVE)
+        for info_hash in 'abc':
+            placement.place(info_hash, 10)
+            placement.added(info_hash)
+        self.assertEqual([volume.active for volume in self.volumes], [1, 1, 1])
+        placement.refresh({'a': status('/data/0', is_finished=True),
+                           'c': status('/data/2'), 'd': status('/data/2')})
+        self.assertEqual([volume.active for volume in self.volumes], [0, 0, 2])
+        self.assertEqual(placement.place('e', 10).path, '/data/0')
+
+    def test_stats(self):
+        """
+        The stats of each volume have its active torrents and utilisation.
+        """
+        placement = self.placement(MOST_FREE)
+        placement.track({'a': status('/data/1')})
+        stats = placement.get_stats()['/data/1']
+        self.assertEqual(stats['active'], 1)
+        self.assertEqual(stats['weight'], 2)
+        self.assertEqual(stats['utilisation'], 0.5)
+
+
+
+class LoadVolumesTests(unittest.TestCase):
+    """
+    Tests for L{load_volumes}.
+    """
+
+    def config(self, roots):
+        return {'storage_roots': roots, 'admission_high_water': 0.8}
+
+    def test_default(self):
+        """
+        Without storage roots the default path is the only volume.
+        """
+        volumes = load_volumes(self.config([]), '/downloads')
+        self.assertEqual([(v.path, v.weight) for v in volumes], [('/downloads', 1)])
+        self.assertEqual(volumes[0].admission.high_water, 0.8)
+
+    def test_roots(self):
+        """
+        Storage roots are given as paths or as dictionaries with a weight.
+        """
+        volumes = load_volumes(self.config(['/data/0', {'path': '/data/1', 'weight': 3}]),
+                               '/downloads')
+        self.assertEqual([(v.path, v.weight) for v in volumes],
+                         [('/data/0', 1), ('/data/1', 3)])
@@ -0,0 +1,145 @@
+'''
+Tests for L{lobbercore.pool}.
+'''
+
+from twisted.internet.protocol import ClientFactory
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactor
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from lobbercore.pool import HTTPConnectionPool, upstreamName
+
+KEY = ('tracker.example', 80, False)
+
+
+class MemoryClock(MemoryReactor, Clock):
+    """
+    A reactor recording the connections made, with a controllable clock.
+    """
+
+    def __init__(self):
+        MemoryReactor.__init__(self)
+        Clock.__init__(self)
+
+
+
+class FakeRequestFactory(ClientFactory):
+    """
+    Stands in for a L{PersistentProxyClientFactory}.
+    """
+
+    def __init__(self):
+        self.father = DummyRequest([])
+
+
+
+class FakeProtocol(object):
+    """
+    Stands in for a L{PersistentProxyClient}, reporting to the pool when its
+    connection is closed.
+    """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.transport = self
+        self.requests = []
+        self.closed = False
+
+    def proxyRequest(self, clientFactory):
+        self.requests.append(clientFactory)
+
+    def loseConnection(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.connectionLost(self.key, self)
+
+
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+    """
+    Tests for L{HTTPConnectionPool}.
+    """
+
+    def setUp(self):
+        self.reactor = MemoryClock()
+        self.pool = HTTPConnectionPool(self.reactor, maxIdle=2, maxTotal=2,
+                                       idleTimeout=0.3)
+
+    def connect(self, n=1):
+        """
+        Send C{n} requests at once, which open a connection each, and relay
+        their responses.
+        """
+        for i in range(n):
+            self.pool.request(KEY, FakeRequestFactory())
+        protocols = [FakeProtocol(self.pool, KEY) for i in range(n)]
+        for protocol in protocols:
+            self.pool.release(KEY, protocol)
+        return protocols
+
+    def stats(self):
+        return self.pool.getStats()[upstreamName(KEY)]
+
+    def test_idleExpiry(self):
+        """
+        Idle connections are closed after C{idleTimeout} seconds, and no
+        longer count towards C{maxTotal}.
+        """
+        protocols = self.connect(2)
+        self.assertEqual(self.stats(),
+                         {'open': 2, 'idle': 2, 'queued': 0})
+        self.reactor.advance(0.3)
+        self.assertEqual([protocol.closed for protocol in protocols], [True, True])
+        self.assertEqual(self.stats(),
+                         {'open': 0, 'idle': 0, 'queued': 0})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def test_connectAfterIdleExpiry(self):
+        """
+        Requests made after idle connections have expired open new
+        connections instead of waiting for one.
+        """
+        for i in range(3):
+            self.connect(2)
+            self.reactor.advance(0.3)
+        self.pool.request(KEY, FakeRequestFactory())
+        self.assertEqual(len(self.reactor.tcpClients), 7)
+        self.assertEqual(self.stats()['queued'], 0)
+
+    def test_idleReused(self):
+        """
+        An idle connection is handed the next request and its idle timeout is
+        cancelled.
+        """
+        protocol, = self.connect()
+        clientFactory = FakeRequestFactory()
+        self.pool.request(KEY, clientFactory)
+        self.assertEqual(protocol.requests, [clientFactory])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+
+    def test_idleClosedByServer(self):
+        """
+        An idle connection closed by the server is forgotten, with its idle
+        timeout.
+        """
+        protocol, = self.connect()
+        protocol.loseConnection()
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(self.stats(),
+                         {'open': 0, 'idle': 0, 'queued': 0})
+
+    def test_queuedUntilClosed(self):
+        """
+        Requests beyond C{maxTotal} wait for a connection to close, then
+        open one.
+        """
+        self.pool.request(KEY, FakeRequestFactory())
+        self.pool.request(KEY, FakeRequestFactory())
+        self.pool.request(KEY, FakeRequestFactory())
+        self.assertEqual(self.stats()['queued'], 1)
+        FakeProtocol(self.pool, KEY).loseConnection()
+        self.assertEqual(self.stats(),
+                         {'open': 2, 'idle': 0, 'queued': 0})
+        self.assertEqual(len(self.reactor.tcpClients), 3)
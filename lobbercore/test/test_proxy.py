@@ -0,0 +1,435 @@
+'''
+Tests for L{lobbercore.proxy}.
+'''
+
+import zlib
+from StringIO import StringIO
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError, TimeoutError
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from lobbercore.breaker import CircuitBreaker
+from lobbercore.cache import HTTPCache
+from lobbercore.encoding import ACCEPT_ENCODING
+from lobbercore.metrics import Registry
+from lobbercore.proxy import ProxyRoute, ProxyResource
+
+BODY = '[{"id": 1}]'
+
+
+class LocalRequest(DummyRequest):
+    """
+    A request of a local client to the proxy.
+    """
+
+    clientproto = 'HTTP/1.1'
+    producer = None
+
+    def __init__(self, uri, method='GET', headers=None, body=''):
+        DummyRequest.__init__(self, [])
+        self.uri = uri
+        self.path = uri.split('?', 1)[0]
+        self.method = method
+        self.content = StringIO(body)
+        self.headers.update(headers or {})
+
+    @property
+    def code(self):
+        return self.responseCode or 200
+
+    def getAllHeaders(self):
+        return dict(self.headers)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+
+class FakePool(object):
+    """
+    An L{HTTPConnectionPool} which keeps the requests handed to it for the
+    test to connect.
+    """
+
+    def __init__(self):
+        self.metrics = Registry()
+        self.requests = []
+        self.released = []
+        self.dequeued = []
+
+    def request(self, key, clientFactory):
+        clientFactory.pool = self
+        clientFactory.key = key
+        self.requests.append(clientFactory)
+
+    def connectionMade(self, key, protocol):
+        pass
+
+    def release(self, key, protocol):
+        self.released.append(protocol)
+
+    def connectionLost(self, key, protocol):
+        pass
+
+    def connectionFailed(self, key):
+        pass
+
+    def dequeue(self, key, clientFactory):
+        self.dequeued.append(clientFactory)
+
+
+
+class ProxyRouteTests(unittest.TestCase):
+    """
+    Tests for L{ProxyRoute} and the upstream requests it makes.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakePool()
+
+    def route(self, **kwargs):
+        kwargs.setdefault('pool', self.pool)
+        kwargs.setdefault('reactor', self.clock)
+        return ProxyRoute('tracker.example', 8080, **kwargs)
+
+    def render(self, route, uri, **kwargs):
+        request = LocalRequest(uri, **kwargs)
+        route.render(request, request.path)
+        return request
+
+    def connect(self, clientFactory):
+        """
+        Connect C{clientFactory} and return its protocol.
+        """
+        protocol = clientFactory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        return protocol
+
+    def sent(self, protocol):
+        """
+        Return the request line and the headers sent by C{protocol}.
+        """
+        lines = protocol.transport.value().split('\r\n\r\n', 1)[0].split('\r\n')
+        return lines[0], dict(line.split(': ', 1) for line in lines[1:])
+
+    def respond(self, protocol, body=BODY, headers=(), code='200 OK'):
+        head = ['HTTP/1.1 %s' % code, 'Content-Length: %d' % len(body)]
+        head.extend(headers)
+        protocol.dataReceived('\r\n'.join(head) + '\r\n\r\n' + body)
+
+    def test_rewrite(self):
+        """
+        The first match of each rewrite pattern is replaced in the path, and
+        the query is relayed as it is.
+        """
+        route = self.route(path_rewrite=[['^/tracker/', '/t/'], ['t', 'T']])
+        self.render(route, '/tracker/announce?info_hash=tracker')
+        self.assertEqual(self.pool.requests[0].rest,
+                         '/T/announce?info_hash=tracker')
+
+    def test_routePrefix(self):
+        """
+        L{ProxyResource} removes the prefix of a route from the path of the
+        requests routed by it, and routes by host.
+        """
+        prefixed = self.route()
+        hosted = self.route()
+        resource = ProxyResource()
+        resource.addRoute(prefixed, '/lobber')
+        resource.addRoute(hosted, hosts=['Tracker.Example'])
+        resource.render(LocalRequest('/lobber/torrent/1.torrent?x=1'))
+        resource.render(LocalRequest('/lobber', headers={'host': 'tracker.example:7001'}))
+        self.assertEqual([f.rest for f in self.pool.requests],
+                         ['/torrent/1.torrent?x=1', '/lobber'])
+        request = LocalRequest('/other')
+        resource.render(request)
+        self.assertEqual(request.responseCode, 404)
+
+    def test_headers(self):
+        """
+        The headers of the route replace those of the local client, and the
+        request goes upstream on a persistent connection with a known body
+        length.
+        """
+        route = self.route(headers={'X_LOBBER_KEY': 'secret'})
+        self.render(route, '/upload', method='POST', body='data',
+                    headers={'host': 'localhost:7001',
+                             'x_lobber_key': 'forged',
+                             'connection': 'close',
+                             'transfer-encoding': 'chunked',
+                             'accept-encoding': 'identity'})
+        clientFactory = self.pool.requests[0]
+        protocol = self.connect(clientFactory)
+        while protocol.transport.producer is not None:
+            # The body is sent by a pull producer.
+            protocol.transport.producer.resumeProducing()
+        line, headers = self.sent(protocol)
+        self.assertEqual(line, 'POST /upload HTTP/1.1')
+        self.assertEqual(headers['host'], 'tracker.example:8080')
+        self.assertEqual(headers['x_lobber_key'], 'secret')
+        self.assertEqual(headers['connection'], 'keep-alive')
+        self.assertEqual(headers['content-length'], '4')
+        self.assertEqual(headers['accept-encoding'], ACCEPT_ENCODING)
+        self.assertNotIn('transfer-encoding', headers)
+        self.assertEqual(clientFactory.acceptEncoding, 'identity')
+        self.assertEqual(protocol.transport.value().split('\r\n\r\n', 1)[1], 'data')
+
+    def test_defaultPort(self):
+        """
+        The Host header leaves out the default port of the scheme.
+        """
+        for port, tls in ((80, False), (443, True)):
+            route = ProxyRoute('tracker.example', port, tls, pool=self.pool)
+            self.assertEqual(route.headers['host'], 'tracker.example')
+
+    def test_response(self):
+        """
+        The response is relayed without its hop-by-hop headers, and the
+        connection handed back to the pool.
+        """
+        request = self.render(self.route(), '/feed.json')
+        protocol = self.connect(self.pool.requests[0])
+        self.respond(protocol, headers=['Connection: keep-alive',
+                                        'Keep-Alive: timeout=5',
+                                        'ETag: "v1"'])
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders('etag'), ['"v1"'])
+        for name in ('connection', 'keep-alive'):
+            self.assertFalse(request.responseHeaders.hasHeader(name))
+        self.assertEqual(self.pool.released, [protocol])
+
+    def test_totalDeadline(self):
+        """
+        A request still waiting for a connection when its total deadline runs
+        out is taken out of the pool queue and answered with a 504.
+        """
+        request = self.render(self.route(totalTimeout=10), '/feed.json')
+        self.clock.advance(9)
+        self.assertEqual(request.finished, 0)
+        self.clock.advance(1)
+        self.assertEqual(request.responseCode, 504)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(self.pool.dequeued, self.pool.requests)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_firstByteDeadline(self):
+        """
+        A request without a status line C{firstByteTimeout} seconds after it
+        was sent is answered with a 504 and its connection dropped.
+        """
+        request = self.render(self.route(firstByteTimeout=5, totalTimeout=30),
+                              '/feed.json')
+        self.clock.advance(20)
+        protocol = self.connect(self.pool.requests[0])
+        self.clock.advance(5)
+        self.assertEqual(request.responseCode, 504)
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_deadlineAfterStatus(self):
+        """
+        A response which has started when the total deadline runs out is
+        ended where it is.
+        """
+        request = self.render(self.route(totalTimeout=10), '/feed.json')
+        protocol = self.connect(self.pool.requests[0])
+        protocol.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n[')
+        self.clock.advance(10)
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(request.written, ['['])
+        self.assertEqual(request.finished, 1)
+        self.assertTrue(protocol.transport.disconnecting)
+
+    def test_answeredInTime(self):
+        """
+        The deadlines of a request answered in time are cancelled.
+        """
+        request = self.render(self.route(firstByteTimeout=5, totalTimeout=10),
+                              '/feed.json')
+        self.respond(self.connect(self.pool.requests[0]))
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_streaming(self):
+        """
+        Requests for streaming paths have no deadlines.
+        """
+        route = self.route(firstByteTimeout=5, totalTimeout=10,
+                           streaming=['/events$'])
+        self.render(route, '/feed/events?since=1')
+        self.assertIdentical(self.pool.requests[0].totalTimeout, None)
+        self.assertIdentical(self.pool.requests[0].firstByteTimeout, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connectFailed(self):
+        """
+        A failed connection is answered with a 502, a timed out one with a
+        504.
+        """
+        for reason, code in ((ConnectionRefusedError(), 502),
+                             (TimeoutError(), 504)):
+            request = self.render(self.route(), '/feed.json')
+            self.pool.requests[-1].clientConnectionFailed(None, Failure(reason))
+            self.assertEqual(request.responseCode, code)
+            self.assertEqual(request.finished, 1)
+
+    def test_closedBeforeStatus(self):
+        """
+        A new connection closed before the status line is answered with a
+        502.
+        """
+        request = self.render(self.route(), '/feed.json')
+        protocol = self.connect(self.pool.requests[0])
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(request.responseCode, 502)
+        self.assertEqual(request.finished, 1)
+
+    def test_reusedClosed(self):
+        """
+        A request whose reused connection is closed before the status line
+        is sent again on a new connection.
+        """
+        route = self.route()
+        self.render(route, '/1')
+        protocol = self.connect(self.pool.requests[0])
+        self.respond(protocol)
+        request = self.render(route, '/2')
+        protocol.proxyRequest(self.pool.requests[1])
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(request.finished, 0)
+        self.assertEqual(self.pool.requests[2:], self.pool.requests[1:2])
+
+    def test_breaker(self):
+        """
+        Failed requests are counted by the breaker, and requests are refused
+        with a 503 while it is open.
+        """
+        breaker = CircuitBreaker('tracker', failureThreshold=2, resetTimeout=30,
+                                 reactor=self.clock)
+        route = self.route(breaker=breaker)
+        self.render(route, '/1')
+        self.respond(self.connect(self.pool.requests[-1]), code='502 Bad Gateway')
+        self.render(route, '/2')
+        self.pool.requests[-1].clientConnectionFailed(
+            None, Failure(ConnectionRefusedError()))
+        request = self.render(route, '/3')
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.outgoingHeaders['retry-after'], '31')
+        self.assertEqual(len(self.pool.requests), 2)
+
+
+
+class CachedRouteTests(unittest.TestCase):
+    """
+    Tests for L{ProxyRoute} with a cache, whose fetches go through
+    L{ProxyRoute.fetcher}.
+    """
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.cache = HTTPCache([['^/torrent/.*\\.json$', 60, 300]], 1024 * 1024)
+        self.route = ProxyRoute('tracker.example', 80, pool=self.pool,
+                                cache=self.cache, headers={'X_LOBBER_KEY': 'k'})
+
+    def render(self, uri, **kwargs):
+        request = LocalRequest(uri, **kwargs)
+        self.route.render(request, request.path)
+        return request
+
+    def answer(self, clientFactory, head):
+        protocol = clientFactory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(head)
+        return protocol
+
+    def test_revalidation(self):
+        """
+        A stale entry is served and revalidated in the background with a
+        conditional GET carrying the headers of the route, and refreshed by
+        a 304.
+        """
+        self.render('/torrent/feed.json')
+        self.answer(self.pool.requests[0],
+                    'HTTP/1.1 200 OK\r\nETag: "v1"\r\nContent-Length: %d\r\n\r\n%s'
+                    % (len(BODY), BODY))
+        self.cache.get('/torrent/feed.json').stored -= 100
+        request = self.render('/torrent/feed.json')
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(request.finished, 1)
+        revalidation = self.pool.requests[1]
+        self.assertEqual(revalidation.command, 'GET')
+        self.assertEqual(revalidation.headers['if-none-match'], '"v1"')
+        self.assertEqual(revalidation.headers['x_lobber_key'], 'k')
+        self.answer(revalidation, 'HTTP/1.1 304 Not Modified\r\n\r\n')
+        self.assertEqual(self.cache.getStats()['not_modified'], 1)
+        self.render('/torrent/feed.json')
+        self.assertEqual(len(self.pool.requests), 2)
+
+    def test_expiredRevalidation(self):
+        """
+        An expired entry is revalidated for the local request, which gets
+        the entry when the upstream server answers with a 304.
+        """
+        self.render('/torrent/feed.json')
+        self.answer(self.pool.requests[0],
+                    'HTTP/1.1 200 OK\r\nETag: "v1"\r\nContent-Length: %d\r\n\r\n%s'
+                    % (len(BODY), BODY))
+        self.cache.get('/torrent/feed.json').stored -= 1000
+        request = self.render('/torrent/feed.json', headers={'if-none-match': '"v0"'})
+        self.assertEqual(request.finished, 0)
+        self.assertEqual(self.pool.requests[1].headers['if-none-match'], '"v1"')
+        self.answer(self.pool.requests[1], 'HTTP/1.1 304 Not Modified\r\n\r\n')
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(''.join(request.written), BODY)
+
+    def test_uncachedMethod(self):
+        """
+        Requests other than GET are relayed without the cache.
+        """
+        request = self.render('/torrent/feed.json', method='POST', body='x')
+        self.assertEqual(self.pool.requests[0].command, 'POST')
+        self.assertIdentical(self.pool.requests[0].father, request)
+
+    def gzipResponse(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(BODY) + compressor.flush()
+        return ('HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n'
+                'Content-Length: %d\r\n\r\n%s' % (len(body), body)), body
+
+    def test_passThrough(self):
+        """
+        A compressed response to a path the cache has no rule for is relayed
+        as it is to a client accepting its encoding, and decoded for one
+        which does not.
+        """
+        head, body = self.gzipResponse()
+        request = self.render('/torrent/1.torrent', headers={'accept-encoding': 'gzip'})
+        self.assertEqual(self.pool.requests[0].acceptEncoding, 'gzip')
+        self.answer(self.pool.requests[0], head)
+        self.assertEqual(''.join(request.written), body)
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-encoding'), ['gzip'])
+        request = self.render('/torrent/1.torrent')
+        self.answer(self.pool.requests[1], head)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertFalse(request.responseHeaders.hasHeader('content-encoding'))
+        self.assertFalse(request.responseHeaders.hasHeader('content-length'))
+
+    def test_cachedDecoded(self):
+        """
+        Responses to cached paths are decoded, so that the entry can answer
+        any client.
+        """
+        head, body = self.gzipResponse()
+        request = self.render('/torrent/feed.json', headers={'accept-encoding': 'gzip'})
+        self.assertIdentical(self.pool.requests[0].acceptEncoding, None)
+        self.answer(self.pool.requests[0], head)
+        self.assertEqual(''.join(request.written), BODY)
+        self.assertEqual(self.cache.get('/torrent/feed.json').body, BODY)
@@ -0,0 +1,262 @@
+'''
+Tests for L{lobbercore.resolver}.
+'''
+
+from twisted.internet import defer
+from twisted.internet.error import DNSLookupError
+from twisted.internet.protocol import ClientFactory, Protocol
+from twisted.internet.task import Clock
+from twisted.names import dns
+from twisted.names.error import DomainError
+from twisted.trial import unittest
+from lobbercore.resolver import CachingResolver, HappyEyeballsConnector, interleave
+
+
+class FakeNames(object):
+    """
+    A L{twisted.names} resolver answering from C{records}, a list of
+    C{(type, address, ttl)} per name, whose lookups are fired by the test.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.lookups = []
+        self.fail = False
+
+    def lookup(self, name, type):
+        d = defer.Deferred()
+        self.lookups.append((name, type, d))
+        return d
+
+    def lookupAddress(self, name):
+        return self.lookup(name, dns.A)
+
+    def lookupIPV6Address(self, name):
+        return self.lookup(name, dns.AAAA)
+
+    def answer(self):
+        lookups, self.lookups = self.lookups, []
+        for name, type, d in lookups:
+            records = []
+            for recordType, address, ttl in self.records.get(name, []):
+                if recordType == type and not self.fail:
+                    if type == dns.A:
+                        payload = dns.Record_A(address, ttl)
+                    else:
+                        payload = dns.Record_AAAA(address, ttl)
+                    records.append(dns.RRHeader(name, type, dns.IN, ttl, payload))
+            if records:
+                d.callback((records, [], []))
+            else:
+                d.errback(DomainError(name))
+
+
+
+class CachingResolverTests(unittest.TestCase):
+    """
+    Tests for L{CachingResolver}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.names = FakeNames()
+        self.names.records['tracker'] = [(dns.A, '192.0.2.1', 60),
+                                         (dns.A, '192.0.2.2', 100),
+                                         (dns.AAAA, '2001:db8::1', 300)]
+        self.resolver = CachingResolver(self.names, minTTL=10, maxTTL=3600,
+                                        maxStale=100, reactor=self.clock)
+
+    def resolve(self):
+        results = []
+        self.resolver.resolve('tracker').addBoth(results.append)
+        self.names.answer()
+        return results[0]
+
+    def test_interleave(self):
+        self.assertEqual(interleave(['a', 'b'], ['1', '2', '3']), ['a', '1', 'b', '2', '3'])
+
+    def test_resolve(self):
+        """
+        Addresses are ordered IPv6 first and cached for the shortest TTL.
+        """
+        self.assertEqual(self.resolve(), ['2001:db8::1', '192.0.2.1', '192.0.2.2'])
+        self.assertEqual(self.resolver.getStats()['tracker']['ttl'], 60)
+        self.clock.advance(10)
+        self.assertEqual(self.resolve(), ['2001:db8::1', '192.0.2.1', '192.0.2.2'])
+        self.assertEqual(self.names.lookups, [])
+
+    def test_coalesced(self):
+        """
+        Concurrent lookups of a name are made once.
+        """
+        results = []
+        self.resolver.resolve('tracker').addCallback(results.append)
+        self.resolver.resolve('tracker').addCallback(results.append)
+        self.assertEqual(len(self.names.lookups), 2)
+        self.names.answer()
+        self.assertEqual(len(results), 2)
+
+    def test_refresh(self):
+        """
+        An entry is looked up again in the background before it expires.
+        """
+        self.resolve()
+        self.clock.advance(50)
+        self.names.records['tracker'] = [(dns.A, '192.0.2.3', 60)]
+        self.assertEqual(self.resolve(), ['2001:db8::1', '192.0.2.1', '192.0.2.2'])
+        self.assertEqual(self.resolve(), ['192.0.2.3'])
+
+    def test_stale(self):
+        """
+        An expired entry is used for up to C{maxStale} seconds while lookups
+        fail.
+        """
+        self.resolve()
+        self.names.fail = True
+        self.clock.advance(120)
+        self.assertEqual(self.resolve(), ['2001:db8::1', '192.0.2.1', '192.0.2.2'])
+        self.clock.advance(100)
+        self.assertEqual(self.resolve().type, DNSLookupError)
+
+    def test_address(self):
+        """
+        IP addresses are not looked up.
+        """
+        self.assertEqual(self.resolver.resolve('::1').result, ['::1'])
+        self.assertEqual(self.names.lookups, [])
+
+
+
+class Resolved(object):
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+
+    def resolve(self, host):
+        return defer.succeed(self.addresses)
+
+
+
+class RecordingFactory(ClientFactory):
+
+    def __init__(self):
+        self.failed = []
+        self.built = []
+
+    def buildProtocol(self, addr):
+        protocol = Protocol()
+        self.built.append(protocol)
+        return protocol
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed.append(reason)
+
+
+
+class FakeConnector(object):
+    """
+    A connection attempt, which reports failing when it is stopped like
+    the reactor's connectors do.
+    """
+
+    state = 'connecting'
+
+    def __init__(self, host, factory):
+        self.host = host
+        self.factory = factory
+
+    def stopConnecting(self):
+        self.state = 'disconnected'
+        self.factory.clientConnectionFailed(self, 'stopped')
+
+
+
+class ConnectingClock(Clock):
+    """
+    A reactor recording the connection attempts made, with a controllable
+    clock.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.connectors = []
+
+    def connectTCP(self, host, port, factory, timeout=30):
+        connector = FakeConnector(host, factory)
+        self.connectors.append(connector)
+        factory.startedConnecting(connector)
+        return connector
+
+
+
+class HappyEyeballsConnectorTests(unittest.TestCase):
+    """
+    Tests for L{HappyEyeballsConnector}.
+    """
+
+    def setUp(self):
+        self.reactor = ConnectingClock()
+        self.factory = RecordingFactory()
+        self.connector = HappyEyeballsConnector(
+            self.reactor, Resolved(['2001:db8::1', '192.0.2.1', '192.0.2.2']),
+            'tracker', 80, self.factory, attemptDelay=0.25)
+        self.connector.connect()
+
+    def attempts(self):
+        return [connector.host for connector in self.reactor.connectors]
+
+    def fail(self, i, reason='refused'):
+        connector = self.reactor.connectors[i]
+        connector.state = 'disconnected'
+        connector.factory.clientConnectionFailed(connector, reason)
+
+    def test_staggered(self):
+        """
+        Addresses are tried in order, C{attemptDelay} seconds apart.
+        """
+        self.assertEqual(self.attempts(), ['2001:db8::1'])
+        self.reactor.advance(0.25)
+        self.assertEqual(self.attempts(), ['2001:db8::1', '192.0.2.1'])
+
+    def test_failedAttempt(self):
+        """
+        The next address is tried at once when an attempt fails.
+        """
+        self.fail(0)
+        self.assertEqual(self.attempts(), ['2001:db8::1', '192.0.2.1'])
+
+    def test_firstWins(self):
+        """
+        The first connection made is used, and the other attempts stopped.
+        """
+        self.reactor.advance(0.25)
+        winner = self.reactor.connectors[1]
+        winner.state = 'connected'
+        winner.factory.buildProtocol(None)
+        self.assertEqual(len(self.factory.built), 1)
+        self.assertEqual(self.connector.state, 'connected')
+        self.assertEqual(self.reactor.connectors[0].state, 'disconnected')
+        self.reactor.advance(1)
+        self.assertEqual(len(self.attempts()), 2)
+        self.assertEqual(self.factory.failed, [])
+
+    def test_allFail(self):
+        """
+        The factory is told the connection failed once every address has.
+        """
+        self.reactor.advance(1)
+        for i in range(3):
+            self.fail(i)
+        self.assertEqual(self.factory.failed, ['refused'])
+        self.assertEqual(self.connector.state, 'disconnected')
+
+    def test_stopConnecting(self):
+        """
+        Stopping the connector fails the connection once and stops the
+        attempts.
+        """
+        self.connector.stopConnecting()
+        self.assertEqual(len(self.factory.failed), 1)
+        self.assertEqual(self.reactor.connectors[0].state, 'disconnected')
+        self.reactor.advance(1)
+        self.assertEqual(self.attempts(), ['2001:db8::1'])
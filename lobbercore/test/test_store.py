@@ -0,0 +1,140 @@
+'''
+Tests for L{lobbercore.store}.
+'''
+
+import time
+from twisted.internet import task
+from twisted.trial import unittest
+from lobbercore.store import TorrentStore, KNOWN, ADDED, REMOVED
+
+
+
+class TorrentStoreTests(unittest.TestCase):
+    """
+    Tests for L{TorrentStore}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.clock = task.Clock()
+        self.store = self.open()
+
+    def tearDown(self):
+        self.store.db.close()
+
+    def open(self):
+        return TorrentStore(self.path, flush_delay=5, batch_size=3,
+                            reactor=self.clock)
+
+    def restart(self):
+        """
+        Close the store as the plugin does when it is disabled and open it
+        again from its database.
+        """
+        self.store.close()
+        self.store = self.open()
+
+    def stored(self):
+        return dict(self.store.db.execute('SELECT info_hash, state FROM torrents'))
+
+    def test_index(self):
+        """
+        States are in the index as soon as they are set.
+        """
+        self.store.seen('a')
+        self.store.set_state('b', ADDED)
+        self.store.seen('b')
+        self.assertIn('a', self.store)
+        self.assertNotIn('c', self.store)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.store.get_state('a'), KNOWN)
+        self.assertEqual(self.store.get_state('b'), ADDED)
+        self.assertFalse(self.store.is_removed('b'))
+
+    def test_writeBehind(self):
+        """
+        States are written to the database once C{flush_delay} seconds have
+        passed.
+        """
+        self.store.set_state('a', ADDED)
+        self.assertEqual(self.stored(), {})
+        self.clock.advance(5)
+        self.assertEqual(self.stored(), {'a': ADDED})
+        self.assertEqual(self.store.get_stats()['pending'], 0)
+
+    def test_batchSize(self):
+        """
+        States are written at once when C{batch_size} writes are pending.
+        """
+        for info_hash in 'abc':
+            self.store.set_state(info_hash, REMOVED)
+        self.assertEqual(len(self.stored()), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unchanged(self):
+        """
+        Setting the state a torrent already has writes nothing.
+        """
+        self.store.set_state('a', ADDED)
+        self.store.flush()
+        self.store.set_state('a', ADDED)
+        self.assertEqual(self.store.get_stats()['pending'], 0)
+        self.assertEqual(self.store.get_stats()['writes']['changes'], 1)
+
+    def test_restart(self):
+        """
+        The index and placements are rebuilt from the database, including
+        the writes still pending when the store was closed.
+        """
+        self.store.seen('a')
+        self.store.set_state('b', ADDED)
+        self.store.set_placement('b', '/data/1')
+        self.store.flush()
+        self.store.set_state('a', REMOVED)
+        self.store.set_state('c', ADDED)
+        self.store.set_placement('c', '/data/2')
+        self.restart()
+        self.assertEqual(self.store.index, {'a': REMOVED, 'b': ADDED, 'c': ADDED})
+        self.assertEqual(self.store.placements, {'b': '/data/1', 'c': '/data/2'})
+        self.assertTrue(self.store.is_removed('a'))
+        stats = self.store.get_stats()
+        self.assertEqual((stats[KNOWN], stats[ADDED], stats[REMOVED]), (0, 2, 1))
+
+    def test_failedWrite(self):
+        """
+        Writes which fail are kept and written by the next flush.
+        """
+        self.store.set_state('a', ADDED)
+        db = self.store.db
+        self.store.db = None
+        self.store.flush()
+        self.assertEqual(self.store.get_stats()['writes']['errors'], 1)
+        self.store.db = db
+        self.store.flush()
+        self.assertEqual(self.stored(), {'a': ADDED})
+
+    def test_expire(self):
+        """
+        Torrents which have been in a state for longer than the age given
+        are forgotten, with their placements, also after a restart.
+        """
+        self.store.set_state('a', REMOVED)
+        self.store.set_placement('a', '/data/1')
+        self.store.set_state('b', REMOVED)
+        self.store.flush()
+        self.store.db.execute('UPDATE torrents SET updated = ? WHERE info_hash = ?',
+                              (time.time() - 100, 'a'))
+        self.assertEqual(self.store.expire(REMOVED, 50), 1)
+        self.assertNotIn('a', self.store)
+        self.assertIdentical(self.store.get_placement('a'), None)
+        self.restart()
+        self.assertEqual(self.store.index, {'b': REMOVED})
+        self.assertEqual(self.store.placements, {})
+
+    def test_migrate(self):
+        """
+        The removed torrents of the old plugin config are imported and
+        written at once.
+        """
+        self.store.migrate(['a', 'b'])
+        self.assertEqual(self.stored(), {'a': REMOVED, 'b': REMOVED})
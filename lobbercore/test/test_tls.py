@@ -0,0 +1,123 @@
+'''
+Tests for L{lobbercore.tls}.
+'''
+
+from OpenSSL import SSL, crypto
+from twisted.trial import unittest
+from lobbercore import tls
+
+
+
+def serverContext():
+    """
+    Return a TLS 1.2 server context with a new self-signed certificate.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    ctx = SSL.Context(SSL.TLSv1_2_METHOD)
+    ctx.use_privatekey(key)
+    ctx.use_certificate(cert)
+    ctx.set_session_id(b'lobbercore')
+    return ctx
+
+
+def pump(client, server):
+    """
+    Move the bytes of C{client} and C{server} between them until neither
+    has any left.
+    """
+    moved = True
+    while moved:
+        moved = False
+        for a, b in ((client, server), (server, client)):
+            try:
+                data = a.bio_read(65536)
+            except SSL.WantReadError:
+                continue
+            b.bio_write(data)
+            moved = True
+
+
+def handshake(connection):
+    try:
+        connection.do_handshake()
+    except SSL.WantReadError:
+        pass
+
+
+
+class CachingClientContextFactoryTests(unittest.TestCase):
+    """
+    Tests for L{tls.CachingClientContextFactory}.
+    """
+
+    def setUp(self):
+        self.server = serverContext()
+        self.factory = tls.CachingClientContextFactory()
+        # A connection freed without a TLS shutdown loses its session.
+        self.connections = []
+
+    def connect(self):
+        """
+        Complete a handshake of a new client connection of the factory and
+        return the client connection.
+        """
+        client = SSL.Connection(self.factory.getContext(), None)
+        client.set_connect_state()
+        self.factory.prepareConnection(client)
+        server = SSL.Connection(self.server, None)
+        server.set_accept_state()
+        for i in range(10):
+            handshake(client)
+            handshake(server)
+            pump(client, server)
+        self.factory.saveSession(client)
+        self.connections.append((client, server))
+        return client
+
+    def test_resumed(self):
+        """
+        A reconnect resumes the session of the previous connection.
+        """
+        if not tls.canResume:
+            raise unittest.SkipTest('The binding cannot hand sessions on.')
+        self.connect()
+        self.connect()
+        self.assertEqual(self.factory.fullHandshakes, 1)
+        if tls.sessionReused(self.connect()) is None:
+            raise unittest.SkipTest('The binding does not tell resumption.')
+        self.assertEqual(self.factory.resumedHandshakes, 2)
+
+    def test_noSessions(self):
+        """
+        Where the binding cannot hand sessions on every connection does a
+        full handshake.
+        """
+        self.patch(tls, 'canResume', False)
+        self.connect()
+        self.connect()
+        self.assertEqual(self.factory.fullHandshakes, 2)
+        self.assertEqual(self.factory.resumedHandshakes, 0)
+        self.assertIdentical(self.factory._session, None)
+
+    def test_noReuseCheck(self):
+        """
+        Where the binding does not tell whether a handshake resumed a
+        session, the session is still handed on and the handshake counts as
+        full.
+        """
+        if not tls.canResume:
+            raise unittest.SkipTest('The binding cannot hand sessions on.')
+        self.patch(tls, '_lib', None)
+        self.connect()
+        self.connect()
+        self.assertEqual(self.factory.fullHandshakes, 2)
+        self.assertNotIdentical(self.factory._session, None)
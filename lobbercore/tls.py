@@ -0,0 +1,123 @@
+'''
+Shared TLS client contexts for the Lobber proxy.
+'''
+
+import time
+from OpenSSL import SSL
+from twisted.internet import ssl
+
+# Whether the binding can hand sessions from one connection to the next,
+# pyOpenSSL can since 0.14. Without it every connection does a full
+# handshake.
+canResume = (hasattr(SSL.Connection, 'get_session') and
+             hasattr(SSL.Connection, 'set_session'))
+
+# pyOpenSSL has no public way to tell whether a handshake resumed a
+# session, its private binding of OpenSSL is used where it has one.
+try:
+    from OpenSSL._util import lib as _lib
+except ImportError:
+    _lib = None
+if not hasattr(_lib, 'SSL_session_reused'):
+    _lib = None
+
+
+def sessionReused(connection):
+    """
+    Return C{True} if the handshake of C{connection} resumed a previous
+    session, C{False} if it was a full handshake and C{None} if the OpenSSL
+    binding does not tell.
+    """
+    if not canResume:
+        return False
+    handle = getattr(connection, '_ssl', None)
+    if _lib is None or handle is None:
+        return None
+    try:
+        return bool(_lib.SSL_session_reused(handle))
+    except (TypeError, AttributeError):
+        return None
+
+
+class CachingClientContextFactory(ssl.ClientContextFactory):
+    """
+    A client context factory which builds its OpenSSL context once and keeps
+    it for all connections to one upstream server, together with the last
+    TLS session, so that reconnects resume that session instead of doing a
+    full handshake.
+
+    The protocol version is negotiated, SSLv2 and SSLv3 are refused.
+
+    Where the OpenSSL binding cannot hand sessions on, see L{canResume},
+    every connection does a full handshake.
+
+    @ivar fullHandshakes: number of completed handshakes which did not resume
+        a session, or which cannot be told to have resumed one.
+    @ivar resumedHandshakes: number of completed handshakes which resumed a
+        session.
+    @ivar handshakeObserver: callable called with the duration in seconds of
+        each completed handshake and whether it resumed a session, or C{None}.
+    """
+
+    method = SSL.SSLv23_METHOD
+    _context = None
+    _session = None
+
+    def __init__(self, handshakeObserver=None):
+        self.fullHandshakes = 0
+        self.resumedHandshakes = 0
+        self.handshakeObserver = handshakeObserver
+
+    def getContext(self):
+        if self._context is None:
+            ctx = SSL.Context(self.method)
+            ctx.set_options(SSL.OP_NO_SSLv2)
+            ctx.set_options(SSL.OP_NO_SSLv3)
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+            ctx.set_info_callback(self._infoCallback)
+            self._context = ctx
+        return self._context
+
+    def prepareConnection(self, connection):
+        """
+        Offer the cached session to C{connection}. This must be called before
+        the handshake starts.
+        """
+        if canResume and self._session is not None:
+            connection.set_session(self._session)
+
+    def saveSession(self, connection):
+        """
+        Keep the session of C{connection} for the next connection. With TLS
+        1.3 the session ticket arrives after the handshake, so this is also
+        called once a connection has been used.
+        """
+        if canResume:
+            self._session = connection.get_session()
+
+    def getStats(self):
+        return {
+            'full_handshakes': self.fullHandshakes,
+            'resumed_handshakes': self.resumedHandshakes,
+        }
+
+    def _infoCallback(self, connection, where, ret):
+        # With TLS 1.3 post-handshake messages such as session tickets start
+        # and finish handshakes too, only the first one is counted.
+        if where & SSL.SSL_CB_HANDSHAKE_START:
+            if not hasattr(connection, '_handshakeStarted'):
+                connection._handshakeStarted = time.time()
+        elif where & SSL.SSL_CB_HANDSHAKE_DONE:
+            if getattr(connection, '_handshakeDone', False):
+                self.saveSession(connection)
+                return
+            connection._handshakeDone = True
+            reused = sessionReused(connection)
+            if reused:
+                self.resumedHandshakes += 1
+            else:
+                self.fullHandshakes += 1
+            self.saveSession(connection)
+            started = getattr(connection, '_handshakeStarted', None)
+            if self.handshakeObserver is not None and started is not None:
+                self.handshakeObserver(time.time() - started, bool(reused))